@@ -0,0 +1,301 @@
+"""
+Script: adjacency.py
+Purpose: Shared border helpers used by the landuse adjacency rules and the TC forest fragment rules.
+         Border lengths are computed in bulk over arrays of (left, right) geometry pairs with
+         vectorized shapely 2 operations instead of one intersection per Python loop iteration.
+         The county pseg adjacency graph (CSR, saved as output/pseg_graph.npz) is built once per
+         county and turns every landuse adjacency rule into an array query.
+"""
+import hashlib
+import os
+import time
+
+import numpy as np
+import shapely
+
+import luconfig
+import mp_runtime
+
+
+def shared_border_lengths(left_geoms, right_geoms):
+    """
+    Method: shared_border_lengths()
+    Purpose: Length of the intersection of each (left, right) geometry pair. If GEOS fails on the
+             vectorized call (invalid geometry), pairs are retried one at a time and the failing
+             pairs are returned as NaN so they never pass a border test, same as the old try/except loops.
+    Params: left_geoms - array of shapely geometries
+            right_geoms - array of shapely geometries, same length as left_geoms
+    Returns: lengths - float64 array of shared border lengths (NaN where the intersection failed)
+    """
+    left_geoms = np.asarray(left_geoms, dtype=object)
+    right_geoms = np.asarray(right_geoms, dtype=object)
+    if len(left_geoms) == 0:
+        return np.empty(0, dtype=np.float64)
+    try:
+        return shapely.length(shapely.intersection(right_geoms, left_geoms))
+    except shapely.errors.GEOSException:
+        lengths = np.full(len(left_geoms), np.nan)
+        for i, (l, r) in enumerate(zip(left_geoms, right_geoms)):
+            try:
+                lengths[i] = r.intersection(l).length
+            except shapely.errors.GEOSException:
+                pass
+        return lengths
+
+def border_pass(lengths, left_perimeters, btype, minborder):
+    """
+    Method: border_pass()
+    Purpose: Per pair shared border test used by the landuse adjacency rules.
+    Params: lengths - shared border length of each pair
+            left_perimeters - perimeter of the left geometry of each pair
+            btype - 'minimum': pass if border > minborder
+                    'percent': pass if border > minborder * left perimeter
+            minborder - minimum border length or fraction of the left perimeter
+    Returns: bool array, True for pairs that pass
+    """
+    lengths = np.asarray(lengths, dtype=np.float64)
+    if btype == 'minimum':
+        return lengths > minborder
+    if btype == 'percent':
+        return lengths > (minborder * np.asarray(left_perimeters, dtype=np.float64))
+    print(f"Border type must be 'minimum' or 'percent'! btype is currently {btype}")
+    raise TypeError(f"Border type must be 'minimum' or 'percent'! btype is currently {btype}")
+
+def patch_border_pass(patch_ids, lengths, patch_perimeters, r_field):
+    """
+    Method: patch_border_pass()
+    Purpose: Sum shared border per patch over all its pairs and test it against the patch perimeter,
+             used by the TC forest fragment rules.
+    Params: patch_ids - patch id of each pair
+            lengths - shared border length of each pair (NaN pairs count as 0)
+            patch_perimeters - perimeter of the patch of each pair
+            r_field - 'maj': pass if total border > half of the patch perimeter
+                      'all_ag': pass if total border > 85% of the patch perimeter
+    Returns: list of patch ids that pass
+    """
+    patch_ids = np.asarray(patch_ids)
+    if len(patch_ids) == 0:
+        return []
+    uniq, first, inv = np.unique(patch_ids, return_index=True, return_inverse=True)
+    total = np.bincount(inv, weights=np.nan_to_num(np.asarray(lengths, dtype=np.float64)), minlength=len(uniq))
+    perim = np.asarray(patch_perimeters, dtype=np.float64)[first]
+    if r_field == 'maj':
+        keep = total > (perim / 2)
+    elif r_field == 'all_ag':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            keep = (total / perim) > 0.85
+    else:
+        print(f"r_field must be 'maj' or 'all_ag'! r_field is currently {r_field}")
+        raise TypeError(f"r_field must be 'maj' or 'all_ag'! r_field is currently {r_field}")
+    return list(uniq[keep])
+
+
+#####################################################################################
+#------------------------------ PSEG ADJACENCY GRAPH -------------------------------#
+#####################################################################################
+class PsegGraph:
+    """
+    County pseg adjacency graph in CSR form. Nodes are psegs positions (row order of psegs when the
+    graph was built), edges are intersecting pseg pairs stored in both directions.
+    Params: psid - PSID of each node
+            perimeter - perimeter of each node
+            indptr - CSR row pointer (n + 1), edges of node i are indptr[i]:indptr[i+1]
+            indices - neighbour node of each edge
+            border - shared border length of each edge (NaN where GEOS failed)
+            nbr_psid - PSID of the neighbour of each edge
+    """
+    def __init__(self, psid, perimeter, indptr, indices, border, nbr_psid):
+        self.psid = psid
+        self.perimeter = perimeter
+        self.indptr = indptr
+        self.indices = indices
+        self.border = border
+        self.nbr_psid = nbr_psid
+
+    def __len__(self):
+        return len(self.psid)
+
+    def sources(self):
+        """
+        Returns the source node of every edge (expanded CSR rows).
+        """
+        return np.repeat(np.arange(len(self.psid), dtype=np.int64), np.diff(self.indptr))
+
+    def neighbours(self, node):
+        """
+        Returns (neighbour nodes, shared border lengths) of one node.
+        """
+        s, e = self.indptr[node], self.indptr[node + 1]
+        return self.indices[s:e], self.border[s:e]
+
+def _graph_task(args):
+    """
+    Worker for build_pseg_graph. Join a chunk of psegs against all psegs and measure the shared border
+    of each pair once (left < right) and the perimeter of the chunk.
+    """
+    layer, idx = args
+    left, right = mp_runtime.query_pairs(layer, idx, layer, None, 'intersects')
+    once = left < right
+    left, right = left[once], right[once]
+    lengths = shared_border_lengths(mp_runtime.layer_geoms(layer, left), mp_runtime.layer_geoms(layer, right))
+    return left, right, lengths, idx, shapely.length(mp_runtime.layer_geoms(layer, idx))
+
+def build_pseg_graph(psegs, runtime, batch_size):
+    """
+    Method: build_pseg_graph()
+    Purpose: Build the pseg adjacency graph on the worker runtime from the published 'psegs' layer.
+    Params: psegs - main pseg gdf, same rows as the published layer
+            runtime - mp_runtime.WorkerRuntime with 'psegs' published
+            batch_size - max psegs per task
+    Returns: PsegGraph
+    """
+    layer = runtime.layers['psegs']
+    n = len(psegs)
+    chunk_iterator = [(layer, c) for c in runtime.chunks(np.arange(n), batch_size)]
+    results = runtime.map(_graph_task, chunk_iterator)
+    left = np.concatenate([r[0] for r in results]) if results else np.empty(0, dtype=np.int64)
+    right = np.concatenate([r[1] for r in results]) if results else np.empty(0, dtype=np.int64)
+    lengths = np.concatenate([r[2] for r in results]) if results else np.empty(0, dtype=np.float64)
+
+    # both directions, sorted by source then neighbour
+    src = np.concatenate([left, right])
+    dst = np.concatenate([right, left])
+    border = np.concatenate([lengths, lengths])
+    order = np.lexsort((dst, src))
+    src, dst, border = src[order], dst[order], border[order]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+
+    psid = psegs['PSID'].values.astype(np.int64)
+    perimeter = np.zeros(n, dtype=np.float64)
+    for r in results:
+        perimeter[r[3]] = r[4]
+    return PsegGraph(psid, perimeter, indptr, dst.astype(np.int32), border, psid[dst])
+
+def save_pseg_graph(graph, path, key=''):
+    np.savez(path, psid=graph.psid, perimeter=graph.perimeter, indptr=graph.indptr,
+             indices=graph.indices, border=graph.border, nbr_psid=graph.nbr_psid, key=key)
+
+def load_pseg_graph(path):
+    """
+    Method: load_pseg_graph()
+    Purpose: Read a graph written by save_pseg_graph (ie {folder}/{cf}/output/pseg_graph.npz).
+    Returns: PsegGraph
+    """
+    with np.load(path) as g:
+        return PsegGraph(g['psid'], g['perimeter'], g['indptr'], g['indices'], g['border'], g['nbr_psid'])
+
+def graph_path(folder, cf):
+    return f"{folder}/{cf}/output/pseg_graph.npz"
+
+def graph_key(psegs, layer):
+    """
+    Method: graph_key()
+    Purpose: Content key of the graph inputs, the PSIDs and the published WKB of psegs. A rerun of data_prep keeps
+             sequential PSIDs, so the PSIDs alone do not tell a stale graph apart (see checkpoints.fingerprint).
+    Params: psegs - main pseg gdf, same rows as the published layer
+            layer - SharedLayer of psegs
+    Returns: hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(psegs['PSID'].values, dtype=np.int64).tobytes())
+    for sa in (layer.offsets, layer.wkb):
+        ary, shm = sa.attach()
+        sha.update(memoryview(np.ascontiguousarray(ary)).cast('B'))
+        del ary
+        if shm is not None:
+            shm.close()
+    return sha.hexdigest()
+
+def get_pseg_graph(cf, psegs, runtime, batch_size):
+    """
+    Method: get_pseg_graph()
+    Purpose: Load the county graph saved next to output/data.gpkg if its key matches psegs (graph_key), otherwise
+             build it on the runtime and save it.
+    Params: cf - county fips
+            psegs - main pseg gdf (after datacheck)
+            runtime - mp_runtime.WorkerRuntime with 'psegs' published
+            batch_size - max psegs per task
+    Returns: PsegGraph
+    """
+    path = graph_path(luconfig.folder, cf)
+    key = graph_key(psegs, runtime.layers['psegs'])
+    if os.path.isfile(path):
+        with np.load(path) as g:
+            saved = str(g['key']) if 'key' in g.files else ''
+        if saved == key:
+            graph = load_pseg_graph(path)
+            print(f'--Loaded pseg graph: {len(graph)} psegs, {len(graph.indices)} edges')
+            return graph
+        print('--Saved pseg graph does not match psegs, rebuilding')
+    gt = time.time()
+    graph = build_pseg_graph(psegs, runtime, batch_size)
+    save_pseg_graph(graph, path, key)
+    print(f'--Built pseg graph: {len(graph)} psegs, {len(graph.indices)} edges in {round(time.time()-gt)} seconds')
+    return graph
+
+def graph_adjacency(graph, df1_mask, df2_mask, btype, minborder):
+    """
+    Method: graph_adjacency()
+    Purpose: Vectorized adjacency rule over the graph; same result as the sjoin + border test of
+             adjacency_mp. A pseg in both df1 and df2 borders itself with its whole perimeter, as it did in the sjoin.
+    Params: graph - PsegGraph
+            df1_mask - bool array over nodes of psegs that can be classified
+            df2_mask - bool array over nodes of psegs df1 must border
+            btype - 'minimum' or 'percent' (see border_pass)
+            minborder - minimum border length or fraction of the df1 perimeter
+    Returns: passed - bool array over nodes of df1 psegs that pass
+    """
+    passed = np.zeros(len(graph), dtype=bool)
+    src = graph.sources()
+    edges = np.flatnonzero(df1_mask[src] & df2_mask[graph.indices])
+    ok = border_pass(graph.border[edges], graph.perimeter[src[edges]], btype, minborder)
+    passed[src[edges[ok]]] = True
+
+    both = np.flatnonzero(df1_mask & df2_mask)
+    if len(both) > 0:
+        perim = graph.perimeter[both]
+        passed[both[border_pass(perim, perim, btype, minborder)]] = True
+    return passed
+
+def frontier_edges(graph, frontier):
+    """
+    Returns the edges (positions in graph.indices) leaving the frontier nodes.
+    """
+    starts, ends = graph.indptr[frontier], graph.indptr[frontier + 1]
+    counts = ends - starts
+    if counts.sum() == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.repeat(starts - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())
+
+def grow_region(graph, df1_mask, df2_mask, btype, minborder, max_hops):
+    """
+    Method: grow_region()
+    Purpose: Region growing over the graph. The first hop is graph_adjacency(df1, df2); every later hop
+             labels the df1 psegs that border a pseg labelled in the previous hop, until nothing new is labelled
+             or max_hops is reached. Only the edges of the previous hop's psegs (the frontier) are tested, a pair
+             that failed the border test once cannot pass later.
+    Params: graph - PsegGraph
+            df1_mask - bool array over nodes of psegs that can be labelled
+            df2_mask - bool array over nodes of the seed psegs
+            btype - 'minimum' or 'percent' (see border_pass), the df1 pseg is the left pseg of every pair
+            minborder - minimum border length or fraction of the df1 perimeter
+            max_hops - max number of hops (1 is graph_adjacency)
+    Returns: hops - int32 array over nodes, hop at which a pseg was labelled (0 for psegs not labelled)
+    """
+    hops = np.zeros(len(graph), dtype=np.int32)
+    frontier = np.flatnonzero(graph_adjacency(graph, df1_mask, df2_mask, btype, minborder))
+    hop = 1
+    while len(frontier) > 0:
+        hops[frontier] = hop
+        print(f'----Hop {hop}: {len(frontier)} psegs')
+        if hop == max_hops:
+            break
+        edges = frontier_edges(graph, frontier)
+        nbr = graph.indices[edges].astype(np.int64)
+        open_nbr = df1_mask[nbr] & (hops[nbr] == 0)
+        edges, nbr = edges[open_nbr], nbr[open_nbr]
+        ok = border_pass(graph.border[edges], graph.perimeter[nbr], btype, minborder)
+        frontier = np.unique(nbr[ok])
+        hop += 1
+    return hops
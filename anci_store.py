@@ -0,0 +1,214 @@
+"""
+Script: anci_store.py
+Purpose: County partitioned store of the luconfig.anci_dict vector layers. Run once (and again whenever a
+         source layer is updated) before the county runs:
+
+            python anci_store.py              # build/refresh every vector layer
+            python anci_store.py -layers herePath UACPath --force
+
+         Each layer is read in full once and split by the county boundaries (luconfig.county_shp) into
+         {anci_store}/{key}.gpkg with one layer per county GEOID; GPKG layers carry their own spatial index.
+         manifest.json records the content hash (sha1) of every source so unchanged layers are skipped,
+         and the size/mtime of the source files so a county run falls back to the source if it changed
+         after the store was built. read_layer() caches layers per (key, county) in process.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+
+import luconfig
+
+MANIFEST = 'manifest.json'
+
+_cache = {} # (key, GEOID) -> gdf
+
+def vector_layers(anci_dict):
+    """
+    Returns anci_dict keys of vector layers (rasters are not stored).
+    """
+    return [k for k, v in anci_dict.items() if not v.lower().endswith('.tif')]
+
+def county_id(cf):
+    """
+    Returns the county GEOID of a cf (ie 'name_51001' -> '51001'), same as burn_in.getCountyGeom.
+    """
+    return cf.split('_')[-1]
+
+def source_files(ancipath):
+    """
+    Returns the files making up a vector source: every file of a .gdb, the sidecar files of a .shp.
+    """
+    ancipath = Path(ancipath)
+    if ".gdb" in str(ancipath).lower():
+        gdb = ancipath.parent if ancipath.suffix.lower() != '.gdb' else ancipath
+        return sorted(p for p in gdb.rglob('*') if p.is_file())
+    if ancipath.suffix.lower() == '.shp':
+        return sorted(p for p in ancipath.parent.glob(f'{ancipath.stem}.*') if p.is_file())
+    return [ancipath]
+
+def source_signature(ancipath):
+    files = source_files(ancipath)
+    return [sum(os.path.getsize(f) for f in files), max(os.path.getmtime(f) for f in files)]
+
+def source_hash(ancipath):
+    """
+    Method: source_hash()
+    Purpose: sha1 of the content of every file making up a vector source.
+    Params: ancipath - path to source layer
+    Returns: hex digest
+    """
+    sha = hashlib.sha1()
+    for f in source_files(ancipath):
+        sha.update(f.name.encode())
+        with open(f, 'rb') as src:
+            for block in iter(lambda: src.read(1 << 24), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def read_source(ancipath, bounds=None):
+    """
+    Method: read_source()
+    Purpose: Read a vector source (.gdb layer, .gpkg or .shp), optionally only features overlapping bounds.
+    Params: ancipath - path to source layer (a .gdb path ends with the layer name)
+            bounds - bbox filter (GeoSeries/GeoDataFrame or tuple), None reads every feature
+    Returns: gdf
+    """
+    ancipath = Path(ancipath)
+    if ".gdb" in str(ancipath).lower():
+        return gpd.read_file(os.path.dirname(ancipath), driver='FileGDB', layer=os.path.basename(ancipath), bbox=bounds)
+    return gpd.read_file(ancipath, bbox=bounds)
+
+def load_manifest(store):
+    path = Path(store, MANIFEST)
+    if not path.is_file():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(store, manifest):
+    tmp = Path(store, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, Path(store, MANIFEST))
+
+def partition_layer(anci, counties, outpath):
+    """
+    Method: partition_layer()
+    Purpose: Write the features of anci intersecting each county to a layer named by the county GEOID.
+             Features crossing county lines are written to every county they intersect.
+    Params: anci - full source layer
+            counties - county boundaries with GEOID, same crs as anci
+            outpath - output .gpkg
+    Returns: list of GEOIDs written (counties without features are not written)
+    """
+    cnty_idx, feat_idx = anci.sindex.query(counties.geometry.values, predicate='intersects')
+    written = []
+    for c in np.unique(cnty_idx):
+        geoid = str(counties['GEOID'].iloc[c])
+        anci.iloc[np.sort(feat_idx[cnty_idx == c])].to_file(outpath, layer=geoid, driver='GPKG')
+        written.append(geoid)
+    return written
+
+def prepare(anci_folder, anci_dict, store, county_shp, layers=None, force=False):
+    """
+    Method: prepare()
+    Purpose: Build or refresh the county partitioned store. A layer is rebuilt only if the content hash of
+             its source changed (or force); sources whose size and mtime did not change are not hashed again.
+    Params: anci_folder - base ancillary folder
+            anci_dict - luconfig.anci_dict
+            store - store folder (luconfig.anci_store)
+            county_shp - county boundaries relative to anci_folder (luconfig.county_shp)
+            layers - anci_dict keys to prepare, default every vector layer
+            force - rebuild even if the source did not change
+    Returns: N/A
+    """
+    os.makedirs(store, exist_ok=True)
+    manifest = load_manifest(store)
+    counties = None
+    for key in layers or vector_layers(anci_dict):
+        ancipath = Path(anci_folder, anci_dict[key])
+        lt = time.time()
+        signature = source_signature(ancipath)
+        entry = manifest.get(key, {})
+        if not force and entry.get('source') == str(ancipath) and entry.get('signature') == signature:
+            print(f'--{key}: unchanged, skipping')
+            continue
+        sha = source_hash(ancipath)
+        if not force and entry.get('source') == str(ancipath) and entry.get('sha1') == sha:
+            print(f'--{key}: same content, updating signature')
+            entry['signature'] = signature
+            save_manifest(store, manifest)
+            continue
+
+        print(f'--{key}: building from {ancipath}')
+        if counties is None:
+            counties = gpd.read_file(Path(anci_folder, county_shp))[['GEOID', 'geometry']]
+        anci = read_source(ancipath)
+        outpath = Path(store, f'{key}.gpkg')
+        tmppath = Path(store, f'{key}.tmp.gpkg')
+        if tmppath.exists():
+            os.remove(tmppath)
+        written = partition_layer(anci, counties.to_crs(anci.crs), tmppath)
+        if len(written) > 0:
+            os.replace(tmppath, outpath)
+        elif outpath.exists():
+            os.remove(outpath)
+        manifest[key] = {'source': str(ancipath), 'sha1': sha, 'signature': signature,
+                         'crs': anci.crs.to_wkt() if anci.crs else None, 'counties': written}
+        save_manifest(store, manifest)
+        print(f'----{len(anci)} features to {len(written)} counties in {round(time.time()-lt)} seconds')
+
+def read_layer(anci_folder, key, ancipath, cf, bounds=None, store=None):
+    """
+    Method: read_layer()
+    Purpose: Read the features of an ancillary layer for a county from the store, cached per (key, county).
+             Falls back to a bbox read of the source if the layer is not in the store or its source changed
+             after the store was built.
+    Params: anci_folder - base ancillary folder
+            key - anci_dict key
+            ancipath - path to the source within anci_folder (anci_dict[key])
+            cf - county fips
+            bounds - bbox filter used for the fallback source read
+            store - store folder, default luconfig.anci_store
+    Returns: gdf
+    """
+    geoid = county_id(cf)
+    if (key, geoid) in _cache:
+        return _cache[(key, geoid)]
+    store = store or luconfig.anci_store
+    source = Path(anci_folder, ancipath)
+    entry = load_manifest(store).get(key)
+    rt = time.time()
+    if entry is None or entry['source'] != str(source):
+        print(f'----{key} not in anci store, reading source')
+        anci = read_source(source, bounds)
+    elif entry['signature'] != source_signature(source):
+        print(f'----{key} source changed since the anci store was built, reading source (rerun anci_store.py)')
+        anci = read_source(source, bounds)
+    elif geoid in entry['counties']:
+        anci = gpd.read_file(Path(store, f'{key}.gpkg'), layer=geoid)
+    else:
+        anci = gpd.GeoDataFrame(geometry=[], crs=entry['crs'])
+    print(f'----Anci read time ({key}): {round(time.time()-rt, 2)}')
+    _cache[(key, geoid)] = anci
+    return anci
+
+def clear_cache():
+    _cache.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the county partitioned ancillary store')
+    parser.add_argument('-layers', nargs='+', help='anci_dict keys to prepare (default all vector layers)')
+    parser.add_argument('--force', default=False, action='store_true')
+    args = parser.parse_args()
+
+    st = time.time()
+    prepare(luconfig.anci_folder, luconfig.anci_dict, luconfig.anci_store, luconfig.county_shp, args.layers, args.force)
+    print(f'--anci_store complete in {round(time.time()-st)} seconds')
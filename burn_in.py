@@ -23,12 +23,18 @@ import time
 import numpy as np
 import os
 import multiprocessing as mp 
+import shapely
 from shapely.geometry import box, mapping, Polygon
 from fiona.crs import from_epsg
 import pandas as pd
 from osgeo import gdal, gdalconst
 
 from helpers import etime
+import mp_runtime
+import polygonize
+import rasterizer
+import ras_store
+
 #####################################################################################
 #------------------------------- MAIN ------------- --------------------------------#
 #####################################################################################
@@ -143,6 +149,8 @@ def run_burnin_submodule(proj_folder, anci_folder, cf):
         st = time.time()
 
         if not os.path.exists(tidal_composite_path):
+            with rasterio.open(tidal_ras_path) as tidal_src: # county clip of SLR if it covers the tidal raster
+                slr_ras = ras_store.resolve(slr_ras, cf, tidal_src.bounds)
             createTidalComposite(tidal_ras_path, slr_ras, slr_clip, tidal_composite_path)
         etime(cf, "Tidal Wetlands composite raster created", st)
         st = time.time()
@@ -154,6 +162,8 @@ def run_burnin_submodule(proj_folder, anci_folder, cf):
     st = time.time()
 
     # run burn ins
+    with rasterio.open(lu_ras_path) as lu_src: # county clip of rail if it covers the lu raster
+        rail_path = ras_store.resolve(rail_path, cf, lu_src.bounds)
     clip_dict = {
         'rail': [rail_path, 'uint8'],
         'nontidal': [nontidal_ras_path, 'uint16'],
@@ -283,19 +293,7 @@ def prepTCT(lc_path, tc_path, proj_folder, cf, field_name):
         print(out_ras)
 
         if not os.path.exists(out_ras):
-            rst = rasterio.open(fn_ras)
-            meta = rst.meta.copy()
-            meta.update(compress='lzw', dtype='uint16')
-
-            with rasterio.open(out_ras, 'w+', **meta) as out:
-                out_arr = out.read(1)
-
-                # this is where we create a generator of geom, value pairs to use in rasterizing
-                shapes = ((geom,value) for geom, value in zip(vec_ds.geometry, vec_ds[field_name]))
-
-                tc_ras = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
-                out.write_band(1, tc_ras)
-            out.close()
+            rasterizer.rasterize_to_file(fn_ras, vec_ds.geometry, vec_ds[field_name].values, out_ras, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
             print(layer, " psegs with tc rasterized")
 
 
@@ -352,20 +350,7 @@ def prepPonds(lc_path, pond_path, pond_ras_path, field_name):
     vec_ds[field_name] = vec_ds[field_name].astype('int16')
 
 
-    rst = rasterio.open(fn_ras)
-    meta = rst.meta.copy()
-    meta.update(compress='lzw')
-    meta.update({"dtype": "uint16"})
-
-    with rasterio.open(out_ras, 'w+', **meta) as out:
-        out_arr = out.read(1)
-
-        # this is where we create a generator of geom, value pairs to use in rasterizing
-        shapes = ((geom, value) for geom, value in zip(vec_ds.geometry, vec_ds[field_name]))
-        pond_ras = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
-        
-        out.write_band(1, pond_ras)
-    out.close()
+    rasterizer.rasterize_to_file(fn_ras, vec_ds.geometry, vec_ds[field_name].values, out_ras, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
     print("ponds rasterized")
 
 def prepNontidalWetlands(lc_path, nontidal_path, nontidal_ras_path, field_name):
@@ -387,20 +372,7 @@ def prepNontidalWetlands(lc_path, nontidal_path, nontidal_ras_path, field_name):
     vec_ds[field_name] = vec_ds[field_name].astype('int16')
 
 
-    rst = rasterio.open(fn_ras)
-    meta = rst.meta.copy()
-    meta.update(compress='lzw')
-    meta.update({"dtype": "uint16"})
-
-    with rasterio.open(out_ras, 'w+', **meta) as out:
-        out_arr = out.read(1)
-
-        # this is where we create a generator of geom, value pairs to use in rasterizing
-        shapes = ((geom, value) for geom, value in zip(vec_ds.geometry, vec_ds[field_name]))
-        lu_ras = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
-        
-        out.write_band(1, lu_ras)
-    out.close()
+    rasterizer.rasterize_to_file(fn_ras, vec_ds.geometry, vec_ds[field_name].values, out_ras, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
     print("nontidal wetlands rasterized")
     
     # factors = [2, 4, 8, 16, 32, 64, 128, 256, 512]
@@ -424,20 +396,7 @@ def prepTidalWetlands(lc_path, tidal_path, tidal_ras_path, field_name):
     vec_ds[field_name] = vec_ds[field_name].astype('int16')
 
 
-    rst = rasterio.open(fn_ras)
-    meta = rst.meta.copy()
-    meta.update(compress='lzw')
-    meta.update({"dtype": "uint16"})
-
-    with rasterio.open(out_ras, 'w+', **meta) as out:
-        out_arr = out.read(1)
-
-        # this is where we create a generator of geom, value pairs to use in rasterizing
-        shapes = ((geom, value) for geom, value in zip(vec_ds.geometry, vec_ds[field_name]))
-        lu_ras = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
-        
-        out.write_band(1, lu_ras)
-    out.close()
+    rasterizer.rasterize_to_file(fn_ras, vec_ds.geometry, vec_ds[field_name].values, out_ras, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
     print("tidal wetlands rasterized")
     
     # factors = [2, 4, 8, 16, 32, 64, 128, 256, 512]
@@ -506,19 +465,7 @@ def rasterizeLU(lc_path, lu_path, lu_ras_path, field_name):
     vec_ds = gpd.read_file(fn_vec, layer='psegs_lu')
     field_name=field_name
 
-    rst = rasterio.open(fn_ras)
-    meta = rst.meta.copy()
-    meta.update(compress='lzw', dtype='uint16')
-
-    with rasterio.open(out_ras, 'w+', **meta) as out:
-        out_arr = out.read(1)
-
-        # this is where we create a generator of geom, value pairs to use in rasterizing
-        shapes = ((geom,value) for geom, value in zip(vec_ds.geometry, vec_ds[field_name])) #change field name here # lu_code
-
-        lu_ras = features.rasterize(shapes=shapes, fill=0, out=out_arr, transform=out.transform)
-        out.write_band(1, lu_ras)
-    out.close()
+    rasterizer.rasterize_to_file(fn_ras, vec_ds.geometry, vec_ds[field_name].values, out_ras, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2)) # lu_code
     print("psegs with lu rasterized")
 
 
@@ -954,26 +901,25 @@ def fixForest(ary, transform):
         
     if len(forest_gdf) > 0:
         # Step 3 - rasterize the speckles of forest as tct or toa
-        geoms = [(feature['geometry'],feature['burn']) for idx, feature in forest_gdf.iterrows()]
+        ary = rasterizer.rasterize_array(forest_gdf.geometry, forest_gdf['burn'].values, sh, transform, 'uint16', runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
         del forest_gdf
-        ary = rasterize(geoms, out_shape=sh, fill=0,  transform=transform, all_touched=False)
 
-        return ary.astype(np.uint16), True
+        return ary, True
     else:
         return None, False
 
 def vectorizeRaster(unique_array, transform):
     """
     Method: vectorizeRaster()
-    Purpose: Create polygon geometries for each unique zone in the raster.
+    Purpose: Create polygon geometries for each unique zone in the raster (exterior rings), tiles are polygonized
+             on the worker runtime (polygonize.py).
     Params: unique_array - numpy array of zones
             transform - rasterio transform of array that is to be vectorized
     Returns: zones_gdf - geodataframe of vectorized raster zones with unique field 'zone'
     """
     unique_array = unique_array.astype(np.int16)
-    geoms = []
-    for i, (s, v) in enumerate(shapes(unique_array, mask=unique_array.astype(bool) , connectivity=4, transform=transform)): 
-        geoms.append(Polygon(s['coordinates'][0]))
+    values, geoms = polygonize.polygonize_array(unique_array, transform, runtime=mp_runtime.get_runtime(mp.cpu_count() - 2))
+    geoms = shapely.polygons(shapely.get_exterior_ring(geoms))
     zones_gdf = gpd.GeoDataFrame(geometry=geoms, crs="EPSG:5070")
     zones_gdf['zone'] = [int(x) for x in range(1, len(zones_gdf)+1)]
     return zones_gdf
@@ -983,58 +929,13 @@ def sjoin_mp6(df1, batch_size, sjoin_op, sjoinCols, df2):
     """
     Method: sjoin_mp6()
     Purpose: Chunk and mp a sjoin function on specified geodataframes for specified operation,
-             retaining specified columns.
+             retaining specified columns. Runs on the shared worker runtime (mp_runtime).
     Params: df1 - geodataframe of data to chunk and sjoin (left gdf)
             batch_size - integer value of max number of records to include in each chunk
             sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
             sjoinCols - list of column names to retain
             df2 - geodataframe of data to sjoin (right gdf)
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
-    """
-    NUM_CPUS = mp.cpu_count() - 2
-    c = list(df1)
-    df1 = df1.reset_index()
-    df1 = df1[c]
-    if len(df1) == 0:
-        print('df1 is empty')
- 
-    num_chunks = int(len(df1) / batch_size) + 1
-
-    #make cols a string for now to pass as 4th arg to sjoin
-    tmpCols = ''
-    for s in range(len(sjoinCols)):
-        tmpCols += sjoinCols[s]
-        if s+1 != len(sjoinCols):
-            tmpCols += ' '
- 
-    chunk_iterator = []
-    for i in range(0, num_chunks):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        gdf_args = df1[mn:mx], df2, sjoin_op, tmpCols
-        chunk_iterator.append(gdf_args)
-
-    pool = mp.Pool(processes=NUM_CPUS)
-    sj_results = pool.map(sjoin_mp_pt5, chunk_iterator)
-    pool.close()
-    sj_results = pd.concat(sj_results)
-    sj_results.drop_duplicates(inplace=True)
-    return sj_results
-
-def sjoin_mp_pt5(args):
-    """
-    Method: sjoin_mp_pt5()
-    Purpose: Run sjoin on specified geodataframes for specified operation,
-             retaining specified columns.
-    Params: args - tuple of arguments
-                df1 - geodataframe of data to sjoin (left gdf)
-                df2 - geodataframe of data to sjoin (right gdf)
-                sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
-                sjoinCols - string of column names to retain, separated by a space
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
+    Returns: sjoinSeg - df of sjoined data, with sjoin columns retained
     """
-    df1, df2, sjoin_op, sjoinCols = args 
-    cols = sjoinCols.split(' ') #list of column names to keep
-    sjoinSeg = gpd.sjoin(df1, df2, op=sjoin_op)
-    sjoinSeg = sjoinSeg[cols]
-    sjoinSeg.drop_duplicates(inplace=True)
-    return sjoinSeg
\ No newline at end of file
+    runtime = mp_runtime.get_runtime(mp.cpu_count() - 2)
+    return runtime.sjoin_frames(df1, df2, sjoin_op, sjoinCols, batch_size)
\ No newline at end of file
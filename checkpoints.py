@@ -0,0 +1,119 @@
+"""
+Script: checkpoints.py
+Purpose: Rule block checkpoints for the landuse stage. After every named rule block of landuse_rev2.RUN the
+         classification state (PSID, lu codes plus their category table and the provenance event log) is saved to
+         {folder}/{cf}/output/checkpoints/{nn}_{block}.npz together with a fingerprint of the inputs and rule code.
+         A rerun restores the last checkpoint with a matching fingerprint and continues with the next block.
+         Checkpoints are removed once the county output is written.
+"""
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import lu_codes
+import provenance
+
+# modules whose code decides the classification, a change to any of them invalidates the checkpoints
+RULE_MODULES = ['landuse_rev2.py', 'lu_rules.py', 'rule_engine.py', 'lu_codes.py', 'provenance.py', 'adjacency.py', 'zone_raster.py', 'luconfig.py']
+
+
+def fingerprint(psegs, input_paths, code_paths=None):
+    """
+    Method: fingerprint()
+    Purpose: Fingerprint of the inputs and the rule code. psegs attributes are hashed by content (the county input
+             is copied from blob storage every run, so its mtime changes), other inputs by size and mtime.
+    Params: psegs - main pseg gdf after datacheck
+            input_paths - other input files (ancillary layers and rasters)
+            code_paths - rule code files, default RULE_MODULES next to this file
+    Returns: hex digest
+    """
+    sha = hashlib.sha1()
+    cols = [c for c in psegs.columns if c != 'geometry']
+    sha.update(','.join(cols).encode())
+    sha.update(pd.util.hash_pandas_object(psegs[cols], index=False).values.tobytes())
+    for p in sorted(str(p) for p in input_paths):
+        if os.path.exists(p):
+            st = os.stat(p)
+            sha.update(f'{p}|{st.st_size}|{st.st_mtime_ns}'.encode())
+        else:
+            sha.update(f'{p}|missing'.encode())
+    here = os.path.dirname(os.path.abspath(__file__))
+    for p in code_paths or [os.path.join(here, m) for m in RULE_MODULES]:
+        with open(p, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class Checkpoints:
+    """
+    Checkpoints of one county run.
+    Params: folder - luconfig.folder
+            cf - county fips
+            blocks - ordered rule block names
+            key - fingerprint() of the run
+    """
+    def __init__(self, folder, cf, blocks, key):
+        self.path = Path(folder, cf, 'output', 'checkpoints')
+        self.blocks = list(blocks)
+        self.key = key
+
+    def _file(self, i):
+        return Path(self.path, f'{i:02d}_{self.blocks[i]}.npz')
+
+    def save(self, block, psegs):
+        """
+        Method: save()
+        Purpose: Save the classification state after block.
+        Params: block - name of the block that just finished
+                psegs - main pseg gdf with coded lu
+        Returns: N/A
+        """
+        ct = time.time()
+        os.makedirs(self.path, exist_ok=True)
+        state = {'key': np.array(self.key), 'psid': psegs['PSID'].values}
+        for col in lu_codes.STATE_COLUMNS:
+            cat = psegs[col].array
+            state[f'{col}_codes'] = np.asarray(cat.codes, dtype=np.int32)
+            state[f'{col}_categories'] = np.array(list(cat.categories), dtype=str)
+        log = provenance.log()
+        state['event_positions'], state['event_rules'] = log.arrays()
+        rids = sorted(log.catalogue)
+        state['rule_ids'] = np.array(rids, dtype=np.int64)
+        state['rule_labels'] = np.array([log.catalogue[r][0] for r in rids], dtype=str)
+        state['rule_with_class'] = np.array([log.catalogue[r][1] for r in rids], dtype=bool)
+        tmp = Path(self.path, f'{block}.tmp.npz')
+        np.savez(tmp, **state)
+        os.replace(tmp, self._file(self.blocks.index(block)))
+        print(f'----Checkpoint {block} saved in {round(time.time()-ct, 2)} seconds')
+
+    def resume(self, psegs):
+        """
+        Method: resume()
+        Purpose: Restore lu and the provenance event log from the last valid checkpoint.
+        Params: psegs - main pseg gdf after datacheck, modified in place
+        Returns: index of the first block to run (0 if there is no valid checkpoint)
+        """
+        for i in range(len(self.blocks) - 1, -1, -1):
+            f = self._file(i)
+            if not f.is_file():
+                continue
+            with np.load(f) as state:
+                if str(state['key']) != self.key or not np.array_equal(state['psid'], psegs['PSID'].values):
+                    print(f'----Checkpoint {self.blocks[i]} does not match this run, ignoring')
+                    continue
+                for col in lu_codes.STATE_COLUMNS:
+                    psegs[col] = pd.Categorical.from_codes(state[f'{col}_codes'], categories=list(state[f'{col}_categories']))
+                catalogue = {int(r): (str(l), bool(w)) for r, l, w in zip(state['rule_ids'], state['rule_labels'], state['rule_with_class'])}
+                provenance.resume(provenance.EventLog.from_arrays(len(psegs), state['event_positions'], state['event_rules'], catalogue))
+            print(f'--Resuming after checkpoint {self.blocks[i]}')
+            return i + 1
+        return 0
+
+    def clear(self):
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
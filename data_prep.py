@@ -40,6 +40,15 @@ from qgis.core import *
 import argparse
 import sys
 import fnmatch
+import pyogrio
+import shapely
+import io
+
+import mp_runtime
+import overlay
+import polygonize
+import rasterizer
+import raster_psegs
 
 
 
@@ -65,6 +74,18 @@ class commandLine:
         help ='The ancillary folder which will contain rasters for tabulate area',
         )
 
+        parser.add_argument('--postgis',
+        default = False,
+        action = "store_true",
+        help ='Overlay segments and parcels in PostGIS instead of in process (overlay.py)',
+        )
+
+        parser.add_argument('--raster',
+        default = False,
+        action = "store_true",
+        help ='Derive psegs from the segment and parcel label grids instead of a vector overlay (raster_psegs.py)',
+        )
+
         args = parser.parse_args()
 
         if args.c == None:
@@ -82,6 +103,8 @@ class commandLine:
         self.project_folder = args.p
         self.county = args.c
         self.anci_folder = args.a
+        self.postgis = args.postgis
+        self.raster = args.raster
 
 
 class DataPrepHelper:
@@ -187,32 +210,32 @@ class DataPrepHelper:
     return out_path
 
 
+  def rastervector(self, raster_layer, out_path):
+    # tiled polygonizer (polygonize.py): one polygon per region of equal VALUE, layer named after the file like qgis
+    self.raster_layer = raster_layer
+    self.out_path = out_path
+    layer = os.path.splitext(os.path.basename(out_path))[0]
+    if os.path.exists(out_path):
+      os.remove(out_path)
+    n = polygonize.polygonize_to_file(raster_layer, out_path, layer, 'VALUE', runtime=mp_runtime.get_runtime())
+    print(n, 'polygons written to', out_path)
+    return out_path
+
+
   def prepRaster(self, input_path, parcels_gpd, target_field, output_path):
     self.input_path = input_path
     self.parcels_gpd = parcels_gpd
     self.target_field = target_field
     self.output_path = output_path
-    rst = rasterio.open(input_path)
-    meta = rst.meta.copy()
-    meta.update(compress='lzw', dtype='int32') #trying different dtypes here
-    # windows= rst.block_windows(1)
-    with rasterio.open(output_path, 'w+', **meta) as out:
-      # Maybe just write profile instead of building new raster
-        # for idx, window in windows:
-      out_arr = out.read(1)
-      # this is where we create a generator of geom, value pairs to use in rasterizing
-      if target_field == 'PID':
-        shapes1 = ((geom,value) for geom, value in zip(parcels_gpd.geometry, parcels_gpd.PID))
-      if target_field == 'pid':
-        shapes1 = ((geom,value) for geom, value in zip(parcels_gpd.geom, parcels_gpd.pid))
-      if target_field == 'SID':
-        shapes1 = ((geom,value) for geom, value in zip(parcels_gpd.geometry, parcels_gpd.SID))
-      if target_field == 'sid':
-        shapes1 = ((geom,value) for geom, value in zip(parcels_gpd.geom, parcels_gpd.sid))
-      par_ras = features.rasterize(shapes=shapes1, fill=0, out=out_arr, transform=out.transform)
-      out.write_band(1, par_ras)
-    out.close()
-    return out_arr
+    # tiled burn on the grid of input_path (rasterizer.py), written window by window
+    if target_field not in parcels_gpd.columns: # ie polygonized parcels still labelled VALUE
+      raise KeyError(f"{target_field} is not a field of the layer to rasterize: {list(parcels_gpd.columns)}")
+    if target_field in ('PID', 'SID'):
+      geoms = parcels_gpd.geometry
+    if target_field in ('pid', 'sid'):
+      geoms = parcels_gpd.geom
+    rasterizer.rasterize_to_file(input_path, geoms, parcels_gpd[target_field].values, output_path, 'int32', runtime=mp_runtime.get_runtime())
+    return output_path
 
 
   def vectorizeRaster(self, unique_array, raster_path):
@@ -230,18 +253,52 @@ class DataPrepHelper:
     zones_gdf['PID'] = [int(x) for x in range(1, len(zones_gdf)+1)] #id for sjoin
     return zones_gdf
 
-  def to_database(self, geo_dict):
+  def to_database(self, geo_dict, batch_size=100000):
+    # bulk load with COPY: geometry is sent as hex EWKB (no WKT), the spatial index is built after the load
     self.geo_dict = geo_dict
     geo_df = geo_dict['geo_df']
     name = geo_dict['name']
-    engine = create_engine(f'postgresql://{postgres_user}:{postgres_pass}@{postgres_host}:5432/{postgres_db}')
-    geo_df['geom'] = geo_df['geometry'].apply(lambda x: WKTElement(x.wkt, srid=5070))
-    geo_df.drop('geometry', 1, inplace=True)
-    print('got to dropping duplicative column')
-    geo_df.to_sql(name, engine, if_exists='replace', index=False, 
-                            dtype={'geom': Geometry('POLYGON', srid= 5070)})
+    conDB = psycopg2.connect(host=postgres_host,
+    database=postgres_db,
+    user=postgres_user,
+    password = postgres_pass)
+    cursor = conDB.cursor()
+    cols = [c for c in geo_df.columns if c != geo_df.geometry.name]
+    col_types = []
+    for c in cols:
+      if pandas.api.types.is_integer_dtype(geo_df[c]):
+        col_types.append(f'"{c}" bigint')
+      elif pandas.api.types.is_float_dtype(geo_df[c]):
+        col_types.append(f'"{c}" double precision')
+      else:
+        col_types.append(f'"{c}" text')
+    cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+    cursor.execute(f'CREATE TABLE "{name}" ({", ".join(col_types)}, geom geometry(POLYGON, 5070))')
+    quoted = ', '.join(f'"{c}"' for c in cols)
+    copy_sql = f'COPY "{name}" ({quoted}, geom) FROM STDIN WITH (FORMAT csv)'
+    for i in range(0, len(geo_df), batch_size):
+      batch = geo_df.iloc[i:i + batch_size]
+      data = pandas.DataFrame(batch[cols])
+      data['geom'] = shapely.to_wkb(shapely.set_srid(batch.geometry.values, 5070), hex=True, include_srid=True)
+      buf = io.StringIO()
+      data.to_csv(buf, header=False, index=False)
+      buf.seek(0)
+      cursor.copy_expert(copy_sql, buf)
+    print(f'copied {len(geo_df)} rows to {name}, building spatial index')
+    cursor.execute(f'CREATE INDEX "idx_{name}_geom" ON "{name}" USING GIST (geom)')
+    cursor.execute(f'ANALYZE "{name}"')
+    conDB.commit()
+    cursor.close()
+    conDB.close()
     return True
 
+  def spatial_parts(self, geo_df, part_size=2500):
+    # spatially compact partitions (grid cells of the feature centers, see overlay.spatial_chunks)
+    self.geo_df = geo_df
+    part = np.zeros(len(geo_df), dtype=np.int64)
+    for i, chunk in enumerate(overlay.spatial_chunks(shapely.bounds(geo_df.geometry.values), part_size, 2000)):
+      part[chunk] = i
+    return part
 
   def db_overlay(self, new_table):
     conDB = psycopg2.connect(host=postgres_host,
@@ -252,29 +309,26 @@ class DataPrepHelper:
     self.new_table = new_table
     sql_statement = '''CREATE TABLE if not exists {0}(SID bigint, Class_name text, PID bigint, geom geometry)'''.format(new_table)
     cursor.execute(sql_statement)
-    sql_statement = '''CREATE INDEX IF NOT EXISTS idx_parcelsPID on "parcels"("PID")'''
+    sql_statement = '''CREATE INDEX IF NOT EXISTS idx_parcelsPart on "parcels"("part")'''
     cursor.execute(sql_statement)
-    sql_PID = '''SELECT MAX("PID") from "parcels"'''
-    cursor.execute(sql_PID)
-    max_pid = cursor.fetchall()
-    max_pid = max_pid[0]
-    max_pid = max_pid[0]
+    sql_part = '''SELECT MAX("part") from "parcels"'''
+    cursor.execute(sql_part)
+    max_part = cursor.fetchall()
+    max_part = max_part[0]
+    max_part = max_part[0]
     conDB.commit()
     cursor.close()
     conDB.close()
+    # one statement per spatial partition of the parcels (spatial_parts), each worker touches a compact area
     sql_statements = []
-    num = math.ceil(max_pid/2500)
-    for x in range(num):
-      if x > 0:
-        w = x-1
-        if x < num:
-          sql_statements.append('''INSERT INTO {0}(SID,Class_name, PID, geom) SELECT
-          "lc_segs"."SID",
-          "lc_segs"."Class_name",
-          "parcels"."PID",
-          ST_Intersection("lc_segs".geom,"parcels".geom) as geom
-          FROM "lc_segs", "parcels"
-          WHERE "lc_segs".geom && "parcels".geom AND ST_Intersects("lc_segs".geom, "parcels".geom) and "parcels"."PID" > {1} and "parcels"."PID" < {2}'''.format(new_table,w*2500,x*2500))
+    for x in range(max_part + 1):
+      sql_statements.append('''INSERT INTO {0}(SID,Class_name, PID, geom) SELECT
+      "lc_segs"."SID",
+      "lc_segs"."Class_name",
+      "parcels"."PID",
+      ST_Intersection("lc_segs".geom,"parcels".geom) as geom
+      FROM "lc_segs", "parcels"
+      WHERE "lc_segs".geom && "parcels".geom AND ST_Intersects("lc_segs".geom, "parcels".geom) and "parcels"."part" = {1}'''.format(new_table,x))
 
     client = Client(processes=False)
     futures = client.map(curser, sql_statements)
@@ -284,19 +338,35 @@ class DataPrepHelper:
     return True
 
 
-  def read_psegs(self, new_table):
+  def read_psegs(self, new_table, outpath, layer_name, batch_size=100000):
+    # stream psegs through a server side cursor, every batch gets its PSIDs and is appended to the gpkg
     self.new_table = new_table
     conDB = psycopg2.connect(host=postgres_host,
     database=postgres_db,
     user=postgres_user,
     password = postgres_pass)
-    cursor = conDB.cursor()
-    print('reading in psegs as a geodataframe')
-    sql = "select * from {0}".format(new_table)
-    df = gpd.read_postgis(sql, conDB, crs = 5070)
+    cursor = conDB.cursor(name='read_psegs')
+    cursor.itersize = batch_size
+    print('streaming psegs to', outpath)
+    sql = "select sid, class_name, pid, ST_AsBinary(geom) from {0}".format(new_table)
+    cursor.execute(sql)
+    if os.path.exists(outpath):
+      os.remove(outpath)
+    n = 0
+    while True:
+      rows = cursor.fetchmany(batch_size)
+      if len(rows) == 0:
+        break
+      sid, class_name, pid, wkb = zip(*rows)
+      batch = gpd.GeoDataFrame({'sid': sid, 'class_name': class_name, 'pid': pid,
+                                'PSID': np.arange(n + 1, n + len(rows) + 1)},
+                               geometry=shapely.from_wkb([bytes(w) for w in wkb]), crs=5070)
+      pyogrio.write_dataframe(batch, outpath, layer=layer_name, driver='GPKG', geometry_type='Unknown', append=n > 0)
+      n += len(rows)
     cursor.close()
     conDB.close()
-    return df
+    print(n, 'psegs written')
+    return n
 
   def to_gpkg(self,geo_df, outpath, layer_name):
     self.geo_df = geo_df
@@ -387,13 +457,13 @@ if __name__ == '__main__':
     
     ### Create a temp raster
     print('creating a temp raster with parcels')
-    ras_arr = helper.prepRaster(snap_ras, parcels, 'PID', out_ras)
+    helper.prepRaster(snap_ras, parcels, 'PID', out_ras)
     time_helper.etime(county,'parcels rasterized', st)
     
     # Create a vector geopackage from the temp raster
     print('creating a vector from the temp raster')
     st = time.time()
-    parcels_gpkg = helper.qgisrastervector(out_ras, f"{project_folder}/{county}/input/vectorized_parcels.gpkg")
+    parcels_gpkg = helper.rastervector(out_ras, f"{project_folder}/{county}/input/vectorized_parcels.gpkg")
     # parcels = helper.vectorizeRaster(ras_arr, out_ras)
     # parcels.to_file('{0}/{1}/input/temp_dataprep.gpkg'.format(project_folder,county), layer = 'vectorized_parcels',driver = 'GPKG')
     time_helper.etime(county,'parcels raster is vectorized and sent to gpkg', st)
@@ -419,72 +489,114 @@ if __name__ == '__main__':
     lc_segs = gpd.read_file(segs_layer)
     lc_segs['SID']= [int(x) for x in range(1, len(lc_segs)+1)]
     parcels = gpd.read_file(parcs_layer)
+    parcels = parcels.rename(columns={'VALUE': 'PID'}) # polygonized label is the burned parcel id
 
-    print('sending parcels and segments to database tables')
-    st = time.time()
-
-    segs_dict = {
-      'geo_df':lc_segs,
-      'name':'lc_segs'
-    }
-    
-    parcs_dict = {
-      'geo_df':parcels,
-      'name':'parcels'
-    }
-    segsw = helper.to_database(segs_dict)
-    print('segments to DB:',segsw)
-    parcsw = helper.to_database(parcs_dict)
-    print('parcels to DB:',parcsw)
-
-    time_helper.etime(county,'parcels and lc_segs to database tables', st)
-    print('starting the union in SQL') 
-    st = time.time()
-    helper.db_overlay('psegs')
-    time_helper.etime(county,'created psegs',st)
-        
-    st = time.time()
-    print('reading in psegs, adding PSIDs, validating all geometries, and writing to gpkg')
-    so_gdf = helper.read_psegs('psegs')
+    out_ras_PID = '{0}/{1}/input/ps_parcels.tif'.format(project_folder,county)
+    out_ras_SID = '{0}/{1}/input/ps_segs.tif'.format(project_folder,county)
 
-    so_gdf['PSID']= [int(x) for x in range(1, len(so_gdf)+1)]
+    if system.raster:
+        print('deriving psegs from the segment and parcel label grids')
+        st = time.time()
+        helper.prepRaster(snap_ras, parcels, 'PID', out_ras_PID)
+        helper.prepRaster(snap_ras, lc_segs, 'SID', out_ras_SID)
+        time_helper.etime(county, 'parcels and segments rasterized', st)
+
+        st = time.time()
+        lc_vals = [1,2,3,4,5,6,7,8,9,10,11,12]
+        ps_df, parcels_df, segs_df = raster_psegs.pseg_table(out_ras_SID, out_ras_PID, snap_ras, lc_vals)
+        raster_psegs.write_labels(out_ras_SID, out_ras_PID, ps_df, '{0}/{1}/input/ps_psegs.tif'.format(project_folder,county))
+        temp_folder = '{0}/{1}/temp'.format(project_folder,county)
+        os.makedirs(temp_folder, exist_ok=True)
+        raster_psegs.write_tables(parcels_df, segs_df, lc_vals, temp_folder)
+        time_helper.etime(county, 'psegs, areas and land cover composition from pixel counts', st)
+
+        st = time.time()
+        psid, geoms = raster_psegs.vectorize('{0}/{1}/input/ps_psegs.tif'.format(project_folder,county), mp_runtime.get_runtime())
+        classes = lc_segs.set_index('SID')['Class_name']
+        so_gdf = gpd.GeoDataFrame(ps_df[['SID', 'PID', 'PSID', 'ps_area']].assign(Class_name=classes.reindex(ps_df['SID']).values),
+          geometry=geoms[np.searchsorted(psid, ps_df['PSID'].values)], crs=lc_segs.crs)
+        so_gdf = so_gdf.merge(parcels_df[['PID', 'p_area']], on='PID', how='left').merge(segs_df, on='SID', how='left')
+        psegs_path = "{0}/{1}/input/data.gpkg".format(project_folder,county)
+        pyogrio.write_dataframe(so_gdf, psegs_path, layer='psegs', driver='GPKG')
+        time_helper.etime(county, 'psegs vectorized and written to gpkg', st)
+
+    elif not system.postgis:
+        print('overlaying segments and parcels in process')
+        st = time.time()
+        runtime = mp_runtime.get_runtime()
+        so_gdf = overlay.overlay_psegs(lc_segs, parcels, runtime)
+        mp_runtime.shutdown_runtime()
+        time_helper.etime(county,'created psegs',st)
+
+        st = time.time()
+        psegs_path = "{0}/{1}/input/data.gpkg".format(project_folder,county)
+        pyogrio.write_dataframe(so_gdf, psegs_path, layer='psegs', driver='GPKG')
+        time_helper.etime(county, 'psegs written to gpkg', st)
+        pid_field, sid_field = 'PID', 'SID'
 
-    helper.to_gpkg(so_gdf,"{0}/{1}/input/psegs_temp.gpkg".format(project_folder,county),'psegs')
+    else:
+        print('sending parcels and segments to database tables')
+        st = time.time()
 
-    psegs_path = helper.validate_layer({'layer_path':"{0}/{1}/input/psegs_temp.gpkg".format(project_folder,county),
-    'layer_name':'psegs'})
+        segs_dict = {
+          'geo_df':lc_segs,
+          'name':'lc_segs'
+        }
+    
+        parcels['part'] = helper.spatial_parts(parcels)
+        parcs_dict = {
+          'geo_df':parcels,
+          'name':'parcels'
+        }
+        segsw = helper.to_database(segs_dict)
+        print('segments to DB:',segsw)
+        parcsw = helper.to_database(parcs_dict)
+        print('parcels to DB:',parcsw)
+
+        time_helper.etime(county,'parcels and lc_segs to database tables', st)
+        print('starting the union in SQL') 
+        st = time.time()
+        helper.db_overlay('psegs')
+        time_helper.etime(county,'created psegs',st)
+        
+        st = time.time()
+        print('reading in psegs, adding PSIDs, validating all geometries, and writing to gpkg')
+        helper.read_psegs('psegs', "{0}/{1}/input/psegs_temp.gpkg".format(project_folder,county), 'psegs')
 
-    time_helper.etime(county, 'assigned all PSIDs, validated all geometries, and written to gpkg', st)
+        psegs_path = helper.validate_layer({'layer_path':"{0}/{1}/input/psegs_temp.gpkg".format(project_folder,county),
+        'layer_name':'psegs'})
 
-    out_ras_PID = '{0}/{1}/input/ps_parcels.tif'.format(project_folder,county)
-    out_ras_SID = '{0}/{1}/input/ps_segs.tif'.format(project_folder,county)
+        time_helper.etime(county, 'assigned all PSIDs, validated all geometries, and written to gpkg', st)
+        so_gdf = gpd.read_file(psegs_path)
+        pid_field, sid_field = 'pid', 'sid'
 
     # we might not need this if not used for TA
-    so_gdf = gpd.read_file(psegs_path)
-    print('making a raster based on parcels')
-    st = time.time()
-    helper.prepRaster(snap_ras, so_gdf, 'pid',out_ras_PID)
-    time_helper.etime(county, 'Raster created based on PID', st)
-
-    st = time.time()
-    print('making a raster based on segments')
-    helper.prepRaster(snap_ras, so_gdf, 'sid',out_ras_SID)
-    time_helper.etime(county, 'Raster created based on SID', st)
-
-    print('dropping temporary tables, all other data has been prepared')
-    conDB = psycopg2.connect(host='localhost',
-    database=postgres_db,
-    user=postgres_user,
-    password = postgres_pass)
-    cursor = conDB.cursor()
-    sql_statement = '''DROP TABLE IF EXISTS "psegs"'''
-    cursor.execute(sql_statement)
-    sql_statement = '''DROP TABLE IF EXISTS "parcels"'''
-    cursor.execute(sql_statement)
-    sql_statement = '''DROP TABLE IF EXISTS "lc_segs"'''
-    cursor.execute(sql_statement)
-    conDB.commit()
-    cursor.close()
-    conDB.close()
+    if not system.raster: # raster mode burned the label grids already
+        print('making a raster based on parcels')
+        st = time.time()
+        helper.prepRaster(snap_ras, so_gdf, pid_field,out_ras_PID)
+        time_helper.etime(county, 'Raster created based on PID', st)
+
+        st = time.time()
+        print('making a raster based on segments')
+        helper.prepRaster(snap_ras, so_gdf, sid_field,out_ras_SID)
+        time_helper.etime(county, 'Raster created based on SID', st)
+
+    if system.postgis:
+        print('dropping temporary tables, all other data has been prepared')
+        conDB = psycopg2.connect(host='localhost',
+        database=postgres_db,
+        user=postgres_user,
+        password = postgres_pass)
+        cursor = conDB.cursor()
+        sql_statement = '''DROP TABLE IF EXISTS "psegs"'''
+        cursor.execute(sql_statement)
+        sql_statement = '''DROP TABLE IF EXISTS "parcels"'''
+        cursor.execute(sql_statement)
+        sql_statement = '''DROP TABLE IF EXISTS "lc_segs"'''
+        cursor.execute(sql_statement)
+        conDB.commit()
+        cursor.close()
+        conDB.close()
     print('this county',county, 'has been prepared, machine is ready for next county. goodbye :)')
     sys.exit()
\ No newline at end of file
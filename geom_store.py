@@ -0,0 +1,132 @@
+"""
+Script: geom_store.py
+Purpose: On disk WKB column of psegs for the geometry-lazy mode (luconfig.lu_lazy_geometry).
+         {folder}/wkb.bin holds the concatenated WKB of every pseg, offsets.npy the n + 1 byte offsets and
+         bounds.npy the n x 4 bounds. The files are memory mapped, so geometry of a subset is decoded on demand
+         and the landuse model only keeps attribute arrays in memory. The store is published to the worker
+         runtime as a file backed layer (mp_runtime.WorkerRuntime.publish_store).
+"""
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import shapely
+from pyproj import CRS
+
+WKB = 'wkb.bin'
+OFFSETS = 'offsets.npy'
+BOUNDS = 'bounds.npy'
+CRS_FILE = 'crs.wkt'
+
+
+class StoreWriter:
+    """
+    Writes a GeometryStore batch by batch (ie from an Arrow reader), only one batch is decoded at a time.
+    Params: folder - store folder, replaced if it exists
+            crs - crs of the geometries
+    """
+    def __init__(self, folder, crs):
+        self.folder = Path(folder)
+        if self.folder.exists():
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+        with open(Path(self.folder, CRS_FILE), 'w') as f:
+            f.write(CRS(crs).to_wkt() if crs else '')
+        self.wkb = open(Path(self.folder, WKB), 'wb')
+        self.offsets = [np.zeros(1, dtype=np.int64)]
+        self.bounds = []
+        self.size = 0
+
+    def append(self, wkbs):
+        """
+        Append a batch of WKB (array of bytes objects).
+        """
+        wkbs = np.asarray(wkbs, dtype=object)
+        lengths = np.fromiter((len(w) for w in wkbs), dtype=np.int64, count=len(wkbs))
+        self.offsets.append(self.size + np.cumsum(lengths))
+        self.size += int(lengths.sum())
+        self.wkb.write(b''.join(wkbs))
+        self.bounds.append(shapely.bounds(shapely.from_wkb(wkbs)))
+
+    def close(self):
+        """
+        Returns: GeometryStore of the written folder
+        """
+        self.wkb.close()
+        np.save(Path(self.folder, OFFSETS), np.concatenate(self.offsets))
+        np.save(Path(self.folder, BOUNDS), np.concatenate(self.bounds) if self.bounds else np.empty((0, 4)))
+        return GeometryStore(self.folder)
+
+
+class GeometryStore:
+    """
+    Memory mapped WKB column written by StoreWriter. Positions are psegs row positions.
+    Params: folder - store folder
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self._open()
+
+    def _open(self):
+        self.offsets = np.load(Path(self.folder, OFFSETS), mmap_mode='r')
+        self.bounds = np.load(Path(self.folder, BOUNDS), mmap_mode='r')
+        size = int(self.offsets[-1])
+        self.wkb = np.memmap(Path(self.folder, WKB), dtype=np.uint8, mode='r', shape=(size,)) if size > 0 else np.empty(0, dtype=np.uint8)
+        with open(Path(self.folder, CRS_FILE)) as f:
+            wkt = f.read()
+        self.crs = CRS(wkt) if wkt else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def paths(self):
+        return Path(self.folder, WKB), Path(self.folder, OFFSETS), Path(self.folder, BOUNDS)
+
+    def geoms(self, idx):
+        """
+        Returns shapely geometries of the requested positions (decoded every call, nothing is cached).
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        return shapely.from_wkb([self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes() for i in idx])
+
+    def chunks(self, batch_size):
+        """
+        Returns position ranges of at most batch_size psegs.
+        """
+        return [np.arange(s, min(s + batch_size, len(self))) for s in range(0, len(self), batch_size)]
+
+    def area(self, batch_size=1000000):
+        """
+        Returns the area of every geometry, decoded batch_size at a time.
+        """
+        area = np.zeros(len(self), dtype=np.float64)
+        for idx in self.chunks(batch_size):
+            area[idx] = shapely.area(self.geoms(idx))
+        return area
+
+    def keep(self, rows, batch_size=1000000):
+        """
+        Method: keep()
+        Purpose: Rewrite the store with only the rows kept (ie psegs dropped by datacheck), in place.
+        Params: rows - bool mask over the store
+                batch_size - max psegs copied at a time
+        Returns: N/A
+        """
+        rows = np.flatnonzero(np.asarray(rows))
+        if len(rows) == len(self):
+            return
+        tmp = Path(f'{self.folder}_tmp')
+        writer = StoreWriter(tmp, self.crs)
+        for s in range(0, len(rows), batch_size):
+            idx = rows[s:s + batch_size]
+            writer.append([self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes() for i in idx])
+        writer.close()
+        del self.wkb, self.offsets, self.bounds
+        shutil.rmtree(self.folder)
+        os.replace(tmp, self.folder)
+        self._open()
+
+    def remove(self):
+        del self.wkb, self.offsets, self.bounds
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -7,6 +7,8 @@ import subprocess
 import sys
 import fnmatch
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 
 import luconfig
 
@@ -111,7 +113,70 @@ def transfer_files(source, destination):
     print('Process ID (PID): ', run_process.pid)
     pid_list.append(run_process.pid)
 
+def zone_ids(values):
+    """
+    Returns zone ids (PID, SID or a table VALUE column) as int64, missing ids as -1.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = np.nan_to_num(values, nan=-1)
+    elif values.dtype.kind == 'O':
+        values = pd.to_numeric(pd.Series(values, copy=False)).fillna(-1).to_numpy()
+    return values.astype(np.int64)
+
+def zone_positions(ids, table_ids):
+    """
+    Method: zone_positions()
+    Purpose: Row of a zone table for every pseg. PID and SID are dense integers, so the table is indexed with one
+             lookup array (zone id -> table row) instead of a hash merge.
+    Params: ids - zone_ids() of the psegs
+            table_ids - zone_ids() of the table rows (unique)
+    Returns: int64 table row of every pseg, -1 where the zone is not in the table
+    """
+    size = int(max(ids.max(initial=-1), table_ids.max(initial=-1))) + 1
+    lookup = np.full(size, -1, dtype=np.int64)
+    valid = table_ids >= 0
+    lookup[table_ids[valid]] = np.flatnonzero(valid)
+    if valid.sum() != len(np.unique(table_ids[valid])):
+        print('----Zone table has duplicate zone ids, keeping the last row of each')
+    pos = np.full(len(ids), -1, dtype=np.int64)
+    has_id = ids >= 0
+    pos[has_id] = lookup[ids[has_id]]
+    return pos
+
+def gather_table(tabledf, zoneID, ids):
+    """
+    Method: gather_table()
+    Purpose: Gather every column of a zone table into psegs order, one allocation per column. Numeric columns
+             come back as int32 with 0 for psegs whose zone is missing (the old merge + fillna(0) + int32),
+             other columns as object with None.
+    Params: tabledf - zone table with a zoneID column
+            zoneID - 'PID' or 'SID'
+            ids - zone_ids() of psegs[zoneID]
+    Returns: {column: array}
+    """
+    pos = zone_positions(ids, zone_ids(tabledf[zoneID].values))
+    found = np.flatnonzero(pos >= 0)
+    rows = pos[found]
+    columns = {}
+    for col in tabledf.columns:
+        if col == zoneID:
+            continue
+        values = tabledf[col].to_numpy()
+        if values.dtype.kind in 'biuf':
+            out = np.zeros(len(ids), dtype=np.int32)
+            out[found] = np.nan_to_num(values[rows], nan=0).astype(np.int32) if values.dtype.kind == 'f' else values[rows]
+        else:
+            out = np.full(len(ids), None, dtype=object)
+            out[found] = values[rows]
+        columns[col] = out
+    return columns
+
 def joinData(cf, psegs, remove_columns):
+    """
+    Join the tabulate area tables of generate_TA_dict (plus segment and parcel area) to psegs by PID/SID.
+    Tables are gathered into psegs by position (gather_table), psegs rows and order are kept.
+    """
 
     jd_st = time.time()
 
@@ -138,6 +203,8 @@ def joinData(cf, psegs, remove_columns):
 
 
     missingLUZ_p, missingLUZ_s = False, False
+    ids = {zone: zone_ids(psegs[zone].values) for zone in ('PID', 'SID')}
+    joined = {} # column -> array in psegs order
 
     for dname, tadict in TA_dict.items():
         tabPath = tadict['tabPath']
@@ -240,8 +307,8 @@ def joinData(cf, psegs, remove_columns):
                 for drop_col in vcols:
                     tabledf = tabledf.drop(drop_col, axis=1)
 
-                print(f'merging {dname} to psegs by {zoneID}')
-                psegs = psegs.merge(tabledf, on=zoneID, how='left')
+                print(f'joining {dname} to psegs by {zoneID}')
+                joined.update(gather_table(tabledf, zoneID, ids[zoneID]))
 
             if dname in ('s_area', 'p_area'):
                 print(dname, " - group 2 (areas)")
@@ -252,9 +319,9 @@ def joinData(cf, psegs, remove_columns):
 
                 tabledf = tabledf.rename(columns={'Value': zoneID, 'Count': dname})
 
-                print(f'merging {dname} to psegs by {zoneID}')
+                print(f'joining {dname} to psegs by {zoneID}')
                 print(f'columns: {tabledf.columns}')
-                psegs = psegs.merge(tabledf, on=zoneID, how='left')
+                joined.update(gather_table(tabledf, zoneID, ids[zoneID]))
 
 
             if dname not in ('luz_pid', 'luz_sid', 's_area', 'p_area'):
@@ -265,15 +332,15 @@ def joinData(cf, psegs, remove_columns):
                     new_name = col.replace("VALUE_", f'{zoneAbv}_{data_source}_')
                     tabledf = tabledf.rename(columns={col: new_name})
 
-                print(f'merging {dname} to psegs by {zoneID}')
-                psegs = psegs.merge(tabledf, on=zoneID, how='left')
+                print(f'joining {dname} to psegs by {zoneID}')
+                joined.update(gather_table(tabledf, zoneID, ids[zoneID]))
 
 
         else:
             if dname == 'luz_sid' and missingLUZ_s:
-                psegs.loc[:, 's_luz'] = 'no_luz'
+                joined['s_luz'] = np.full(len(psegs), 'no_luz', dtype=object)
             elif dname == 'luz_pid' and missingLUZ_p:
-                psegs.loc[:, 'p_luz'] = 'no_luz'
+                joined['p_luz'] = np.full(len(psegs), 'no_luz', dtype=object)
             else:
                 print(f"bad file path {tabPath}")
                 raise TypeError(f"bad file path {tabPath}")
@@ -281,6 +348,7 @@ def joinData(cf, psegs, remove_columns):
                 # sys.exit()
 
     print('final columns')
+    psegs = psegs.drop(columns=[c for c in joined if c in psegs.columns]) # joined columns replace existing ones
     try:
         for fincol in psegs.columns:
             if fincol not in ('Class_name','p_luz','s_luz','geometry'):
@@ -289,6 +357,9 @@ def joinData(cf, psegs, remove_columns):
             print(fincol, psegs[fincol].dtype)
     except:
         print(psegs.dtypes)
+    psegs = psegs.assign(**joined)
+    for fincol in joined:
+        print(fincol, joined[fincol].dtype)
 
     etime(cf, "joinData()", jd_st)
 
@@ -397,4 +468,9 @@ def generate_TA_dict(cf):
         # 'n16_pid': n16_pid
     }
 
+    # coarse products at their native resolution (tabulated with cell coverage weights, see tabulateArea_v1)
+    for name, path in luconfig.ta_native_rasters.items():
+        if name in TA_dict:
+            TA_dict[name]['path'] = f'{anci_folder}/{path}'
+
     return TA_dict
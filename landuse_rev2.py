@@ -4,8 +4,10 @@ import pandas as pd
 import shapely
 import rasterio as rio
 import rasterio.mask
+from rasterio.windows import Window
 import numpy as np
 import fiona
+import pyogrio
 
 import time
 import os
@@ -17,9 +19,24 @@ from pathlib import Path
 import argparse
 
 import luconfig
+import mp_runtime
+import adjacency
+import rule_engine
+import lu_rules
+import lu_codes
+import provenance
+import anci_store
+import ras_store
+import zone_raster
+import checkpoints
+import psegs_schema
+import lu_tiles
 from helpers import lu_etime as etime
 from helpers import joinData
 
+# bit of each vector ancillary layer in psegs['anci_bits'] (see anci_overlay)
+ANCI_BITS = {key: bit for bit, key in enumerate(anci_store.vector_layers(luconfig.anci_dict))}
+
 
 def read_anci(anci_folder, ancipath, bounds):
     """
@@ -35,13 +52,7 @@ def read_anci(anci_folder, ancipath, bounds):
     ancipath = Path(anci_folder, ancipath)
     print(ancipath)
     rt = time.time()
-    if ".gdb" in str(ancipath).lower():
-        anci = gpd.read_file(os.path.dirname(ancipath), driver='FileGDB', layer=os.path.basename(ancipath), bbox=bounds)
-    if ".gpkg" in str(ancipath).lower():
-        gpd.read_file(ancipath, bbox=bounds) # check for multiple layers?
-        anci = gpd.read_file(ancipath, bbox=bounds)
-    else:
-        anci = gpd.read_file(ancipath,  bbox=bounds)  # read ancillary
+    anci = anci_store.read_source(ancipath, bounds)  # read ancillary
 
     print(f'----Anci read time: {round(time.time()-rt)}')
 
@@ -50,11 +61,11 @@ def read_anci(anci_folder, ancipath, bounds):
 
     return anci
 
-def datacheck(cf, psegs, folder):
+def datacheck(cf, psegs, folder, store=None):
 
     """
     Revised: 4/20/21
-    1. Check data strucutre
+    1. Check data strucutre against psegs_schema.SCHEMA (one pass, psegs_schema.conform)
         1a. required columns
         1b. flex columns
     2. Check/fix column dtypes
@@ -64,74 +75,46 @@ def datacheck(cf, psegs, folder):
         4b. check crs
     5. TODO - Check psegs coverage - compare psegs area to county boundary area +- threshold
     6. Calculate fresh PSID TODO - move/confirm existence in data prep
-    7. Calculate ps_area TODO - move to data prep
+    7. Calculate ps_area (and p_area/s_area if missing) TODO - move to data prep
+    store - geom_store.GeometryStore of psegs in the geometry-lazy mode (psegs is a df without geometry)
     """
     # print("psegs dtypes: \n", psegs.dtypes)
 
-    #required columns for landuse model to work
-    reqcolumns = ['SID', 'PID', 'Class_name', 'PSID', 'p_area', 's_area', 'ps_area',
-    'p_lc_1', 'p_lc_2', 'p_lc_3', 'p_lc_4', 'p_lc_5', 'p_lc_6', 'p_lc_7', 'p_lc_8', 'p_lc_9', 'p_lc_10', 'p_lc_11', 'p_lc_12',
-    's_c18_0', 's_c18_1', 's_c18_2', 's_c18_3', 's_c18_4',
-    'p_c18_0', 'p_c18_1', 'p_c18_2', 'p_c18_3', 'p_c18_4',
-    's_c1719_0', 's_c1719_1', 's_c1719_2', 's_c1719_3', 's_c1719_4',
-    's_n16_0', 's_n16_1', 
-    'p_luz','s_luz',
-    'logic', 'lu', 'geometry']
-
-    # required values that could realistically be missing from an entire county resulting in no column
-    flex_requiredcolumns = [
-            'p_lc_1', 'p_lc_2', 'p_lc_4', 'p_lc_6',
-            's_c18_1', 's_c18_2', 's_c18_3', 's_c18_4',
-            'p_c18_1', 'p_c18_2', 'p_c18_3', 'p_c18_4',
-            's_c1719_1', 's_c1719_2', 's_c1719_3', 's_c1719_4',
-            'p_luz','s_luz',
-            'lu_code'
-            ]
-
-    non_int32_columns = [ 'Class_name','p_luz','s_luz', 'logic', 'lu', 'geometry']
-
-    print(f'--Input psegs crs: {psegs.crs}')
-    if psegs.crs != "epsg:5070":
+    crs = psegs.crs if store is None else store.crs
+    print(f'--Input psegs crs: {crs}')
+    if crs != "epsg:5070":
         print("psegs crs is not 'epsg:5070', exiting...")
         raise TypeError("psegs crs is not 'epsg:5070'")
         # sys.exit()
 
     pre = len(psegs)
-    LC_classes = psegs.Class_name.unique()
-    print(LC_classes)
-    
-    psegs = psegs[(psegs.Class_name != "")]
-    post = len(psegs)
-    LC_classes = psegs.Class_name.unique()
-    print(LC_classes)
+    print(psegs.Class_name.unique())
+    keep = np.asarray(psegs.Class_name != "")
 
+    schema_st = time.time()
+    psegs = psegs_schema.conform(psegs, keep, store) # schema columns and dtypes, rows with a Class_name
+    post = len(psegs)
+    print(psegs.Class_name.unique())
     print(f'--Removed {pre-post} segments missing Class_name\n----Pre-removal : {pre}\n----Post-removal: {post}')
-
-    ADD_cols = ['lu', 'logic', 's_luz', 'p_luz']
-    for col in ADD_cols:
-        if col not in psegs.columns:
-            print(f"adding {col} column as Str/None")
-            psegs[col] = None
+    etime(cf, psegs, "Conformed psegs to schema", schema_st)
 
     tcreclass_st = time.time()
     print('Reclassing TC over classes')
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Roads"), 'lu'] = "Tree Canopy Over Roads"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Roads"), 'logic'] = "TC over"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Roads"), 'Class_name'] = "Roads"
-
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Other Impervious Surfaces"), 'lu'] = "Tree Canopy Over Other Impervious Surfaces"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Other Impervious Surfaces"), 'logic'] = "TC over"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Other Impervious Surfaces"), 'Class_name'] = "Other Impervious Surfaces"
-
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Structures"), 'lu'] = "Tree Canopy Over Structures"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Structures"), 'logic'] = "TC over"
-    psegs.loc[(psegs.Class_name == "Tree Canopy Over Structures"), 'Class_name'] = "Buildings"  
+    provenance.start(len(psegs)) # rows are final, rule events from here on
+    classes, lu = psegs['Class_name'].to_numpy(copy=True), psegs['lu'].to_numpy(copy=True)
+    for tc_class, lc_class in (("Tree Canopy Over Roads", "Roads"),
+                               ("Tree Canopy Over Other Impervious Surfaces", "Other Impervious Surfaces"),
+                               ("Tree Canopy Over Structures", "Buildings")):
+        tc = classes == tc_class
+        lu[tc] = tc_class
+        provenance.record(tc, "TC over")
+        classes[tc] = lc_class
+    psegs['Class_name'], psegs['lu'] = classes, lu
     etime(cf, psegs,  "Reclassed TC Over classes", tcreclass_st)
-        
-    if (len(psegs.PSID.unique()) != len(psegs) or 'PSID' not in psegs.columns):
-        print("Generating unique PSIDs")
-        psegs['PSID'] = [int(x) for x in range(1, len(psegs) + 1)]
 
+    if len(np.unique(psegs['PSID'].values)) != len(psegs):
+        print("Generating unique PSIDs")
+        psegs['PSID'] = np.arange(1, len(psegs) + 1, dtype=np.int32)
 
     for col in psegs.columns:
         print(col)
@@ -141,194 +124,172 @@ def datacheck(cf, psegs, folder):
     print(f"Unique PIDs : {len(psegs.PID.unique())}")
     print(f"Unique SIDs : {len(psegs.SID.unique())}")
 
-    if 'ps_area' not in psegs.columns:
-        if len(psegs) >= 6000000:
-            print("--Adding 'ps_area'(batching)")
-            get_ps_area(cf, psegs, 1000000)
-        else:
-            print("--Adding 'ps_area' (no batching)")
-            calc_ps_area_st = time.time()
-            psegs["ps_area"] = psegs['geometry'].area
-            etime(cf, psegs, "calculated 'ps_area'", calc_ps_area_st)
-
-    for col in psegs.columns:
-        if col not in reqcolumns:
-            print(f'Pseg file has a column that is not required! : deleting {col}!')
-            psegs = psegs.drop(columns=[col])
-
-    for col in reqcolumns:
-        if col not in psegs.columns:
-            if col in flex_requiredcolumns:
-                print(f'Flex column missing! - {col} \n--Adding {col} to table as zero...')
-                psegs[col] = 0
-                psegs[col] = psegs[col].astype('int32')
-            else:
-                print(f"Required column missing! - {col}")
-                
-
-
-            
-        if col not in non_int32_columns:
-            psegs[col] = psegs[col].fillna(0)
-            psegs = psegs.astype({col: 'int32'})
-    
+    psegs = lu_codes.encode(psegs) # Class_name and lu as integer coded categoricals
     print(psegs.dtypes)
 
     return psegs
 
 
-def sub_df_and_chunk(df1, df2, batch_size):
+def sjoin_and_border(args):
     """
-       1. read in psegs
-       2. filter all low veg segments & < 1000 sqm
-       3. delete unnecessary columns
-       4. create unique ids as DF1SID
-       5. filter buildings and clean columns
-       6. identify number of chunks for df2
-       """
-    # create 2 separate GeoDataFrames
-    
-    df1 = df1[['PSID', 'geometry', 's_area', 'lu']]  # add other fields you need
-    df1 = df1.reset_index()  # this is so we can chunk by index
-    df1['DF1SID'] = [int(x) for x in range(1, len(df1) + 1)]  # create UID  for df1 for batching
-
-    df2 = df2[['PSID', 'geometry']]
-    
-    if len(df1) == 0:
-        print('df1 is empty')
-    if len(df2) == 0:
-        print('df2 is empty')
-
-    num_chunks = int((len(df1) / batch_size) + 1)
-
-    return df1, df2, num_chunks
-
-def sub_df_and_chunk2(df1, batch_size):
+    Method: sjoin_and_border()
+    Purpose: Worker for adjacency_mp. Join a chunk of df1 positions against the df2 positions of the
+             published psegs layer and keep the df1 segments passing the shared border test.
+    Params: args - psegs layer, df1 positions, df2 mask, btype, minborder
+    Returns: passed_list - list of psegs positions from df1
     """
-       For LCMAP timber harvest - only need one query and number of chunks
-       1. read in psegs
-       2. filter remaining low veg and barren segments
-       3. delete unnecessary columns
-       4. create unique ids as DF1SID
-       5. identify number of chunks for df1
-       TODO - skip when chunks are empty, maybe
-       """
-
-    df1 = df1[['PSID', 'geometry']]  # 
-    df1 = df1.reset_index()  # this is so we can chunk by index
-    df1['DF1SID'] = [int(x) for x in range(1, len(df1) + 1)]  # create UID  for df1 for batching
-
-    if df1.empty:
-        print('df1 is empty') # TODO -step if this is true
+    layer, df1_idx, df2_mask, btype, minborder = args
+    left, right = mp_runtime.query_pairs(layer, df1_idx, layer, df2_mask, 'intersects')
+    lvGeos = mp_runtime.layer_geoms(layer, left)
+    buildingGeos = mp_runtime.layer_geoms(layer, right)
 
-    num_chunks = int((len(df1) / batch_size) + 1)
+    # shared border of every (df1, df2) pair in one vectorized call, failed intersections never pass
+    blength = adjacency.shared_border_lengths(lvGeos, buildingGeos)
+    passed = adjacency.border_pass(blength, shapely.length(lvGeos), btype, minborder)
+    passed_list = [int(lv) for lv in np.unique(left[passed])]
 
-    return df1, num_chunks
-
-def get_ps_area(cf, psegs, batch_size):
-
-    ps_area_st = time.time()
-    ###### PSID is already calculated on ln98 
-
-    num_chunks = int((len(psegs) / batch_size) + 1) # why +1?
-    
-    chunk_iterator = []
-    for i in range(0, num_chunks):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        mn = int(mn)
-        mx = int(mx)
-        print(f"--Chunk: {i}/{num_chunks} PSID {mn} thru {mx}")
-        psegs.loc[mn:mx, 'ps_area'] = psegs[mn:mx].geometry.area
+    return passed_list
 
-    etime(cf, psegs,  'get_ps_area', ps_area_st)
 
+def anci_overlay_pt2(args):
+    """
+    Method: anci_overlay_pt2()
+    Purpose: Worker for anci_overlay. Query a chunk of psegs positions against the combined ancillary layer
+             once and OR the bit of every intersecting feature's source layer into the chunk's bitmask.
+    Params: args - psegs layer, psegs positions, combined anci layer, bit of each anci feature
+    Returns: (positions, bits) - chunk positions and their uint16 ancillary bitmask
+    """
+    layer, idx, anci, feature_bits = args
+    left, right = mp_runtime.query_pairs(layer, idx, anci, None, 'intersects')
+    bits = np.zeros(len(idx), dtype=np.uint16)
+    np.bitwise_or.at(bits, np.searchsorted(idx, left), feature_bits[right])
+    return idx, bits
 
-def sjoin_and_border(args):
+def publish_psegs(psegs, store=None):
     """
-    args: df1, df2, psegs, DF1SID_min, DF1SID_max
-    returns: turf_psid_list
-    """
-    dft = time.time()
-    df1, df2, btype, minborder, chunk_num = args
-    #### for debugging memory bottle neck, helped determine batch_size
-    # print(f'chunk # {chunk_num}')
-    # print('sjb df1 mem: ', df1.memory_usage())
-    # print('sjb df1 len: ', len(df1))
-    # print('sjb df2 mem: ', df2.memory_usage())
-    # print('sjb df2 len: ', len(df2))
-    sjt = time.time()
-    sjoinSeg = gpd.sjoin(df1, df2, how='inner', op='intersects')
-
-    buildingsList = list(set(list(sjoinSeg['PSID_right'])))  # make list of set of lists of PSIDs for buildings
-
-    count = 0
-    ecount = 0
-    passed_list = []
-    for building in buildingsList:
-        lowVeg = list(sjoinSeg[sjoinSeg['PSID_right'] == building][
-                          'PSID_left'])  # Ids of low veg segments touching current building
-        buildingGeo = list(df2[df2['PSID'] == building]['geometry'])[0]  # current building geometry
-
-        for lv in lowVeg:
-            count += 1
-            lvGeo = list(df1[df1['PSID'] == lv]['geometry'])[0]
-            try:
-                border = buildingGeo.intersection(lvGeo)  # get multi-line
-                blength = border.length
-                if btype == 'minimum': # if border type is minimum, only pass if greater minimum shared border length
-                    if blength > minborder: 
-                        passed_list.append(int(lv))
-                if btype == 'percent': # if border type is percent, only pass if greater than percent of total border of lvGeo
-                    if blength > (minborder*lvGeo.length):
-                        passed_list.append(int(lv))
-
-            except:
-                ecount += 1
-                pass
-            # except Exception as e:
-            #     ecount += 1
-            #     pass
-
-    del df1
-    del df2
+    Method: publish_psegs()
+    Purpose: Publish psegs geometry to the county worker runtime once. anci_overlay and adjacency_mp
+             address segments by their position in this layer, so psegs rows must not be added,
+             dropped or reordered after publishing.
+    Params: psegs - main pseg gdf (after datacheck)
+            store - geom_store.GeometryStore of psegs in the geometry-lazy mode, published as a file backed layer
+    Returns: runtime - mp_runtime.WorkerRuntime
+    """
+    runtime = mp_runtime.get_runtime(mp.cpu_count() - 1)
+    if store is not None:
+        runtime.publish_store('psegs', store)
+    else:
+        runtime.publish('psegs', psegs.geometry)
+    return runtime
 
-    return passed_list
+def write_lazy(psegs, store, outPath, outLayer, batch_size):
+    """
+    Method: write_lazy()
+    Purpose: Write psegs of the geometry-lazy mode, geometry is decoded from the store batch_size rows at a time.
+    Params: psegs - main pseg df (no geometry)
+            store - geom_store.GeometryStore, same rows as psegs
+            outPath - output gpkg
+            outLayer - output layer name
+            batch_size - max rows per write
+    Returns: N/A
+    """
+    for idx in store.chunks(batch_size):
+        out = gpd.GeoDataFrame(psegs.iloc[idx[0]:idx[-1] + 1].reset_index(drop=True), geometry=store.geoms(idx), crs=store.crs)
+        out.to_file(outPath, layer=outLayer, driver='GPKG', mode='w' if idx[0] == 0 else 'a')
 
+def write_provenance(log, psid, area, outPath):
+    """
+    Method: write_provenance()
+    Purpose: Write the rule provenance of psegs_lu (see provenance.py) as attribute tables next to it:
+             lu_rules - rule catalogue with how often and over what area each rule fired
+             lu_events - PSID, rule_id and order of every rule event
+    Params: log - provenance.EventLog of the run
+            psid - PSID of the psegs, same rows as the log
+            area - ps_area of the psegs
+            outPath - output gpkg
+    Returns: N/A
+    """
+    pyogrio.write_dataframe(log.catalogue_table(area), outPath, layer='lu_rules', driver='GPKG')
+    pyogrio.write_dataframe(log.table(psid), outPath, layer='lu_events', driver='GPKG')
 
-def sjoin_mp_pt2(args):
-    
+def psegs_positions(psegs, df):
     """
-    args: df1, df2
-    returns: passed_list - list of PSIDs from df1
+    Returns positions of df rows (a subset of psegs) in the published psegs layer.
     """
-    df1, df2 = args
-    sjt = time.time()
-    sjoinSeg = gpd.sjoin(df1, df2, how='inner', op='intersects')[['PSID']]
-    # print('spatial join time: ', round(time.time() - sjt), 'seconds')
-    passed_list = list(set(list(sjoinSeg['PSID'])))  # PSIDs from df1
-    return passed_list
+    return psegs.index.get_indexer(df.index)
 
 def apply_lu(psegs, results, newlu, newlogic):
     """
-    1. flatten list of lists generated during parallel processing
+    1. flatten list of lists of psegs positions generated during parallel processing
     2. print n results todo-build in check of this value
-    3. apply new lu and new logic to master pseg df
+    3. apply new lu to master pseg df and record newlogic as the provenance event
     4. profit
     """
-    results = sum(results, [])
+    results = np.asarray(sum(results, []), dtype=np.int64)
     print(f'----Results: {len(results)} {newlogic} segs')
-    psegs.loc[psegs['PSID'].isin(results), 'lu'] = newlu + " " + psegs['Class_name']
-    psegs.loc[psegs['PSID'].isin(results), 'logic'] = newlogic + " " + psegs['Class_name']
+    classes = psegs['Class_name'].array[results]
+    lu_codes.assign(psegs, results, 'lu', lu_codes.with_class(newlu, classes))
+    provenance.record(results, newlogic, with_class=True)
+
 
+def anci_overlay(cf, psegs, runtime, anci_folder, anci_dict, batch_size):
+    """
+    Method: anci_overlay()
+    Purpose: Overlay psegs with every vector layer of anci_dict in one pass. All layers are read for the county
+             (from the county partitioned anci_store when it is built), published as one combined layer and queried once per psegs chunk. The result is stored
+             in psegs['anci_bits'], bit ANCI_BITS[key] is set for psegs intersecting layer key (see anci_rule).
+             Missing or empty layers leave their bit unset.
+    Params: cf - county fips
+            psegs - main pseg gdf, same rows as the published 'psegs' layer
+            runtime - mp_runtime.WorkerRuntime with 'psegs' published
+            anci_folder - base ancillary folder
+            anci_dict - luconfig.anci_dict
+            batch_size - max psegs per task
+    Returns: N/A
+    """
+    ao_st = time.time()
+    print(f'--Start anci_overlay {time.asctime()}')
+    pb = mp_runtime.layer_bounds(runtime.layers['psegs'])
+    bounds = gpd.GeoSeries([shapely.box(*pb[:, :2].min(axis=0), *pb[:, 2:].max(axis=0))], crs="epsg:5070") # county extent (crs checked in datacheck)
+    del pb
+    geoms, feature_bits = [], []
+    for key, bit in ANCI_BITS.items():
+        ancipath = Path(anci_folder, anci_dict[key])
+        if not os.path.exists(os.path.dirname(ancipath) if '.gdb' in str(ancipath).lower() else ancipath):
+            print(f'----Anci ({key}) not found, skipping layer: {ancipath}')
+            continue
+        anci = anci_store.read_layer(anci_folder, key, anci_dict[key], cf, bounds)
+        print(f'----{key}: {len(anci)} features')
+        if len(anci) > 0:
+            geoms.append(anci.geometry.values)
+            feature_bits.append(np.full(len(anci), 1 << bit, dtype=np.uint16))
+
+    anci_bits = np.zeros(len(psegs), dtype=np.uint16)
+    if len(geoms) > 0:
+        anci_layer = runtime.publish('anci', np.concatenate(geoms))
+        feature_bits = np.concatenate(feature_bits)
+        chunk_iterator = []
+        for chunk in runtime.chunks(np.arange(len(psegs)), batch_size):
+            chunk_iterator.append((runtime.layers['psegs'], chunk, anci_layer, feature_bits))
+        for idx, bits in runtime.map(anci_overlay_pt2, chunk_iterator):
+            anci_bits[idx] = bits
+        runtime.release('anci')
+    psegs['anci_bits'] = anci_bits
+    etime(cf, psegs, 'anci overlay', ao_st)
+
+def anci_mask(psegs, key):
+    """
+    Returns bool array of psegs intersecting the ancillary layer key (from anci_overlay).
+    """
+    return (psegs['anci_bits'].values & (1 << ANCI_BITS[key])) != 0
 
-def sjoin_mp(psegs, newlu, newlogic, df1, anci_folder, ancipath, batch_size):
+def anci_rule(psegs, newlu, newlogic, df1, key):
     """
     :param newlu: str of lu class to be assigned
     :param newlogic: str of explanation of logic
-    :param dfq1: query for df1 (more polygons)
-    :param ancipath: path to ancillary data including filename and extensions
-    :param batch_size:  max rows per process
-    :return:s
+    :param df1: subset of psegs to test against the ancillary data
+    :param key: luconfig.anci_dict key of the ancillary layer (overlaid by anci_overlay)
+    :return:
     """
 
     if type(newlogic) != str:
@@ -336,322 +297,210 @@ def sjoin_mp(psegs, newlu, newlogic, df1, anci_folder, ancipath, batch_size):
         raise TypeError(f'Logic must be string! "logic" is currently {type(newlogic)}')
         # sys.exit()
 
-    print(f'--Start sjoin_mp for {newlu}, {newlogic}\n----Anci: {os.path.basename(ancipath)}')
-
-    anci = read_anci(anci_folder,ancipath, psegs.envelope) 
-
-    if anci.empty:
-        print(f'----Anci ({os.path.basename(ancipath)}) is empty, skipping step') 
-
-    else:
-        # try:
-        df1, num_chunks = sub_df_and_chunk2(df1, batch_size)
-        print(f"----df1 len: {len(df1)} anci len: {len(anci)}")
-
-        cpus_minus_1 = mp.cpu_count() - 1
-        # print(f'Utilizing {cpus_minus_1} out of {mp.cpu_count()} cores')
-        pool = mp.Pool(processes=cpus_minus_1)
-
-        chunk_iterator = []
-        for i in range(0, num_chunks):
-            mn, mx = i * batch_size, (i + 1) * batch_size
-            gdf_args = df1[mn:mx], anci
-            chunk_iterator.append(gdf_args)
-
-        sj_results = pool.map(sjoin_mp_pt2, chunk_iterator)
-        pool.close()
-        apply_lu(psegs, sj_results, newlu, newlogic)
-
-        # except AssertionError:
-        #     _, _, tb = sys.exc_info()
-        #     traceback.print_tb(tb) # Fixed format
-        #     tb_info = traceback.extract_tb(tb)
-        #     filename, line, func, text = tb_info[-1]
-        #     print('An error occurred on line {} in statement {}'.format(line, text))
-            # exit(1)
+    print(f'--Start anci_rule for {newlu}, {newlogic}\n----Anci: {key}')
+    df1_mask = np.zeros(len(psegs), dtype=bool)
+    df1_mask[psegs_positions(psegs, df1)] = True
+    passed = df1_mask & anci_mask(psegs, key)
+    print(f"----df1 len: {len(df1)} intersecting anci: {passed.sum()}")
+    apply_lu(psegs, [np.flatnonzero(passed).tolist()], newlu, newlogic)
 
 def adjacency_mp(psegs, newlu, newlogic, df1, df2, btype, minborder, batch_size):
     """
     :param newlu: str of lu class to be assigned
     :param newlogic: str of explanation of logic
-    :param dfq1: query for df1 (more polygons)
-    :param dfq2: query for df2 (less polygons)
+    :param df1: subset of psegs to classify (more polygons)
+    :param df2: subset of psegs df1 must border (less polygons)
     :param minborder:  minimum shared border between df1 and df2
     :param batch_size:  max rows per process
     :return:
     """
     
-    df1, df2, num_chunks = sub_df_and_chunk(df1, df2, batch_size)
     print(f"--Start adjacency_mp() for '{newlu}' {time.asctime()}")
     print(f'----Border type: {btype}, Minimum: {minborder}')
     print(f'----Batch_size: {batch_size} df1 len: {len(df1)} df2 len: {len(df2)}')
+    if len(df1) == 0:
+        print('df1 is empty')
+    if len(df2) == 0:
+        print('df2 is empty')
 
-    cpus_minus_1 = mp.cpu_count() - 1
-    pool = mp.Pool(processes=cpus_minus_1)
+    runtime = mp_runtime.get_runtime()
+    df2_mask = np.zeros(len(psegs), dtype=bool)
+    df2_mask[psegs_positions(psegs, df2)] = True
+    df2_mask = runtime.share_array('adjacency_df2', df2_mask)
 
     chunk_iterator = []
-    for i in range(0, num_chunks):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        chunk_num = i
-        gdf_args = df1[mn:mx], df2, btype, minborder, chunk_num
-        chunk_iterator.append(gdf_args)
-
-    bordering_results = pool.map(sjoin_and_border, chunk_iterator)
-    pool.close()
-    apply_lu(psegs, bordering_results, newlu, newlogic)
+    for chunk in runtime.chunks(psegs_positions(psegs, df1), batch_size):
+        chunk_iterator.append((runtime.layers['psegs'], chunk, df2_mask, btype, minborder))
 
-def ruleset1(cf, psegs):
-
-    folder = luconfig.folder
-    print(f'--Start ruleset1() {time.asctime()}')
-    rs1_st = time.time()
-    # direct LC to LU classes
-    psegs.loc[(psegs.Class_name.isin(['Water','Buildings','Other Impervious Surfaces','Roads','Tree Canopy','Emergent Wetlands'])), 'logic'] = 'landcover'
-    psegs.loc[(psegs.Class_name.isin(['Water','Buildings','Other Impervious Surfaces','Roads','Tree Canopy','Emergent Wetlands'])), 'lu'] = psegs['Class_name']
-
-    # Turf: occupied parcel - parcel area <= 4046 - 93sqm # todo this may be interfering with the TCT ruleset
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area <= 4046) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) >= 93), 'logic'] = "Occupied parcel turf"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area <= 4046) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) >= 93), 'lu'] = "Turf Herbaceous"
-
-    # Barren: occupied parcel - parcel area <= 4046 - 93sqm 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Barren') & (psegs.p_area <= 4046) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) >= 93), 'logic'] = "Occupied parcel barren"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Barren') & (psegs.p_area <= 4046) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) >= 93), 'lu'] = "Developed Barren"
+    bordering_results = runtime.map(sjoin_and_border, chunk_iterator)
+    runtime.release('adjacency_df2')
+    apply_lu(psegs, bordering_results, newlu, newlogic)
 
-    etime(cf, psegs, 'Ruleset 1', rs1_st)
+def adjacency_graph(psegs, graph, newlu, newlogic, df1, df2, btype, minborder):
+    """
+    Method: adjacency_graph()
+    Purpose: Classify df1 psegs that border df2 psegs using the county adjacency graph, same rule as adjacency_mp
+             without the spatial join and border intersections.
+    Params: graph - adjacency.PsegGraph built from psegs
+            newlu - str of lu class to be assigned
+            newlogic - str of explanation of logic
+            df1 - subset of psegs to classify
+            df2 - subset of psegs df1 must border
+            btype - 'minimum' or 'percent'
+            minborder - minimum shared border between df1 and df2
+    Returns: N/A
+    """
+    print(f"--Start adjacency_graph() for '{newlu}' {time.asctime()}")
+    print(f'----Border type: {btype}, Minimum: {minborder}')
+    print(f'----df1 len: {len(df1)} df2 len: {len(df2)}')
+    df1_mask = np.zeros(len(psegs), dtype=bool)
+    df1_mask[psegs_positions(psegs, df1)] = True
+    df2_mask = np.zeros(len(psegs), dtype=bool)
+    df2_mask[psegs_positions(psegs, df2)] = True
+    passed = adjacency.graph_adjacency(graph, df1_mask, df2_mask, btype, minborder)
+    apply_lu(psegs, [np.flatnonzero(passed).tolist()], newlu, newlogic)
+
+def region_grow(psegs, graph, newlu, newlogic, df1, df2, btype, minborder, max_hops):
+    """
+    Method: region_grow()
+    Purpose: Spread newlu from df2 psegs over bordering df1 psegs for up to max_hops hops (adjacency.grow_region).
+             With max_hops = 1 this is adjacency_graph.
+    Params: graph - adjacency.PsegGraph built from psegs
+            newlu - str of lu class to be assigned
+            newlogic - str of explanation of logic
+            df1 - subset of psegs that can be labelled
+            df2 - seed psegs
+            btype - 'minimum' or 'percent'
+            minborder - minimum shared border of each hop
+            max_hops - hop limit (luconfig.lu_grow_hops)
+    Returns: N/A
+    """
+    print(f"--Start region_grow() for '{newlu}' {time.asctime()}")
+    print(f'----Border type: {btype}, Minimum: {minborder}, Max hops: {max_hops}')
+    print(f'----df1 len: {len(df1)} df2 len: {len(df2)}')
+    df1_mask = np.zeros(len(psegs), dtype=bool)
+    df1_mask[psegs_positions(psegs, df1)] = True
+    df2_mask = np.zeros(len(psegs), dtype=bool)
+    df2_mask[psegs_positions(psegs, df2)] = True
+    hops = adjacency.grow_region(graph, df1_mask, df2_mask, btype, minborder, max_hops)
+    apply_lu(psegs, [np.flatnonzero(hops > 0).tolist()], newlu, newlogic)
+
+def ruleset1(cf, psegs, features=None):
+    """
+    Direct LC to LU classes and occupied parcel turf/barren (lu_rules.RULESET1)
+    """
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['ruleset1'], features)
 
-def ag_cdl(cf, psegs, folder): # classify psegs lu by CDL tabulations, no spatial operations
-    print(f'--Start ag_cdl()  {time.asctime()}')
-    cdl_st = time.time()
-    
+def ag_cdl(cf, psegs, folder, features=None): # classify psegs lu by CDL tabulations, no spatial operations
+    """
+    CDL and NLCD pasture, crop and orchard/vineyard rules (lu_rules.AG_CDL)
+    """
     #TODO where matching CDL AND LUZ, fill segs with that LU
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['ag_cdl'], features)
 
-    # CDL and NCLD both say pasture.
-    # rev2 5/20 - added
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_n16_1 > psegs.s_n16_0) & (psegs.s_c18_4 > (psegs.s_c18_0 + psegs.s_c18_1 +psegs.s_c18_2 +psegs.s_c18_3)), 'logic'] = "nlcd and cdl have maj pas"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_n16_1 > psegs.s_n16_0) & (psegs.s_c18_4 > (psegs.s_c18_0 + psegs.s_c18_1 +psegs.s_c18_2 +psegs.s_c18_3)), 'lu'] = "Pasture" + " " + psegs['Class_name']
-    # rev2 5/21 - added
-    # rev2 6/2 changed to seg must be at least 50% of parcel area.
-    # try p_n16_1 when v1 data prep is complete...
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_n16_1 > psegs.p_area*0.5), 'logic'] = "p_area > 50% NLCD Pasture"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_n16_1 > psegs.p_area*0.5), 'lu'] = "Pasture" + " " + psegs['Class_name']
-
-    # Crop : CDL 2018 only
-    #rev2 6/2- added max pasture limit 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_1 > 10000) & (psegs.s_c18_4 < 10000), 'logic'] = "s_c18_1 > 10000"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_1 > 10000) & (psegs.s_c18_4 < 10000), 'lu'] = "Cropland" + " " + psegs['Class_name']
-
-    # Pasture: CDL 2018 only
-    #rev2 6/2- added max crp limit 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_4 > 10000), 'logic'] = "s_c18_4 > 10000"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_4 > 10000), 'lu'] = "Pasture" + " " + psegs['Class_name']
-
-    # Orchard/Vineyard : CDL 2018 only
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_3 > (psegs.s_area*0.2)), 'logic'] = "s_c18_3 > 20%"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area > 4046*5) & (psegs.s_c18_3 > (psegs.s_area*0.2)), 'lu'] = "Orchard/Vineyard" + " " + psegs['Class_name']
-
-    etime(cf, psegs,  'ag_cdl', cdl_st)
-
-def p_maj_lu(cf, psegs, lc_vals, exclusions, threshold, batch_size, maj_replace):
+def p_maj_lu(cf, psegs, lc_vals, exclusions, threshold, maj_replace):
     """
     args:
         psegs : main pseg gdf
         lc_vals : list of Class_names to be included in area count step
         exclusions : list of LU values to be excluded from PID list, relevant for maj_replace flag
         threshold : pct of parcel coverage required to classify (only includes area covered by lc_vals )
-        batch_size : ps chunk size
         maj_replace : reclass existing LUs for lc_vals to majority in parcel minus lu exclusions
+
+    Area of every (parcel, lu) pair is summed in one grouped pass over the lu codes and PIDs. Ties between lu
+    values go to the lu seen first in psegs order. The parcel total is the ps_area of its lc_vals segments.
+    Psegs without a parcel (PID 0) are each a parcel of their own (see lu_tiles.parcel_index).
     """
     mlu_st = time.time()
+    lc_mask = psegs['Class_name'].isin(lc_vals).values
+    lu = psegs['lu'].array
+    codes = np.asarray(lu.codes)
+    lu_na = codes < 0
+    cats = np.array(list(lu.categories) + [None], dtype=object) # missing lu (code -1) takes the last slot
+    excluded = pd.Series(cats).isin(exclusions).values[codes]
+    ag_gen = (cats == 'ag_gen')[codes]
+    pid = psegs['PID'].values.astype(np.int64)
+    pid = np.where(pid == 0, -1 - np.arange(len(pid)), pid) # no parcel, one group per pseg
+
     # get list of unique PID values that meet criteria
-    # 
     if maj_replace:
-        pids = list(set(list(psegs[ (psegs.Class_name.isin(lc_vals)) & (~psegs.lu.isin(exclusions))]['PID'])))
+        sel = lc_mask & ~excluded
     else:
-        pids = list(set(list(psegs[( (psegs.lu.isna()) | (psegs.lu.str.contains("ag_gen"))) & (psegs.Class_name.isin(lc_vals) & (~psegs.lu.isin(exclusions)))]['PID'])))
-
-    # make temp df within parcels that have no lu 
-    no_lu_df = psegs[(psegs['PID'].isin(pids)) & (psegs.Class_name.isin(lc_vals))][['PID', 'lu', 'ps_area','geometry']]
-    # sum by parcel/lu
-    lu_areas_list = [] #list of dfs with PID/lu area estimates
-    lu_values = list(set(list(no_lu_df['lu']))) # unique land use values
-
-    if len(lu_values) > 0:
-        lu_values.remove(None)
-        if 'ag_gen' in lu_values:
-            lu_values.remove('ag_gen')
-            print(f'removing ag_gen from useable lu_values')
-            
-        for lu in lu_values:
-            tmp = no_lu_df[no_lu_df['lu'] == lu][['PID', 'ps_area']].groupby(['PID']).sum() # group by PID for specified land use and sum area
-            tmp = tmp.reset_index() # bring PID back as column
-            tmp.rename(columns={'ps_area':lu}, inplace=True) # rename total area column to be lu 
-            lu_areas_list.append(tmp)
-
-        # print("lu_areas_list: ", lu_areas_list)
-        # merge all area estimates into one df on PID
-        lu_area_df = lu_areas_list[0].copy()
-        for l in range(1, len(lu_areas_list)): 
-            lu_area_df = lu_area_df.merge(lu_areas_list[l], on=['PID'], how='outer')
-        # get max lu name and area
-
-        lu_area_df['max_lu'] = lu_area_df[lu_values].idxmax(axis=1) # max lu name
-        lu_area_df['lu_area'] = lu_area_df[lu_values].max(axis=1) # max area value
-        # print("lu_area_df: ",lu_area_df)
-
-        #remove all uneeded results columns
-        cols = ['PID', 'max_lu', 'lu_area']
-        lu_area_df = lu_area_df[cols]
-        # add parcel area and get % area?
-        # get segments of specific classes and sum all segs of classes by PID
-        tot_class_area = psegs[psegs['Class_name'].isin(lc_vals)][['PID', 'geometry']]
-
-        if len(tot_class_area) > 6 * 1e6: # greater than 6 mil?
-            num_chunks = int((len(tot_class_area) / 1e6) + 1)
-            for i in range(0, num_chunks):
-                print(f"{i}/{num_chunks}")
-                mn, mx = i * batch_size, (i + 1) * batch_size
-                mn = int(mn)
-                mx = int(mx)
-                print(f"calculating ps_area for chunk: {i}/{num_chunks} PSID {mn} thru {mx}")
-                tot_class_area.loc[mn:mx, 'ps_area'] = tot_class_area[mn:mx].geometry.area
-        else:
-            tot_class_area['ps_area'] = tot_class_area.geometry.area
-
-        tot_class_area = tot_class_area[['PID', 'ps_area']]
-        tot_class_area = tot_class_area .groupby(['PID']).sum()
-        tot_class_area = tot_class_area.reset_index()#bring PID back as column
-        tot_class_area.rename(columns={'ps_area':'tot_area'}, inplace=True) #rename total area column
-        lu_area_df = lu_area_df.merge(tot_class_area, on=['PID'], how='left') #merge total area with seg area
-        lu_area_df.loc[:, 'PctArea'] = lu_area_df['lu_area'] / lu_area_df['tot_area']
-        lu_area_df = lu_area_df[lu_area_df['PctArea'] > threshold]
-        
-        #loop through and apply land use
-        max_lus = list(set(list(lu_area_df['max_lu']))) # unique lu values
-        print("majority lu value: ", max_lus)
-        for lu in max_lus:
-            pids = list(set(list(lu_area_df[lu_area_df['max_lu'] == lu]['PID']))) # unique parcels with current lu
-            # get unique psids with no lu and that have a maj parcel lu
-            psids = list(set(list(psegs[((psegs.lu.isna()) | (psegs.lu == 'ag_gen')) & (psegs.Class_name.isin(lc_vals)) & (psegs.PID.isin(pids))]['PSID'])))
-            psegs.loc[psegs['PSID'].isin(psids), 'lu'] = lu
-            psegs.loc[psegs['PSID'].isin(psids), 'logic'] =  'majority lu > ' + str(threshold) + " and MajRep:" + str(maj_replace) 
-        etime(cf, psegs, f'majority lu MajRep:{str(maj_replace)}', mlu_st)
-    else:
-        print(f"lu_values is empty...\n {lu_values} \n Full psegs lu:{psegs.lu.unique()}")
-
-
-def natural_succession(cf, psegs, batch_size):
+        sel = (lu_na | pd.Series(cats).str.contains("ag_gen", na=False).values[codes]) & lc_mask & ~excluded
+    in_pids = np.isin(pid, np.unique(pid[sel])) & lc_mask
+
+    # segments within those parcels that have a usable lu (ag_gen is not a useable lu value)
+    valid = in_pids & ~lu_na & ~ag_gen
+    if not valid.any():
+        print(f"lu_values is empty...\n Full psegs lu:{psegs.lu.unique()}")
+        return
+    v_codes = codes[valid]
+    uc, first = np.unique(v_codes, return_index=True)
+    lu_order = uc[np.argsort(first)] # lu order of first appearance breaks ties
+    rank = np.zeros(len(cats), dtype=np.int64)
+    rank[lu_order] = np.arange(len(lu_order))
+
+    # sum by parcel/lu in one pass
+    parcels, p_inv = np.unique(pid[valid], return_inverse=True)
+    key = p_inv.astype(np.int64) * len(cats) + rank[v_codes]
+    ukey, k_inv = np.unique(key, return_inverse=True)
+    lu_area = np.bincount(k_inv, weights=psegs['ps_area'].values[valid])
+    k_parcel, k_rank = ukey // len(cats), ukey % len(cats)
+    order = np.lexsort((k_rank, -lu_area, k_parcel)) # by parcel, area desc, lu order
+    best = order[np.r_[True, k_parcel[order][1:] != k_parcel[order][:-1]]] # first row of every parcel
+    max_code = lu_order[k_rank[best]] # every parcel has a usable lu, best is in parcel order
+    max_area = lu_area[best]
+
+    # parcel area covered by lc_vals
+    lc_pid = pid[lc_mask]
+    in_parcels = np.isin(lc_pid, parcels)
+    tot_area = np.bincount(np.searchsorted(parcels, lc_pid[in_parcels]), weights=psegs['ps_area'].values[lc_mask][in_parcels], minlength=len(parcels))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        keep = (max_area / tot_area) > threshold
+
+    #apply land use through the PID index
+    print("majority lu value: ", list(cats[np.unique(max_code[keep])]))
+    maj_code = np.full(len(parcels), -1, dtype=np.int64)
+    maj_code[keep] = max_code[keep]
+    pos = np.searchsorted(parcels, pid)
+    pos[pos >= len(parcels)] = 0
+    parcel_code = np.where(parcels[pos] == pid, maj_code[pos], -1)
+    rows = np.flatnonzero((lu_na | ag_gen) & lc_mask & (parcel_code >= 0))
+    lu_codes.assign(psegs, rows, 'lu', cats[parcel_code[rows]])
+    provenance.record(rows, 'majority lu > ' + str(threshold) + " and MajRep:" + str(maj_replace))
+    etime(cf, psegs, f'majority lu MajRep:{str(maj_replace)}', mlu_st)
+
+
+def natural_succession(cf, psegs, graph, features=None):
 
     # Segmentation perferation statistics/ratios
     # Segment density per parcel area
     # poly count : p_area
     # total border length : p_area
 
-    # Large proportion of TC in parcel and small vegetation
-    # rev2 5/21 - changed lc3/p_area from 70% to 45%
-    
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_area < 1000) & (psegs.s_luz != "TG") & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & ((psegs.p_lc_3 > (psegs.p_area * 0.45))), 'logic'] = r"70% TC parcel,  s_area < 1000"
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_area < 1000) & (psegs.s_luz != "TG") &  (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & ((psegs.p_lc_3 > (psegs.p_area * 0.45))), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
-
-    # Any parcel with scrub/shrub and no roads or structures, SS is natural succession
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_area < 1000) & (psegs.s_luz != "TG") &  (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) < 93) & (psegs.p_c18_0 > (psegs.p_area*0.85)), 'logic'] = "Nat Sus, c18_0*0.85  93m2 of road or building"
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_area < 1000) & (psegs.s_luz != "TG") &  (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & ((psegs.p_lc_7 + psegs.p_lc_8 + psegs.p_lc_9 + psegs.p_lc_10 + psegs.p_lc_11 + psegs.p_lc_12) < 93) & (psegs.p_c18_0 > (psegs.p_area*0.85)), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
-                                                                                                                    
-    # If parcel is over 1 acre, is 70%+ TC andand is has <50% p_c18 coverage, 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & (psegs.s_luz != "TG") &  (psegs.p_area > 4046) & (psegs.s_area < 150) & (psegs.p_lc_3 > (psegs.p_area * 0.7)) & (psegs.p_c18_0 > (psegs.p_area*0.7)), 'logic'] = "nat 70% tc 150m2"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])) & (psegs.s_luz != "TG") &  (psegs.p_area > 4046) & (psegs.s_area < 150) & (psegs.p_lc_3 > (psegs.p_area * 0.7)) & (psegs.p_c18_0 > (psegs.p_area*0.7)), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
-    
+    # Large proportion of TC in parcel and small vegetation, no roads or structures, 70% TC (lu_rules.NATURAL_SUCCESSION)
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['natural_succession'], features)
 
     # If no LU, segment is LV, Barren, and parcel is > 1 acre and touches tree canopy with an s_area > 5000 
     # TODO Separate LV and SS logic. Set size thresh for LV adjacency_mp tool...
     nat_adj_st = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub'])) & (psegs.p_area > 4046) & (psegs.s_area <= 5000) & (psegs.s_luz != "TG") ]
     df2 = psegs[(psegs.Class_name == 'Tree Canopy') & (psegs.s_area >= 10000) & (psegs.p_area > 4046)]
-    adjacency_mp(psegs, 'Natural Succession', 'Nat Big TC adj 1', df1, df2, 'percent', 0.7 , batch_size)
+    adjacency_graph(psegs, graph, 'Natural Succession', 'Nat Big TC adj 1', df1, df2, 'percent', 0.7)
     etime(cf, psegs,  "Natural Sucession adjacent 1/3 (LV, B)", nat_adj_st)
 
     nat_adj2_st = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Scrub\\Shrub'])) & (psegs.p_area > 4046)&  (psegs.s_luz != "TG") ]
     df2 = psegs[(psegs.Class_name == 'Tree Canopy') & (psegs.s_area >= 10000) & (psegs.p_area > 4046)]
-    adjacency_mp(psegs, 'Natural Succession', 'Nat Big TC adj 2', df1, df2, 'minimum', 0, batch_size)
+    adjacency_graph(psegs, graph, 'Natural Succession', 'Nat Big TC adj 2', df1, df2, 'minimum', 0)
     etime(cf, psegs,  "Natural Sucession adjacent 2/3 (SS)", nat_adj2_st)
 
-def luz(cf, psegs):
-    # revised 4/20/21 to not reclass buildings in CAFO, CATT, and POUL 
-    # rev2 5/20 - added p_area thresh for tg changed s_luz to p_luz for TURF
+def luz(cf, psegs, features=None):
+    """
+    Reclass by segment and parcel LUZ values (lu_rules.LUZ)
+    """
     # TODO - revisit to help with ag classing
-    print(f'--Start LUZ() {time.asctime()}')
-    luz_st = time.time()
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])) & (psegs.p_luz == 'TG') & (psegs.p_area < 4046) , 'logic'] = "luz 'TG' maj <1ac" 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])) & (psegs.p_luz == 'TG') & (psegs.p_area < 4046) , 'lu'] = "Turf Herbaceous"
-    
-    # LUZ_values = ('AG_GEN', 'BAR', 'CAFO', 'CATT', 'CENT', 'CONS', 'CROP', 'DEC', 'EVE', 'EXT', 'FALL', 'NAT', 'OV', 'PAS', 'POUL', 'SUS',
-    # 'TG', 'TIM', 'WAT', 'WET', 'WET_NT', 'WET_T', 'no_luz')
-
-    # LUZ where schrub shrub should be reclassed
-    # rev2 5/20 - fixed pseg subsetting to only include SS, was including LV (whoops!)
-    SS_LUZ_valuse = ('NAT', 'OV','SUS','CAFO', 'CATT','TIM')
-    for luz in SS_LUZ_valuse:
-        if luz == 'SUS':
-            lu_name = 'Suspended Succession'
-        elif luz == 'NAT':
-            lu_name = 'Natural Succession'
-        elif luz == 'TIM':
-            lu_name = 'Natural'
-        elif luz in ('OV'): # rev2 6/1- removed CROP
-            lu_name = 'Orchard/Vineyard'
-        elif luz in ('CAFO', 'CATT'):
-            lu_name = 'Pasture'
-        else:
-            lu_name = luz
-        
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Scrub\\Shrub'])) & (psegs.s_luz == luz) , 'logic'] = f"ss s_luz {luz} maj"
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Scrub\\Shrub'])) & (psegs.s_luz == luz) , 'lu'] = lu_name + " " + psegs['Class_name']
-
-    del luz
-    del lu_name
-
-    # LUZ where low veg and barren should be reclassed excluding crop and pasture
-    LVB_LUZ_values = ('CAFO', 'CATT', 'CENT', 'EXT', 'FALL', 'NAT', 'OV', 'SUS', 'TIM')
-    for luz in LVB_LUZ_values:
-        if luz in ( 'SUS', 'FALL'):
-            lu_name = 'Suspended Succession'
-        elif luz in ('NAT', 'EXT'): # added EXT for rev2 from suspended to natural
-            lu_name = 'Natural Succession'
-        elif luz == 'TIM':
-            lu_name = 'Natural Succession'
-        elif luz in ('CAFO', 'CATT'):
-            lu_name = 'Pasture'
-        elif luz == 'OV':
-            lu_name = 'Orchard/Vineyard'
-        elif luz in ('AG_GEN', 'CENT'):
-            lu_name = 'Cropland'
-        else:
-            lu_name = luz
-        # rev2 6/2 - removed SS
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.s_luz == luz) , 'logic'] = f"lvb s_luz {luz} maj"
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.s_luz == luz) , 'lu'] = lu_name + " " + psegs['Class_name']
-        del luz
-        del lu_name
-
-    # Pasture and Crop specific rules for LUZ
-    # rev2 6/2 - removed Crop and Pasture from other loop and build more thresholds
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.p_area > 4046*5 ) & (psegs.s_luz == 'PAS') & (psegs.s_luz == psegs.p_luz ) & (psegs.p_c18_4 > psegs.p_c18_1), 'logic'] = f"s_luz PAS, no cdl conflict, 5ac+"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.p_area > 4046*5 ) & (psegs.s_luz == 'PAS') & (psegs.s_luz == psegs.p_luz ) & (psegs.p_c18_4 > psegs.p_c18_1) , 'lu'] = "Pasture " + psegs['Class_name']
-
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.p_area > 4046*5 ) & (psegs.s_luz == 'CROP') & (psegs.s_luz == psegs.p_luz ) & (psegs.p_c18_4 < psegs.p_c18_1), 'logic'] = f"s_luz CROP, no cdl conflict, 5ac+"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren'])) & (psegs.p_area > 4046*5 ) & (psegs.s_luz == 'CROP') & (psegs.s_luz == psegs.p_luz ) & (psegs.p_c18_4 < psegs.p_c18_1) , 'lu'] = "Cropland " + psegs['Class_name']
-
-    # Extractive  
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin([['Other Impervious Surfaces', 'Barren']])) & (psegs.s_luz == 'EXT') , 'logic'] = 'Other imp and barren EXT luz'
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin([['Other Impervious Surfaces', 'Barren']])) & (psegs.s_luz == 'EXT') , 'logic'] = 'Suspended Succession' + psegs['Class_name']
-
-    # LUZ where other impervious should be reclassed
-    Imp_LUZ_values = ('EXT') # removed 'CAFO', 'CATT', 'POUL' 4/28/21
-    for luz in Imp_LUZ_values:
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin([['Other Impervious Surfaces']])) & (psegs.s_luz == luz) , 'logic'] = f"s_luz {luz} maj"
-        psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin([['Other Impervious Surfaces']])) & (psegs.s_luz == luz) , 'lu'] = luz + " " + psegs['Class_name']
-
-    etime(cf, psegs,  'luz', luz_st)
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['luz'], features)
 
 
 def solar(psegs, ancipath, newlogic):
@@ -681,228 +530,204 @@ def solar(psegs, ancipath, newlogic):
 
         # TODO  parallelize
         for i in sj.SID.unique():
-            psegs.loc[psegs["SID"] == i, 'logic'] = newlogic
+            rows = (psegs["SID"] == i).values
+            provenance.record(rows, newlogic)
             myClass_name = psegs.loc[psegs['SID'] == i].Class_name.values[0]  # get seg lc value as string
-            psegs.loc[psegs["SID"] == i, 'lu'] = f"Solar {myClass_name}"
+            lu_codes.assign(psegs, rows, 'lu', f"Solar {myClass_name}")
 
     etime(cf, psegs,  "solar", solar_st)
 
 
-def lcmap_timber_mp(psegs, thlu, thlogic, nslu, nslogic, df1, anci_folder, timHarRasPath, sucAgeRasPath, batch_size):
+def lcmap_timber_mp(cf, psegs, thlu, thlogic, nslu, nslogic, df1, anci_folder, timHarRasPath, sucAgeRasPath, block_size):
     """
     Method: lcmap_timber_mp()
-    Purpose: Chunk up remaining low veg and barren psegs to be multiprocessed through lcmap timber harvest
-             and natural succession workflow. Calls apply_lu to add lu and logic to segments found in workflow.
-    Params: thlu - str of lu class to be assigned to timber harvest clearing segments
+    Purpose: LCMAP timber harvest and natural succession workflow on zone rasters. The remaining low veg and barren
+             psegs are burned once as zones on the native grid of each LCMAP raster (per block, on the worker runtime)
+             and harvest and succession age are reduced for all psegs together. Same rules as the old per segment masks:
+                harvest - timber harvest (4) in the segment and timber harvest + deforestation (2) >= 10% of its pixels
+                succession age - majority age of a harvested segment, <= 5 is timber harvest clearing otherwise natural succession
+             Calls apply_lu to add lu and record logic for segments found in workflow.
+    Params: cf - county fips, the LCMAP rasters are read from their county clips if prepared (ras_store.py)
+            thlu - str of lu class to be assigned to timber harvest clearing segments
             thlogic - str of explanation of logic for timber harvest segments
             nslu - str of lu class to be assigned to natural succession due to timber harvest clearing segments
             nslogic - str of explanation of logic for natural succession due to timber harvest clearing segments
-            dfq1 - query for df1 (find low veg and barren segs that do not have a lu)
+            df1 - low veg and barren segs that do not have a lu
             timHarRasPath - lcmap primary patterns raster with timber harvest class
             sucAgeRasPath - lcmap succession age raster
-            batch_size - max rows per process
+            block_size - max rows/cols of a raster block per task
     returns: N/A
     """
 
-    timHarRasPath = Path(anci_folder, timHarRasPath)
-    sucAgeRasPath = Path(anci_folder, sucAgeRasPath)
-
-    print('--Start timber harvest MP')
-
-    df1, num_chunks = sub_df_and_chunk2(df1, batch_size) 
-    cols = list(df1)
-    df1 = df1.reset_index()
-    df1 = df1[cols]
-    cpus_minus_1 = mp.cpu_count() - 1
-    pool = mp.Pool(processes=cpus_minus_1)
-    chunk_iterator = []
-    for i in range(num_chunks):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        gdf_args = df1[mn:mx], timHarRasPath, sucAgeRasPath
-        chunk_iterator.append(gdf_args)
-    th_results, ns_results = [], []
-    for th_result, ns_result in pool.map(runTH, chunk_iterator): 
-        th_results.append(th_result)
-        ns_results.append(ns_result)
-    pool.close()
-    apply_lu(psegs, th_results, thlu, thlogic)
-    apply_lu(psegs, ns_results, nslu, nslogic)
-    
-def runTH(args):
-    """
-    Method: runTH()
-    Purpose: Call function to find timber harvest clearing and natural succession segments due to clearing.
-    Params: segments - psegs gdf
-            timHarRasPath - lcmap primary patterns raster; contains timber harvest and deforestation classes
-            sucAgeRasPath - lcmap succession age raster; contains # of years a pixel has been low veg (grass + crop)
-    Returns: th_list - list of PSIDs that contained timber harvest
-             ns_list - list of PSIDs that contained nat succession
-    Note: Do I need to calc succession age for all non-classes low veg segments? if not, nest within timber harvest
-        method. Since we are not capping natural succession by age, we only need age to differentiate between 
-        timber harvest clearing and natural succession. if the age data is not used anywhere else, only get age
-        if timber harvest is detected."""
-    segments, timHarRasPath, sucAgeRasPath = args
-    th_list = [] # will store all PSID of timber harvest segments
-    ns_list = [] # will store all PSID of timber harvest prior to 2015 (natural succession)
-    with rio.open(timHarRasPath) as th:
-        with rio.open(sucAgeRasPath) as ns:
-            for index, feature in segments.iterrows(): #exclude newly added natural succession
-                isHarv = timberHarvest(th, feature) #get timber harvest
-                if isHarv != 0: # 0 if not tim harv, otherwise PSID
-                    a = getSucAge(ns, feature) #get maj succession age
-                    #play with a > 0 - may not be detected yet in LCMAP - does it make a difference to only test a <= 3?
-                    #To include 0 below - most update getSucAge by commenting out: tmpAge = tmpAge[tmpAge != 0]
-                    if a <= 5: # rev2 6/1 - changed a <= 3 to a<=5
-                        th_list.append(isHarv)
-                    else: #harvested before 2015 - natural succession
-                        ns_list.append(isHarv)
-    return th_list, ns_list
-
-def timberHarvest(ras, feature):
-    """
-    Method: timberHarvest()
-    Purpose: Mask lcmap timber harvest raster by current segment and return its PSID if there is timber harvset within the segment and
-             at least 10% of the 10m cells in the segment are timber harvest and deforestation.
-    Params: ras - rasterio object of LCMAP primary patterns (class 4 in timb harv with not tree cover, 2 is deforestation)
-            feature - one row of a the psegs geodataframe
-    Returns: PSID of segment if passes timber harvest threshold, 0 otherwise
-    """
-
-    p = feature['PSID']  # SID OR PSID?
-    tmp, t = rio.mask.mask(ras, [feature['geometry']], crop=True, all_touched=False, nodata=100) #raster array where pixel centroids are within segment
-    totalArea = (tmp < 100).sum()
-    tmp = tmp[tmp != 0] # remove all 0 pixels
-    tmp = tmp[tmp != 100] # remove all 100 pixels (pattern not classified)
-    if 4 in tmp: # Check if timber harvest is detected
-        pctFull = ((tmp == 2).sum() + (tmp == 4).sum()) / totalArea #total count of timb harv and deforestation divided by total count in segment
-        if pctFull >= 0.1: # if timb harv exists and is at least 10% of pixels are timb harv/deforestation
-            return p # return PSID
-        else:
-            return 0
+    print('--Start timber harvest zones')
+    if df1.empty:
+        print('df1 is empty')
+        return
+    if 'lcmap_harvest' in psegs.columns: # computed before the tiled rule chain (run_tiled)
+        harvest, age = psegs['lcmap_harvest'].values, psegs['lcmap_age'].values
     else:
-        return 0
+        harvest, age = lcmap_stats(cf, psegs, df1, anci_folder, timHarRasPath, sucAgeRasPath, block_size)
+    positions = psegs_positions(psegs, df1)
+    harvested = positions[harvest[positions]]
+    th = harvested[age[harvested] <= 5] # rev2 6/1 - changed a <= 3 to a<=5
+    ns = harvested[age[harvested] > 5] # harvested before 2015 - natural succession
+    apply_lu(psegs, [th.tolist()], thlu, thlogic)
+    apply_lu(psegs, [ns.tolist()], nslu, nslogic)
+
+def lcmap_stats(cf, psegs, df1, anci_folder, timHarRasPath, sucAgeRasPath, block_size):
+    """
+    Method: lcmap_stats()
+    Purpose: Timber harvest and succession age of df1 psegs from the LCMAP rasters (see lcmap_timber_mp).
+             Psegs do not overlap, so the result of a pseg does not depend on the other candidates.
+    Params: cf - county fips
+            df1 - psegs to test
+            timHarRasPath - lcmap primary patterns raster with timber harvest class
+            sucAgeRasPath - lcmap succession age raster
+            block_size - max rows/cols of a raster block per task
+    Returns: (harvest, age) - arrays over psegs, harvest is True for harvested df1 psegs and age is the majority
+             succession age of harvested psegs (0 elsewhere)
+    """
+    timHarRasPath = ras_store.resolve(Path(anci_folder, timHarRasPath), cf)
+    sucAgeRasPath = ras_store.resolve(Path(anci_folder, sucAgeRasPath), cf)
+    harvest = np.zeros(len(psegs), dtype=bool)
+    age = np.zeros(len(psegs), dtype=np.int64)
+    if df1.empty:
+        return harvest, age
+    runtime = mp_runtime.get_runtime()
+    positions = psegs_positions(psegs, df1)
+    geoms = mp_runtime.decode_geoms(runtime.layers['psegs'], positions) # from the published layer, psegs may not hold geometry
+
+    # harvest for every candidate
+    pix, total, c2, c4 = lcmap_zone_stats(runtime, positions, geoms, timHarRasPath, 'harvest', block_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harvested = (c4 > 0) & ((c2 + c4) / total >= 0.1)
+    harvested = np.flatnonzero(harvested[1:])
+
+    # succession age only for harvested segments
+    harvest[positions[harvested]] = True
+    age[positions[harvested]] = lcmap_zone_stats(runtime, positions[harvested], geoms[harvested], sucAgeRasPath, 'age', block_size)[1:]
+    return harvest, age
+
+def lcmap_zone_stats(runtime, positions, geoms, ras_path, stat, block_size):
+    """
+    Method: lcmap_zone_stats()
+    Purpose: Run lcmap_block_task over the raster blocks covering geoms and combine the blocks. Zone i + 1 is geoms[i].
+             Segments without a pixel center (smaller than a pixel) get the pixel under a point on their surface
+             if luconfig.lcmap_centroid_fallback is set, otherwise no pixels as with rio.mask.mask.
+    Params: runtime - mp_runtime.WorkerRuntime with 'psegs' published
+            positions - psegs positions of geoms
+            geoms - candidate pseg geometries
+            ras_path - LCMAP raster
+            stat - 'harvest' or 'age'
+            block_size - max rows/cols of a raster block per task
+    Returns: harvest - (pixels, total, c2, c4) arrays indexed by zone
+             age - majority succession age indexed by zone
+    """
+    n = len(geoms)
+    pix, total, c2, c4 = [np.zeros(n + 1, dtype=np.int64) for i in range(4)]
+    age_parts = []
+    if n > 0:
+        with rio.open(ras_path) as src:
+            windows = zone_raster.block_windows(src, shapely.total_bounds(geoms), block_size)
+            boxes = zone_raster.window_boxes(src, windows)
+        blk, cand = shapely.STRtree(geoms).query(boxes, predicate='intersects')
+        order = np.argsort(blk, kind='stable')
+        blk, cand = blk[order], cand[order]
+        chunk_iterator = []
+        uniq, starts = np.unique(blk, return_index=True)
+        for b, cands in zip(uniq, np.split(cand, starts[1:])):
+            chunk_iterator.append((runtime.layers['psegs'], positions[cands], cands + 1, str(ras_path), windows[b], stat))
+        print(f'----{os.path.basename(ras_path)}: {n} segments in {len(chunk_iterator)} blocks')
+
+        for result in runtime.map(lcmap_block_task, chunk_iterator):
+            if stat == 'harvest':
+                z = result[0]
+                for ary, part in zip((pix, total, c2, c4), result[1:]):
+                    np.add.at(ary, z, part)
+            else:
+                age_parts.append(result)
 
-def getSucAge(ageRas, feature):
+        if luconfig.lcmap_centroid_fallback:
+            if stat == 'harvest':
+                small = np.flatnonzero(pix[1:] == 0) + 1
+            else:
+                counted = np.zeros(n + 1, dtype=bool)
+                for z, v, c in age_parts:
+                    counted[z] = True
+                small = np.flatnonzero(~counted[1:]) + 1
+            if len(small) > 0:
+                print(f'----{len(small)} segments smaller than a pixel, using the pixel under a surface point')
+                pts = shapely.point_on_surface(geoms[small - 1])
+                with rio.open(ras_path) as src:
+                    v = np.array([x[0] for x in src.sample(zip(shapely.get_x(pts), shapely.get_y(pts)))])
+                if stat == 'harvest':
+                    for ary, part in zip((pix, total, c2, c4), harvest_counts(small, v)[1:]):
+                        np.add.at(ary, small, part)
+                else:
+                    age_parts.append(zone_raster.zone_value_counts(*succession_age_values(small, v)))
+
+    if stat == 'harvest':
+        return pix, total, c2, c4
+    if len(age_parts) == 0:
+        return np.zeros(n + 1, dtype=np.int64)
+    return zone_raster.zone_majority(n, *[np.concatenate(p) for p in zip(*age_parts)])
+
+def lcmap_block_task(args):
+    """
+    Method: lcmap_block_task()
+    Purpose: Worker for lcmap_zone_stats. Burn the candidate psegs of one raster block as zones (pixel centers,
+             like rio.mask.mask with all_touched=False) and reduce the block.
+    Params: args - psegs layer, psegs positions, zones, raster path, window, 'harvest' or 'age'
+    Returns: harvest - (zones, pixels, total, c2, c4) of the zones in the block
+             age - (zones, ages, counts) of the zone/age pairs in the block
+    """
+    layer, positions, zones, ras_path, window, stat = args
+    with rio.open(ras_path) as src:
+        values = src.read(1, window=Window(*window))
+        transform = src.window_transform(Window(*window))
+    grid = zone_raster.zone_grid(mp_runtime.layer_geoms(layer, positions), zones, values.shape, transform)
+    z, v = zone_raster.zone_values(grid, values)
+    if stat == 'harvest':
+        return harvest_counts(z, v)
+    return zone_raster.zone_value_counts(*succession_age_values(z, v))
+
+def harvest_counts(z, v):
+    """
+    Per zone pixel counts for the timber harvest rule (100 is outside the segment in the old masks):
+    pixels, total (< 100), deforestation (2) and timber harvest (4).
     """
-    Method: getSucAge()
-    Purpose: Mask succession age raster by current segment and return its majority age
-    Params: ageRas - rasterio object of "succession age" data (# of years in a row LCMAP classes the pixel as grassy/shrub)
-            feature - one row of psegs geodataframe
-    Returns: majority succession age (0 if not detected - this is ok since UVM detected low veg/barren)
+    uz, inv = np.unique(z, return_inverse=True)
+    n = len(uz)
+    return (uz, np.bincount(inv, minlength=n).astype(np.int64),
+            np.bincount(inv, weights=v < 100, minlength=n).astype(np.int64),
+            np.bincount(inv, weights=v == 2, minlength=n).astype(np.int64),
+            np.bincount(inv, weights=v == 4, minlength=n).astype(np.int64))
+
+def succession_age_values(z, v):
     """
-    tmpAge, t_age = rio.mask.mask(ageRas, [feature['geometry']], crop=True, all_touched=False, nodata=100) #raster array where pixel centroids are within segment
-    # tmpAge = tmpAge[tmpAge != 0] #remove all 0 pixels - possibly exclude this???
-    tmpAge = tmpAge[tmpAge != 100] #remove all 100 pixels 
-    tmpAge[tmpAge > 100] = tmpAge[tmpAge>100] - 100 #convert all "ages" to be between 0 and 33 (if >100 it means was developed prior)
-    if len(tmpAge) > 0:
-        vals, i = np.unique(tmpAge, return_inverse=True) #list of unique raster values whose centroid is within the segment and lsit of their count
-        if len(vals) > 0: 
-            return vals[np.argmax(np.bincount(i))]
-    return 0
+    Succession age of zone pixels: 100 removed, > 100 (developed prior) converted to be between 0 and 33.
+    """
+    v = v.astype(np.int64)
+    keep = v != 100
+    z, v = z[keep], v[keep]
+    v[v > 100] = v[v > 100] - 100
+    return z, v
 
 
 ######################################################################
-################################ MAIN ################################
+############################ RULE BLOCKS #############################
 ######################################################################
 
-def RUN(cf, test):
-
-    folder = luconfig.folder
-    destinationDir = luconfig.dest
-    anci_folder = luconfig.anci_folder
-    anci_dict = luconfig.anci_dict
-    batch_size = luconfig.batch_size
-    batch_log_Path = luconfig.batch_log_Path
-
-    cf_st = time.time()
-    print(f'\n--Start {cf}: {time.asctime()}')
-    b_log = open(batch_log_Path, "a")
-    b_log.write(f'\n--Start {cf}: {time.asctime()}')
-    b_log.close()
-
-##################################### 
-    if test:
-        print('--landuse.RUN() Test: ', test)
-        # psegsPath = r"B:/landuse/testing_subsets/psegs_sub4.gpkg" # for checking nat succession
-        # inLayer = 'psegs'
-        # make output name with iteration
-        vnums = []
-        for (root,dirs,files) in os.walk('Z:/landuse/testing_subsets/output', topdown=True):
-            for file in files:
-                vnum = int(file.split("_")[-1].split(".")[0])
-                vnums.append(vnum)
-
-        print("--Iteration number: ", max(vnums)+1)
-        outPath = f"Z:/landuse/testing_subsets/output/psegs_sub4_rev2_{max(vnums)+1}.gpkg"
-        outLayer = 'psegs_lu'
-
-    else:
-        print('--landuse.RUN() Test: ', test)
-        psegsPath = f"{folder}/{cf}/input/data.gpkg" # output will swap 'input' to 'output' and layer 'psegs_lu'
-        inLayer = 'psegs'
-        outPath = psegsPath.replace('input','output')
-        outLayer = 'psegs_lu'
-
-##################################### 
-
-    # State specific file paths
-    st_dict = luconfig.st_dict
-
-    if st_dict[cf[5:7]] == 'PA':
-        timberPath = Path(anci_folder, anci_dict['PAtimberPath'])
-    if st_dict[cf[5:7]] == 'MD':
-        timberPath = Path(anci_folder, anci_dict['MDtimberPath']) 
-
-    ###  ACTION ********************************************************
-    # try:
-    psread_st = time.time()
-    print(f"Start reading psegs {time.asctime()}")
-    print(psegsPath)
-    print(inLayer)
-    psegs = gpd.read_file(psegsPath, layer=inLayer, driver='GPKG')
-    etime(cf, psegs,  f"psegs read in", psread_st)
-    print("psegs dtypes: \n", psegs.dtypes)
-
-    # except:
-    #     print("ERROR! psegsPath failed to read...")
-    #     print(f'--psegsPath: {psegsPath}')
-    #     for layername in fiona.listlayers(psegsPath):
-    #         with fiona.open(psegsPath, layer=layername) as src:
-    #             print(f"--layer name : {layername} \n--rows: {len(src)}\n--schema: {src.schema}\n")
-    #     return -1, 'psegs failed to read'
-    #     sys.exit()
-
-    joinColumns = ['p_area', 's_area', 'p_lc_1', 'p_lc_3', 'p_lc_4', 'p_lc_5', 'p_lc_6', 'p_lc_7', 'p_lc_8', 'p_lc_9', 'p_lc_10', 'p_lc_11', 'p_lc_12',
-        's_c18_0', 'p_c18_0', 's_c1719_0', 's_n16_0', 'p_luz','s_luz']
-    jc = 0
-    for col in joinColumns:
-        if col not in psegs.columns:
-            jc += 1
-    if jc != 0:
-        print('Required join column(s) missing, trying to join data')
-        print(psegs.columns)
-        print(joinColumns)
-        psegs = psegs[['PSID', 'PID', 'SID', 'Class_name', 'geometry']]
-        psegs = joinData(cf, psegs, True) # replace remove_columns bool with column check
-
-    for col in joinColumns:
-        if col not in psegs.columns:
-            if '_lc_' in col: 
-                val = col.split('_')[-1]
-                print(f"Missing land cover class {val}; adding column of 0")
-                psegs.loc[:, col] = 0
-            else:
-                print(f"Required columns still missing.\npseg cols:{psegs.columns}\nRequired joined cols: {col}")
-                # sys.exit()
-                raise TypeError(f"Required columns still missing.\npseg cols:{psegs.columns}\nRequired joined cols: {col}")
-
-    psegs = datacheck(cf, psegs, folder)
-
-    ruleset1(cf, psegs)  # run ruleset 1 - populates lu and logic fields
+def block_turf(cf, psegs, ctx):
+    """
+    Rule block: ruleset 1, HERE turf and building turf
+    """
+    graph, features = ctx['graph'], ctx['features']
+    ruleset1(cf, psegs, features)  # run ruleset 1 - populates lu and records rule events
 
     st_here = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation')]
-    sjoin_mp(psegs, "Turf", "HERE turf subset", df1, anci_folder, anci_dict['herePath'], batch_size)
+    anci_rule(psegs, "Turf", "HERE turf subset", df1, 'herePath')
     etime(cf, psegs,  "HERE turf sjoin", st_here)
 
     # rev2 5/20 - changed from p_area to ps_area 
@@ -910,14 +735,15 @@ def RUN(cf, test):
     st_buildings = time.time()
     df1 = psegs[((psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.ps_area < 1000)) | ((psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.p_area < 4046*5) & (psegs.s_luz == "TG"))]
     df2 = psegs[(psegs.Class_name == 'Buildings')]
-    adjacency_mp(psegs, 'Turf', 'Building turf', df1, df2, 'minimum', 0, batch_size)
+    adjacency_graph(psegs, graph, 'Turf', 'Building turf', df1, df2, 'minimum', 0)
     etime(cf, psegs,   "buildings", st_buildings)
 
     # Added rev2 5/6/2021
     st_buildings2 = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name == 'Low Vegetation') & (psegs.ps_area < 1000)]
-    df2 = psegs[(psegs.Class_name == 'Low Vegetation') & (psegs.logic == 'building turf')]
-    adjacency_mp(psegs, 'Turf', 'adj to building turf', df1, df2, 'minimum', 0, batch_size)
+    # seeds are the 'Building turf' psegs of the rule above (apply_lu records it with the Class_name)
+    df2 = psegs[(psegs.Class_name == 'Low Vegetation') & (provenance.log().current() == provenance.rule_id('Building turf', with_class=True))]
+    region_grow(psegs, graph, 'Turf', 'adj to building turf', df1, df2, 'minimum', 0, luconfig.lu_grow_hops)
     etime(cf, psegs,  "buildings2", st_buildings2)
 
     # print("BUFFER TEST")
@@ -932,164 +758,409 @@ def RUN(cf, test):
     # # etime(cf, psegs,  "HERE turf sjoin", st_here)
     ###############
 
+
+def block_roads_ag_cdl(cf, psegs, ctx):
+    """
+    Rule block: road-side suspended succession and CDL/NLCD ag
+    """
+    graph, features, folder = ctx['graph'], ctx['features'], ctx['folder']
     # rev2 5/10: reordered from step ~7 to step ~5
     # rev2 5/21 - added SS and barren to dfq1 (97.28% prior to adding)
     # Rules cant include any parcel stats due to dataprep issue
     st_roads = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']) ) & (psegs.s_area < 2000) & ((psegs.s_c18_1 + psegs.s_c18_2 + psegs.s_c18_3 + psegs.s_c18_4) < (psegs.s_area*0.5))]
     df2 = psegs[(psegs.Class_name == 'Roads')]
-    adjacency_mp(psegs, 'Suspended Succession', 'roadside sus', df1, df2, 'percent', 0.25, batch_size) # switched from adjacent at all to 25% of total perimeter must intersect with road
+    adjacency_graph(psegs, graph, 'Suspended Succession', 'roadside sus', df1, df2, 'percent', 0.25) # switched from adjacent at all to 25% of total perimeter must intersect with road
     etime(cf, psegs, "Road-side Suspended Succession Adjacency", st_roads)
 
     # reference CDL and NCLD tabulations for Crp, OrVin, and Pas
-    ag_cdl(cf, psegs, folder)
+    ag_cdl(cf, psegs, folder, features)
 
+
+def block_anci_shore(cf, psegs, ctx):
+    """
+    Rule block: transmission lines, UAC, landfill, mines, shore barren and solar
+    """
+    graph = ctx['graph']
     # TODO maybe swap to shared border
     # rev2 5/10 - added 10k s_area threshold, 5/20 excluding s_luz CROP, 6/1 added overwriting natural succession LU
     st_trans = time.time()
     df1 = psegs[((psegs.lu.isna()) | (psegs.lu.str.contains("Natural Succession"))) & (~psegs.s_luz.isin(['CROP', 'PAS', 'OV'])) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']) & (psegs.s_area < 10000))]
-    sjoin_mp(psegs, "Suspended Succession", "transmission lines anci", df1, anci_folder, anci_dict['transPath'], batch_size)
+    anci_rule(psegs, "Suspended Succession", "transmission lines anci", df1, 'transPath')
     etime(cf, psegs,   "Suspended Succession - Transmission Lines lbs sjoin_mp", st_trans)
 
     bar_uac_sj = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name == 'Barren')]
-    sjoin_mp(psegs, "Developed", "Census UAC sjoin", df1, anci_folder, anci_dict['UACPath'], batch_size)
+    anci_rule(psegs, "Developed", "Census UAC sjoin", df1, 'UACPath')
     etime(cf, psegs,  "Developed Barren UAC sjoin", bar_uac_sj)
 
     # rev2 5/28 - moved up from just above lcmap timber harvest
     st_lfill = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']))]
-    sjoin_mp(psegs, "Suspended Succession", "landfill sjoin", df1, anci_folder, anci_dict['landfillPath'], batch_size)
+    anci_rule(psegs, "Suspended Succession", "landfill sjoin", df1, 'landfillPath')
     etime(cf, psegs,  "Suspended landfill sjoin_mp", st_lfill)
 
     st_mines = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']))]
-    sjoin_mp(psegs, "Natural Succession", "mines anci", df1, anci_folder, anci_dict['minePath'], batch_size)
+    anci_rule(psegs, "Natural Succession", "mines anci", df1, 'minePath')
     etime(cf, psegs,  "Mines anci sjoin", st_mines)
 
     # TODO - adjust size threshold, "shared border:total border", secondary adjacency to the first round results.
     st_bareshore = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name == 'Barren') & (psegs.s_area < 1000)]
     df2 = psegs[(psegs.Class_name == 'Water') & (psegs.s_area > 15)]
-    adjacency_mp(psegs, 'Shore', 'bar adj to wat', df1, df2, 'percent', 0.3, batch_size)
+    adjacency_graph(psegs, graph, 'Shore', 'bar adj to wat', df1, df2, 'percent', 0.3)
     etime(cf, psegs,  "Shore Barren 1", st_bareshore) 
 
     st_bareshore2 = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name == 'Barren')]
     df2 = psegs[(psegs.lu == 'Shore Barren')]
-    adjacency_mp(psegs, 'Shore', 'bar adj to shore', df1, df2, 'minimum', 0, batch_size)
+    region_grow(psegs, graph, 'Shore', 'bar adj to shore', df1, df2, 'minimum', 0, luconfig.lu_grow_hops)
     etime(cf, psegs,  "Shore Barren 2", st_bareshore2) 
 
     # TODO - possibly swap to sjoin_mp to filter psegs.
 
     st_solar = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Buildings', 'Scrub\\Shrub', 'Barren', 'Other Impervious Surfaces']))]
-    sjoin_mp(psegs, "Solar", "solar sjoin", df1, anci_folder, anci_dict['solarPath'], batch_size)
+    anci_rule(psegs, "Solar", "solar sjoin", df1, 'solarPath')
     etime(cf, psegs,  "Solar anci sjoin", st_solar)
 
-    # Map natural succession based on LC and seg size, contains TWO adjacency_mp() functions
+
+def block_natural_succession(cf, psegs, ctx):
+    """
+    Rule block: natural succession, majority lu (1 of 3) and state timber harvest
+    """
+    graph, features, st_dict, timberKey = ctx['graph'], ctx['features'], ctx['st_dict'], ctx['timberKey']
+    # Map natural succession based on LC and seg size, contains TWO adjacency_graph() rules
     # rev1 - new submodel
     # rev2 6/1 - added "if not luz TG" clauses
-    natural_succession(cf, psegs, batch_size)
+    natural_succession(cf, psegs, graph, features)
 
     maj_lc_vals = ['Low Vegetation', 'Barren', 'Scrub\\Shrub']
     maj_lu_exclusions = ['Turf Herbaceous', 'Turf Low Vegetation']
     print(f'--Start majority lu (1 of 3) including {maj_lc_vals} - {time.asctime()}')
-    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.50, int(1e6), maj_replace=False) # psegs, lc values to include, parcel area threshold (percentage as a decimal)
+    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.50, maj_replace=False) # psegs, lc values to include, parcel area threshold (percentage as a decimal)
 
     if st_dict[cf[5:7]] in ('PA', 'MD'):
         st_timb = time.time()
         df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']))]
-        sjoin_mp(psegs, "Natural Succession", "timber sjoin", df1, anci_folder, timberPath, batch_size)
+        anci_rule(psegs, "Natural Succession", "timber sjoin", df1, timberKey)
         etime(cf, psegs,   "State Timber Harvest anci sjoin", st_timb)
     else:
         print('Skipping State Timber Harvest anci sjoin, no anci for state')
 
+
+def block_lcmap(cf, psegs, ctx):
+    """
+    Rule block: LCMAP timber harvest
+    """
+    anci_folder, anci_dict = ctx['anci_folder'], ctx['anci_dict']
     # LCMAP
     th_st = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren']))]
-    lcmap_timber_mp(psegs, 'Harvested Forest', 'lcmap clearing', 'Natural Succession', 'LCMAP clearing before 2015', df1, anci_folder, anci_dict['timHarRasPath'], anci_dict['sucAgeRasPath'],  10000)
+    lcmap_timber_mp(cf, psegs, 'Harvested Forest', 'lcmap clearing', 'Natural Succession', 'LCMAP clearing before 2015', df1, anci_folder, anci_dict['timHarRasPath'], anci_dict['sucAgeRasPath'], 2048)
     etime(cf, psegs,  'LCMAP timber harvest', th_st)
 
+
+def block_luz_remaining(cf, psegs, ctx):
+    """
+    Rule block: LUZ, majority lu (2 of 3), remaining lv/barren/ss and remnant adjacency
+    """
+    graph, features = ctx['graph'], ctx['features']
     # map LUZ values
     # rev2 5/10: reordered luz back to below natural_succession().
 
-    luz(cf, psegs)  
+    luz(cf, psegs, features)
 
     maj_lc_vals = ['Low Vegetation', 'Barren', 'Scrub\\Shrub']
     maj_lu_exclusions = ['Turf Herbaceous', 'Turf Low Vegetation']
     print(f'--Start majority lu (2 of 3) including {maj_lc_vals} - {time.asctime()}')
-    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.25, int(1e6), maj_replace=False)
-
-    # all remaining barren...
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Barren'])), 'logic'] = "All remaining Barren"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Barren'])), 'lu'] = "Developed Barren"
-
-    # all remaining herbaceous with building
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 > 0) & (psegs.p_area <= 40468) & (psegs.Class_name.isin(['Low Vegetation'])), 'logic'] = "Remaining LV w/ building in parcel <10ac"
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 > 0) & (psegs.p_area <= 40468) & (psegs.Class_name.isin(['Low Vegetation'])), 'lu'] = "Turf Herbaceous"
-
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])) & (psegs.p_lc_7 > 0) &(psegs.p_luz == 'TG'), 'logic'] = "remaining lv luz 'TG' w/building" 
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])) & (psegs.p_lc_7 > 0) &(psegs.p_luz == 'TG'), 'lu'] = "Turf Herbaceous"
-
-    # trees, no build, 
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 == 0) & (psegs.p_lc_3 > (psegs.p_area*0.3)) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'logic'] = "Remaining LV w/ >30% p_lc_3 no build"
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 == 0) & (psegs.p_lc_3 > (psegs.p_area*0.3)) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'lu'] = "Natural Succession Herbaceous"
+    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.25, maj_replace=False)
 
-
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 == 0) & (psegs.s_luz.isin(['EVE', "DEC"])) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'logic'] = "Remaining LV or SS no build EVE or DEC LUZ"
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_lc_7 == 0) & (psegs.s_luz.isin(['EVE', "DEC"])) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
-
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Scrub\\Shrub'])), 'logic'] = "Remaining SS no limits"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Scrub\\Shrub'])), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
+    # all remaining barren, herbaceous with building, trees no build, SS
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['remaining'], features)
 
     # rev2 6/1 - added 6/4 removed df2 s_area threshold...
     st_remain_nat = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub']))]
     df2 = psegs[(psegs.lu.isin(["Natural Succession Herbaceous", "Natural Succession Scrub\\Shrub"]))]
-    adjacency_mp(psegs, 'Natural Succession', 'lvb adj to nat sus', df1, df2, 'minimum', 0, batch_size)
-    etime(cf, psegs,  "Remnant Adj to Natural Succession", st_remain_nat) 
+    region_grow(psegs, graph, 'Natural Succession', 'lvb adj to nat sus', df1, df2, 'minimum', 0, luconfig.lu_grow_hops)
+    etime(cf, psegs,  "Remnant Adj to Natural Succession", st_remain_nat)
+
 
+def block_final(cf, psegs, ctx):
+    """
+    Rule block: p_area = 0 and pasture reclass, majority lu (3 of 3), remnant adjacency and whatevers left
+    """
+    graph, features = ctx['graph'], ctx['features']
     # All remaining lv segs with suspended succession if there is no known parcel area (probably roads or public lands)
     print("REVISE 'p_area = 0' logic when new data prep is ready") # replace with road tabulations
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_area == 0) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'logic'] = "p_area = 0"
-    psegs.loc[(psegs.lu.isna()) & (psegs.p_area == 0) & (psegs.Class_name.isin(['Low Vegetation', 'Scrub\\Shrub'])), 'lu'] = "Suspended Succession Herbaceous"
-
-    # if na or pasture in <5 parcel WITH NO build, make nat sus
-    psegs.loc[(psegs.lu.str.contains("Pasture")) & (psegs.p_lc_7 == 0) & (psegs.p_area < (4046*5)) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub'])), 'logic'] = "Reclass Pas to Nat <5ac p"
-    psegs.loc[(psegs.lu.str.contains("Pasture")) & (psegs.p_lc_7 == 0) & (psegs.p_area < (4046*5)) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub'])), 'lu'] = "Natural Succession" + " " + psegs['Class_name']
-
-    # if na or pasture in <5 parcel WITH build, make turf
-    psegs.loc[((psegs.lu.str.contains("Pasture")) | psegs.lu.isna()) & (psegs.p_lc_7 > 0) & (psegs.p_area < (4046*5)) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub'])), 'logic'] = "Reclass Pas to Turf <5ac p w/ building"
-    psegs.loc[((psegs.lu.str.contains("Pasture")) | psegs.lu.isna()) & (psegs.p_lc_7 > 0) & (psegs.p_area < (4046*5)) & (psegs.Class_name.isin(['Low Vegetation'])), 'lu'] = "Turf Herbaceous"
+    # if na or pasture in <5 parcel with no build make nat sus, with build make turf
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['pasture_reclass'], features)
 
     maj_lc_vals = ['Low Vegetation']
     maj_lu_exclusions = ['Turf Herbaceous', 'Turf Low Vegetation']
     print(f'--Start majority lu (3 of 3) including {maj_lc_vals} - {time.asctime()}')
-    # p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.05, int(1e6), maj_replace=True) # rev2 6/1 - changed thresh from 25% to 5%
-    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.60, int(1e6), maj_replace=True) # rev2 6/1 - implemented maj_replace and bumped to 60%
+    # p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.05, maj_replace=True) # rev2 6/1 - changed thresh from 25% to 5%
+    p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.60, maj_replace=True) # rev2 6/1 - implemented maj_replace and bumped to 60%
     print('TESTING AG P MAJ REPLACE')
 
     st_all_remain = time.time()
     df1 = psegs[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation', 'Barren', 'Scrub\\Shrub'])) ]
     df2 = psegs[psegs.lu.str.contains("Natural Succession", na=False)]
-    adjacency_mp(psegs, 'Natural Succession', 'Remnant adj to nat sus', df1, df2, 'minimum', 0, batch_size)
+    region_grow(psegs, graph, 'Natural Succession', 'Remnant adj to nat sus', df1, df2, 'minimum', 0, luconfig.lu_grow_hops)
     etime(cf, psegs,  "Remnant Adj to Natural Succession", st_all_remain) 
 
-    # ag_gen
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_luz == 'AG_GEN') & (psegs.s_area > 10000) & (psegs.p_lc_5 > psegs.p_area*0.5) & (psegs.Class_name.isin(['Low Vegetation'])), 'logic'] = "ag_gen last chance"
-    psegs.loc[(psegs.lu.isna()) & (psegs.s_luz == 'AG_GEN') & (psegs.s_area > 10000) & (psegs.p_lc_5 > psegs.p_area*0.5) & (psegs.Class_name.isin(['Low Vegetation'])), 'lu'] = "Cropland Herbaceous"
+    # ag_gen last chance and all remaining LV
+    rule_engine.run_plan(cf, psegs, lu_rules.PLANS['final'], features)
 
-    # rev2 6/4 -added
-    maj_lc_vals = ['Low Vegetation']
-    maj_lu_exclusions = ['Turf Herbaceous', 'Turf Low Vegetation']
-    print(f'--Start majority lu (3 of 3) including {maj_lc_vals} - {time.asctime()}')
-    # p_maj_lu(cf, psegs, maj_lc_vals, maj_lu_exclusions, 0.05, int(1e6), maj_replace=True) # rev2 6/1 - changed thresh from 25% to 5%
-    print('TESTING AG P MAJ REPLACE')
 
-    # All remaining LV
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])), 'logic'] = "Whatevers left"
-    psegs.loc[(psegs.lu.isna()) & (psegs.Class_name.isin(['Low Vegetation'])), 'lu'] = "Suspended Succession Herbaceous"
+# ordered rule blocks of RUN, each ends with a checkpoint of lu and the rule events (see checkpoints.py)
+RULE_BLOCKS = [
+    ('turf', block_turf),
+    ('roads_ag_cdl', block_roads_ag_cdl),
+    ('anci_shore', block_anci_shore),
+    ('natural_succession', block_natural_succession),
+    ('lcmap', block_lcmap),
+    ('luz_remaining', block_luz_remaining),
+    ('final', block_final),
+    ]
+
+def rule_reach():
+    """
+    Returns the number of rule steps of RULE_BLOCKS that read other psegs' state: adjacency_graph (5), region_grow
+    (4, luconfig.lu_grow_hops each) and p_maj_lu (3). Each hop can carry state one neighbour or one parcel further,
+    the tiled rule chain halo covers all of them. Read at run time so a changed lu_grow_hops is honored.
+    """
+    return 5 + 4 * luconfig.lu_grow_hops + 3
+
+
+######################################################################
+########################## TILED RULE CHAIN ##########################
+######################################################################
+
+def rule_chain_tile(args):
+    """
+    Method: rule_chain_tile()
+    Purpose: Worker for run_tiled. Run the rule blocks on the working set of one tile.
+    Params: args - cf, tile psegs (attributes only, positions 0..n-1), tile PsegGraph, bool array of the core psegs,
+                   index of the first rule block, rule block context without graph and features,
+                   provenance event log of the tile psegs so far
+    Returns: (core, state, events) - core positions in the tile, {column: (codes, categories)} of lu for them and
+             the provenance events recorded by the tile (tile positions)
+    """
+    cf, tile, graph, core, start, ctx, seed = args
+    ctx = dict(ctx, graph=graph, features=rule_engine.FeatureStore(tile))
+    log = provenance.resume(seed)
+    seeded = len(log.positions)
+    for name, block in RULE_BLOCKS[start:]:
+        block(cf, tile, ctx)
+    state = {}
+    for col in lu_codes.STATE_COLUMNS:
+        cat = tile[col].array
+        state[col] = (np.asarray(cat.codes)[core], list(cat.categories))
+    return np.flatnonzero(core), state, log.since(seeded)
+
+def stitch_state(psegs, results):
+    """
+    Method: stitch_state()
+    Purpose: Write the core lu of every tile back to psegs. Cores do not overlap, tile categories are
+             merged into the psegs categories in tile order.
+    Params: psegs - main pseg gdf
+            results - list of (positions in psegs, {column: (codes, categories)}) of each tile
+    Returns: N/A
+    """
+    for col in lu_codes.STATE_COLUMNS:
+        cat = psegs[col].array
+        categories = list(cat.categories)
+        lookup = {c: i for i, c in enumerate(categories)}
+        codes = np.asarray(cat.codes).copy()
+        for positions, state in results:
+            tile_codes, tile_categories = state[col]
+            for c in tile_categories:
+                if c not in lookup:
+                    lookup[c] = len(categories)
+                    categories.append(c)
+            table = np.array([lookup[c] for c in tile_categories] + [-1], dtype=np.int64) # code -1 takes the last slot
+            codes[positions] = table[tile_codes]
+        psegs[col] = pd.Categorical.from_codes(codes, categories=categories)
+
+def run_tiled(cf, psegs, ctx, start, runtime, tile_size):
+    """
+    Method: run_tiled()
+    Purpose: Run RULE_BLOCKS[start:] on spatial tiles in parallel (one task per tile) and stitch the core results
+             back to psegs (see lu_tiles.py for tile ownership and the halo). LCMAP harvest and succession age
+             are computed for every low veg and barren pseg first, so the tiles need no raster or geometry.
+    Params: cf - county fips
+            psegs - main pseg gdf, lu and the provenance log are updated in place
+            ctx - rule block context (graph, features, folder, ...)
+            start - index of the first rule block to run
+            runtime - mp_runtime.WorkerRuntime
+            tile_size - tile width and height in map units (luconfig.lu_tile_size)
+    Returns: N/A
+    """
+    tt = time.time()
+    names = [name for name, block in RULE_BLOCKS[start:]]
+    if 'lcmap' in names:
+        df1 = psegs[psegs.Class_name.isin(['Low Vegetation', 'Barren'])]
+        psegs['lcmap_harvest'], psegs['lcmap_age'] = lcmap_stats(cf, psegs, df1, ctx['anci_folder'], ctx['anci_dict']['timHarRasPath'], ctx['anci_dict']['sucAgeRasPath'], 2048)
+        etime(cf, psegs, 'LCMAP zones for tiles', tt)
+
+    graph = ctx['graph']
+    sources = graph.sources()
+    pidx = lu_tiles.parcel_index(psegs['PID'].values)
+    parcels = lu_tiles.parcel_members(pidx)
+    tiles = lu_tiles.pseg_tiles(psegs, mp_runtime.layer_bounds(runtime.layers['psegs']), pidx, tile_size)
+    attributes = pd.DataFrame(psegs[[c for c in psegs.columns if c != 'geometry']])
+    tile_ctx = {k: v for k, v in ctx.items() if k not in ('graph', 'features')}
+    log = provenance.log()
+
+    reach = rule_reach()
+    chunk_iterator, tile_rows = [], []
+    halo = 0
+    for t in np.unique(tiles):
+        core = tiles == t
+        rows = np.flatnonzero(lu_tiles.working_set(graph, parcels, pidx, core, reach))
+        tile_rows.append(rows)
+        halo += len(rows) - core.sum()
+        tile = attributes.iloc[rows].reset_index(drop=True)
+        chunk_iterator.append((cf, tile, lu_tiles.subgraph(graph, sources, rows), core[rows], start, tile_ctx, log.subset(rows)))
+    print(f'--Tiled rule chain: {len(chunk_iterator)} tiles of {tile_size}, {halo} halo psegs ({round(halo / len(psegs) * 100, 2)}%)')
+    del attributes
+
+    results = []
+    for rows, (core, state, events) in zip(tile_rows, runtime.map(rule_chain_tile, chunk_iterator)):
+        results.append((rows[core], state))
+        to_psegs = np.full(len(rows), -1, dtype=np.int64) # halo events are thrown away with the halo results
+        to_psegs[core] = rows[core]
+        log.extend(events, to_psegs)
+    stitch_state(psegs, results)
+    if 'lcmap' in names:
+        psegs.drop(columns=['lcmap_harvest', 'lcmap_age'], inplace=True)
+    etime(cf, psegs, f'Tiled rule chain ({", ".join(names)})', tt)
+
+######################################################################
+################################ MAIN ################################
+######################################################################
+
+def RUN(cf, test):
+
+    folder = luconfig.folder
+    destinationDir = luconfig.dest
+    anci_folder = luconfig.anci_folder
+    anci_dict = luconfig.anci_dict
+    batch_size = luconfig.batch_size
+    batch_log_Path = luconfig.batch_log_Path
+
+    cf_st = time.time()
+    print(f'\n--Start {cf}: {time.asctime()}')
+    b_log = open(batch_log_Path, "a")
+    b_log.write(f'\n--Start {cf}: {time.asctime()}')
+    b_log.close()
+
+##################################### 
+    if test:
+        print('--landuse.RUN() Test: ', test)
+        # psegsPath = r"B:/landuse/testing_subsets/psegs_sub4.gpkg" # for checking nat succession
+        # inLayer = 'psegs'
+        # make output name with iteration
+        vnums = []
+        for (root,dirs,files) in os.walk('Z:/landuse/testing_subsets/output', topdown=True):
+            for file in files:
+                vnum = int(file.split("_")[-1].split(".")[0])
+                vnums.append(vnum)
+
+        print("--Iteration number: ", max(vnums)+1)
+        outPath = f"Z:/landuse/testing_subsets/output/psegs_sub4_rev2_{max(vnums)+1}.gpkg"
+        outLayer = 'psegs_lu'
+
+    else:
+        print('--landuse.RUN() Test: ', test)
+        psegsPath = f"{folder}/{cf}/input/data.gpkg" # output will swap 'input' to 'output' and layer 'psegs_lu'
+        inLayer = 'psegs'
+        outPath = psegsPath.replace('input','output')
+        outLayer = 'psegs_lu'
+
+##################################### 
+
+    # State specific file paths
+    st_dict = luconfig.st_dict
+
+    timberKey = None
+    if st_dict[cf[5:7]] == 'PA':
+        timberKey = 'PAtimberPath'
+    if st_dict[cf[5:7]] == 'MD':
+        timberKey = 'MDtimberPath'
+
+    ###  ACTION ********************************************************
+    # try:
+    psread_st = time.time()
+    print(f"Start reading psegs {time.asctime()}")
+    print(psegsPath)
+    print(inLayer)
+    joinColumns = psegs_schema.JOIN_COLUMNS
+    readColumns = None # schema columns only, at their target dtypes
+    if not all(col in psegs_schema.layer_columns(psegsPath, inLayer) for col in joinColumns):
+        print('Required join column(s) missing, reading base columns to join data')
+        readColumns = psegs_schema.BASE_COLUMNS
+    runtime = mp_runtime.get_runtime(mp.cpu_count() - 1) # county worker runtime, feature ranges of psegs are read in parallel
+    store = None
+    if luconfig.lu_lazy_geometry: # attributes in memory, geometry in an on disk WKB store
+        psegs, store = psegs_schema.read_psegs_lazy(psegsPath, inLayer, f'{folder}/{cf}/temp/psegs_wkb', readColumns, runtime=runtime)
+    else:
+        psegs = psegs_schema.read_psegs(psegsPath, inLayer, readColumns, runtime)
+    etime(cf, psegs,  f"psegs read in", psread_st)
+    print("psegs dtypes: \n", psegs.dtypes)
+
+    # except:
+    #     print("ERROR! psegsPath failed to read...")
+    #     print(f'--psegsPath: {psegsPath}')
+    #     for layername in fiona.listlayers(psegsPath):
+    #         with fiona.open(psegsPath, layer=layername) as src:
+    #             print(f"--layer name : {layername} \n--rows: {len(src)}\n--schema: {src.schema}\n")
+    #     return -1, 'psegs failed to read'
+    #     sys.exit()
+
+    jc = 0
+    for col in joinColumns:
+        if col not in psegs.columns:
+            jc += 1
+    if jc != 0:
+        print('Required join column(s) missing, trying to join data')
+        print(psegs.columns)
+        print(joinColumns)
+        psegs = psegs[[c for c in psegs_schema.BASE_COLUMNS + ['geometry'] if c in psegs.columns]]
+        psegs = joinData(cf, psegs, True) # replace remove_columns bool with column check
+
+    for col in joinColumns:
+        if col not in psegs.columns:
+            if '_lc_' in col: 
+                val = col.split('_')[-1]
+                print(f"Missing land cover class {val}; adding column of 0")
+                psegs.loc[:, col] = 0
+            else:
+                print(f"Required columns still missing.\npseg cols:{psegs.columns}\nRequired joined cols: {col}")
+                # sys.exit()
+                raise TypeError(f"Required columns still missing.\npseg cols:{psegs.columns}\nRequired joined cols: {col}")
+
+    psegs = datacheck(cf, psegs, folder, store)
+    runtime = publish_psegs(psegs, store) # same county worker runtime, shared with the later modules
+    graph = adjacency.get_pseg_graph(cf, psegs, runtime, batch_size) # saved next to output/data.gpkg
+    anci_overlay(cf, psegs, runtime, anci_folder, anci_dict, batch_size) # all vector anci layers in one pass -> psegs['anci_bits']
+    features = rule_engine.FeatureStore(psegs) # static columns and derived features shared by the rule tables
+
+    ctx = {'graph': graph, 'features': features, 'folder': folder, 'anci_folder': anci_folder,
+           'anci_dict': anci_dict, 'st_dict': st_dict, 'timberKey': timberKey}
+    ckpt = checkpoints.Checkpoints(folder, cf, [name for name, block in RULE_BLOCKS],
+                                   checkpoints.fingerprint(psegs, [Path(anci_folder, v) for v in anci_dict.values()]))
+    start = ckpt.resume(psegs)
+    if not luconfig.lu_tile_size:
+        for name, block in RULE_BLOCKS[start:]:
+            block(cf, psegs, ctx)
+            ckpt.save(name, psegs)
+    elif start < len(RULE_BLOCKS):
+        run_tiled(cf, psegs, ctx, start, runtime, luconfig.lu_tile_size) # blocks run inside the tiles, one checkpoint at the end
+        ckpt.save(RULE_BLOCKS[-1][0], psegs)
 
     ## Classification finished
     # print('Restoring TC over LC Class_names')
@@ -1097,28 +1168,22 @@ def RUN(cf, test):
     # psegs.loc[(psegs.lu == "Tree Canopy Over Other Impervious Surfaces"), 'Class_name'] = "Tree Canopy Over Other Impervious Surfaces"
     # psegs.loc[(psegs.lu == "Tree Canopy Over Structures"), 'Class_name'] = "Tree Canopy Over Structures"
 
-    name_dict = luconfig.name_dict
-    # clean up lu names to match final format
-    for k, v in name_dict.items():
-        print(k, " to ", v)
-        psegs['lu'] = psegs['lu'].replace(k, v, regex=True)
+    # rule provenance: last rule of every pseg, the logic string only on request (luconfig.lu_write_logic)
+    log = provenance.log()
+    psegs['rule_id'] = log.current()
+    if luconfig.lu_write_logic:
+        psegs['logic'] = log.logic_labels(psegs['Class_name'].array)
+
+    # clean up lu names to match final format (luconfig.name_dict), POPULATE lu_code and decode to strings
+    psegs = lu_codes.output_labels(psegs)
 
     print("\nOutput LU list: ", psegs.lu.unique(), "\n")
     if len(psegs[(psegs.lu.isna())]) != 0:
         print("No LU count: ", len(psegs[(psegs.lu.isna())]))
 
-    # POPULATE lu_code
-    psegs['lu_code'] = 0
-    # populate lu_code field if value in dictionary
-    for lu in psegs.lu.unique():
-        if lu in luconfig.lu_code_dict.keys():
-            for k, v in luconfig.lu_code_dict.items():
-                if k == lu:
-                    psegs.loc[(psegs.lu == k), 'lu_code'] = v
-        else:
-            print("\n", lu, " not in keys")
-
     print(psegs.lu_code.unique())
+    areas = psegs['ps_area'].values
+    runtime.release('psegs')
     
     ########################
 
@@ -1130,13 +1195,19 @@ def RUN(cf, test):
 
     if not test:
         print('WARNING: Clearing fields from psegs')
-        psegs = psegs[['PSID', 'PID', 'SID', 'Class_name', 'lu', 'logic', 'lu_code', 'geometry']]
+        psegs = psegs[[c for c in ['PSID', 'PID', 'SID', 'Class_name', 'lu', 'lu_code', 'rule_id', 'logic', 'geometry'] if c in psegs.columns]]
 
     print(f'Saving psegs to file...')
     print(f'--outPath: {outPath}\n--outLayer: {outLayer}')
     wt = time.time()
-    psegs.to_file(outPath, layer=outLayer, driver='GPKG')
+    if store is not None:
+        write_lazy(psegs, store, outPath, outLayer, 1000000)
+        store.remove()
+    else:
+        psegs.to_file(outPath, layer=outLayer, driver='GPKG')
+    write_provenance(log, psegs['PSID'].values, areas, outPath)
     etime(cf, psegs,  f"Output write", wt)
+    ckpt.clear() # output written, a rerun starts from the input again
     
     return psegs
 
@@ -18,6 +18,7 @@ import sys
 from rasterio.windows import from_bounds
 
 import luconfig
+import polygonize
 
 ##########################################################################################
 #---------------------- GETTERS ---------------------------------------------------------#
@@ -536,18 +537,19 @@ def clipRasByCounty(cnty_geom, changeonlypath):
                         "transform": out_transform}) 
     return out_image, out_meta
 
-def vectorizeRaster(unique_array, transform):
+def vectorizeRaster(unique_array, transform, runtime=None):
     """
     Method: vectorizeRaster()
-    Purpose: Create polygon geometries for each unique zone in the raster.
+    Purpose: Create polygon geometries for each unique zone in the raster (exterior rings), polygonized in tiles
+             (polygonize.py).
     Params: unique_array - numpy array of zones
             transform - rasterio transform of array that is to be vectorized
+            runtime - optional mp_runtime.WorkerRuntime to polygonize the tiles in parallel (not from pool workers)
     Returns: zones_gdf - geodataframe of vectorized raster zones with unique field 'zone'
     """
     unique_array = unique_array.astype(np.int16)
-    geoms = []
-    for i, (s, v) in enumerate(shapes(unique_array, mask=unique_array.astype(bool) , connectivity=4, transform=transform)): 
-        geoms.append(Polygon(s['coordinates'][0]))
+    values, geoms = polygonize.polygonize_array(unique_array, transform, runtime=runtime)
+    geoms = [Polygon(g.exterior) for g in geoms]
     zones_gdf = gpd.GeoDataFrame(geometry=geoms, crs="EPSG:5070")
     zones_gdf['zone'] = [int(x) for x in range(1, len(zones_gdf)+1)]
     return zones_gdf
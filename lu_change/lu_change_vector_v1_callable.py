@@ -56,6 +56,9 @@ from lu_change import LU_Change_P6Rollup as p6_change
 from helpers import etime 
 import helpers
 import luconfig
+import mp_runtime
+import rasterizer
+import multiprocessing as mp
 
 def runDirect(lc_change_gdf):
     """
@@ -511,7 +514,7 @@ def run_lu_change(cf, lu_type):
     st = time.time()
 
     # Vectorize change raster
-    lc_change_gdf = lch.vectorizeRaster(lc_change_ary, lc_change_meta['transform'])
+    lc_change_gdf = lch.vectorizeRaster(lc_change_ary, lc_change_meta['transform'], mp_runtime.get_runtime(mp.cpu_count() - 2))
     etime(cf, 'Vectorized Change', st)
     
     # Read in vector parcels
@@ -677,14 +680,15 @@ def run_lu_change(cf, lu_type):
     # Rasterize T1 LU and mask by LC change
     classes_not_in_change = ['Tree Canopy to Tree Canopy', 'Tree Canopy to Tree Canopy NS']
     sh = (lc_change_ary.shape[1], lc_change_ary.shape[2])
-    shapes = [ (row['geometry'], row['T1_LU_Code']) for idx, row in lc_change_gdf[(lc_change_gdf['Method'] == 'New Structure - Parcel')|(lc_change_gdf['LC_Change'].isin(classes_not_in_change))].iterrows()]
+    runtime = mp_runtime.get_runtime(mp.cpu_count() - 2) # tiled burns (rasterizer.py)
+    shapes = lc_change_gdf[(lc_change_gdf['Method'] == 'New Structure - Parcel')|(lc_change_gdf['LC_Change'].isin(classes_not_in_change))]
     if len(shapes) > 0:
-        t1lu_ary = rasterize(shapes, out_shape=sh, fill=0,  transform=lc_change_meta['transform'], all_touched=False)
+        t1lu_ary = rasterizer.rasterize_array(shapes.geometry, shapes['T1_LU_Code'].values, sh, lc_change_meta['transform'], 'uint16', runtime=runtime)
     else:
         etime(cf, 'No TC to TC or NS Parcel to rasterize', st)
-    shapes = [ (row['geometry'], row['T1_LU_Code']) for idx, row in lc_change_gdf[lc_change_gdf['Method'] != 'New Structure - Parcel'].iterrows()]
+    shapes = lc_change_gdf[lc_change_gdf['Method'] != 'New Structure - Parcel']
     if len(shapes) > 0:
-        ns_p_ary = rasterize(shapes, out_shape=sh, fill=0,  transform=lc_change_meta['transform'], all_touched=False)
+        ns_p_ary = rasterizer.rasterize_array(shapes.geometry, shapes['T1_LU_Code'].values, sh, lc_change_meta['transform'], 'uint16', runtime=runtime)
         try:
             t1lu_ary = np.where(lc_change_ary > 0, ns_p_ary, t1lu_ary)
             etime(cf, 'Adding other change to TC to TC and NS Parcel - raster', st)
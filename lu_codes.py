@@ -0,0 +1,132 @@
+"""
+Script: lu_codes.py
+Purpose: Integer coded classification state for psegs. Class_name and lu are held as pandas
+         categoricals with fixed category tables built from luconfig (LC_classes, lu_prefixes), so rules
+         compare small integer codes instead of strings. Labels not in the tables are appended to the
+         categories the first time they are assigned. Rule provenance (the old logic column) is kept
+         as events in provenance.py. Strings are only produced again
+         in output_labels() before psegs are written.
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+import luconfig
+
+CODED_COLUMNS = ('Class_name', 'lu')
+STATE_COLUMNS = ('lu',) # classification state, Class_name is static
+
+CLASS_NAMES = list(luconfig.LC_classes)
+
+# direct LC classes, TC over classes (datacheck) and every "{prefix} {Class_name}" rule label
+LU_LABELS = list(dict.fromkeys(
+    CLASS_NAMES
+    + [f'{p} {c}' for p in luconfig.lu_prefixes for c in CLASS_NAMES]
+    ))
+
+TABLES = {'Class_name': CLASS_NAMES, 'lu': LU_LABELS}
+
+
+class CodedColumn:
+    """
+    Codes and growing category table of one coded column, used by rule_engine to update state
+    without rebuilding a categorical per rule.
+    """
+    def __init__(self, values):
+        values = pd.Categorical(values)
+        self.categories = list(values.categories)
+        self.lookup = {c: i for i, c in enumerate(self.categories)}
+        self.codes = np.asarray(values.codes, dtype=np.int32).copy()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def code(self, label):
+        """
+        Returns the code of label, adding it to the categories if needed.
+        """
+        if label not in self.lookup:
+            self.lookup[label] = len(self.categories)
+            self.categories.append(label)
+        return self.lookup[label]
+
+    def categorical(self):
+        return pd.Categorical.from_codes(self.codes, categories=self.categories)
+
+
+def _categorical(values, table):
+    values = pd.Series(values, copy=False).astype(object)
+    new = [v for v in pd.unique(values.dropna()) if v not in table]
+    if len(new) > 0:
+        print(f'----Adding values not in the category table: {new}')
+    return pd.Categorical(values, categories=table + new)
+
+def encode(psegs):
+    """
+    Method: encode()
+    Purpose: Convert Class_name and lu to categoricals using the fixed tables. Used at the end of
+             datacheck, before any rule runs.
+    Params: psegs - main pseg gdf
+    Returns: psegs
+    """
+    for col in CODED_COLUMNS:
+        psegs[col] = _categorical(psegs[col], TABLES[col])
+    return psegs
+
+def assign(psegs, rows, column, labels):
+    """
+    Method: assign()
+    Purpose: Set labels of a coded column for some psegs, adding new labels to the categories first
+             (a plain .loc assignment of an unknown label to a categorical raises).
+    Params: psegs - main pseg gdf
+            rows - bool mask or positions of psegs to set
+            column - 'lu' or 'Class_name'
+            labels - one label or an array of labels matching rows
+    Returns: N/A
+    """
+    cat = psegs[column].array
+    labels = np.atleast_1d(np.asarray(labels, dtype=object))
+    new = [l for l in pd.unique(labels) if l not in cat.categories]
+    if len(new) > 0:
+        cat = cat.add_categories(new)
+    codes = np.asarray(cat.codes).copy()
+    codes[rows] = cat.categories.get_indexer(labels)
+    psegs[column] = pd.Categorical.from_codes(codes, categories=cat.categories)
+
+def with_class(prefix, classes):
+    """
+    Returns "{prefix} {Class_name}" labels for an array of Class_name values.
+    """
+    classes = pd.Categorical(classes)
+    table = np.array([f'{prefix} {c}' for c in classes.categories], dtype=object)
+    return table[classes.codes]
+
+def output_labels(psegs):
+    """
+    Method: output_labels()
+    Purpose: Output boundary of the coded columns. Applies luconfig.name_dict to the lu categories
+             (same regex replacements as before, once per category instead of once per pseg), populates
+             lu_code with one array lookup from luconfig.lu_code_dict (0 if not in the dictionary) and
+             turns Class_name and lu back into strings for writing.
+    Params: psegs - main pseg gdf
+    Returns: psegs
+    """
+    lu = psegs['lu'].array
+    names = list(lu.categories)
+    for k, v in luconfig.name_dict.items():
+        print(k, " to ", v)
+        names = [re.sub(k, v, n) for n in names]
+    names = np.array(names + [None], dtype=object)
+    codes = np.asarray(lu.codes)
+
+    used = np.unique(codes)
+    for n in names[used]:
+        if n not in luconfig.lu_code_dict:
+            print("\n", n, " not in keys")
+    lu_code = np.array([luconfig.lu_code_dict.get(n, 0) for n in names], dtype=np.int32)
+
+    psegs['lu'] = names[codes] # missing lu (code -1) picks the trailing None
+    psegs['lu_code'] = lu_code[codes]
+    psegs['Class_name'] = np.asarray(psegs['Class_name'].astype(object))
+    return psegs
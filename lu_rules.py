@@ -0,0 +1,139 @@
+"""
+Script: lu_rules.py
+Purpose: Ordered, non-spatial landuse rule tables run by landuse_rev2 through rule_engine.
+         Rules are applied top to bottom; conditions of a rule are and-ed (see rule_engine for the format).
+         Revision notes from the original .loc chains are kept next to their rules.
+"""
+from rule_engine import LU_NA, col, compile_rules
+
+LV = 'Low Vegetation'
+SS = 'Scrub\\Shrub'
+
+# direct LC to LU classes, occupied parcel turf and barren
+RULESET1 = [
+    {'logic': 'landcover', 'lu': '{Class_name}',
+     'when': [('Class_name', 'isin', ['Water', 'Buildings', 'Other Impervious Surfaces', 'Roads', 'Tree Canopy', 'Emergent Wetlands'])]},
+    # Turf: occupied parcel - parcel area <= 4046 - 93sqm # todo this may be interfering with the TCT ruleset
+    {'logic': 'Occupied parcel turf', 'lu': 'Turf Herbaceous',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '<=', 4046), ('p_lc_dev', '>=', 93)]},
+    # Barren: occupied parcel - parcel area <= 4046 - 93sqm
+    {'logic': 'Occupied parcel barren', 'lu': 'Developed Barren',
+     'when': [LU_NA, ('Class_name', '==', 'Barren'), ('p_area', '<=', 4046), ('p_lc_dev', '>=', 93)]},
+    ]
+
+# classify psegs lu by CDL and NLCD tabulations
+AG_CDL = [
+    # CDL and NCLD both say pasture. rev2 5/20 - added
+    {'logic': 'nlcd and cdl have maj pas', 'lu': 'Pasture {Class_name}',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '>', 4046*5), ('s_n16_1', '>', col('s_n16_0')), ('s_c18_4', '>', col('s_c18_0123'))]},
+    # rev2 5/21 - added, rev2 6/2 changed to seg must be at least 50% of parcel area.
+    {'logic': 'p_area > 50% NLCD Pasture', 'lu': 'Pasture {Class_name}',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '>', 4046*5), ('s_n16_1', '>', col('p_area', 0.5))]},
+    # Crop : CDL 2018 only, rev2 6/2- added max pasture limit
+    {'logic': 's_c18_1 > 10000', 'lu': 'Cropland {Class_name}',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '>', 4046*5), ('s_c18_1', '>', 10000), ('s_c18_4', '<', 10000)]},
+    # Pasture: CDL 2018 only, rev2 6/2- added max crp limit
+    {'logic': 's_c18_4 > 10000', 'lu': 'Pasture {Class_name}',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '>', 4046*5), ('s_c18_4', '>', 10000)]},
+    # Orchard/Vineyard : CDL 2018 only
+    {'logic': 's_c18_3 > 20%', 'lu': 'Orchard/Vineyard {Class_name}',
+     'when': [LU_NA, ('Class_name', '==', LV), ('p_area', '>', 4046*5), ('s_c18_3', '>', col('s_area', 0.2))]},
+    ]
+
+# natural succession rules run before the two adjacency rules in natural_succession()
+# rev2 5/21 - changed lc3/p_area from 70% to 45%, rev2 6/1 - added "if not luz TG" clauses
+NATURAL_SUCCESSION = [
+    # Large proportion of TC in parcel and small vegetation
+    {'logic': '70% TC parcel,  s_area < 1000', 'lu': 'Natural Succession {Class_name}',
+     'when': [LU_NA, ('s_area', '<', 1000), ('s_luz', '!=', 'TG'), ('Class_name', 'isin', [LV, SS]), ('p_lc_3', '>', col('p_area', 0.45))]},
+    # Any parcel with scrub/shrub and no roads or structures, SS is natural succession
+    {'logic': 'Nat Sus, c18_0*0.85  93m2 of road or building', 'lu': 'Natural Succession {Class_name}',
+     'when': [LU_NA, ('s_area', '<', 1000), ('s_luz', '!=', 'TG'), ('Class_name', 'isin', [LV, SS]), ('p_lc_dev', '<', 93), ('p_c18_0', '>', col('p_area', 0.85))]},
+    # If parcel is over 1 acre, is 70%+ TC and has <50% p_c18 coverage
+    {'logic': 'nat 70% tc 150m2', 'lu': 'Natural Succession {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [LV, SS]), ('s_luz', '!=', 'TG'), ('p_area', '>', 4046), ('s_area', '<', 150), ('p_lc_3', '>', col('p_area', 0.7)), ('p_c18_0', '>', col('p_area', 0.7))]},
+    ]
+
+# LUZ where scrub shrub should be reclassed, s_luz -> lu prefix
+# rev2 5/20 - fixed pseg subsetting to only include SS, rev2 6/1- removed CROP from OV
+SS_LUZ = {'NAT': 'Natural Succession', 'OV': 'Orchard/Vineyard', 'SUS': 'Suspended Succession',
+          'CAFO': 'Pasture', 'CATT': 'Pasture', 'TIM': 'Natural'}
+# LUZ where low veg and barren should be reclassed excluding crop and pasture
+# rev2 EXT moved from suspended to natural, rev2 6/2 - removed SS
+LVB_LUZ = {'CAFO': 'Pasture', 'CATT': 'Pasture', 'CENT': 'Cropland', 'EXT': 'Natural Succession',
+           'FALL': 'Suspended Succession', 'NAT': 'Natural Succession', 'OV': 'Orchard/Vineyard',
+           'SUS': 'Suspended Succession', 'TIM': 'Natural Succession'}
+
+# revised 4/20/21 to not reclass buildings in CAFO, CATT, and POUL
+# rev2 5/20 - added p_area thresh for tg changed s_luz to p_luz for TURF
+LUZ = [
+    {'logic': "luz 'TG' maj <1ac", 'lu': 'Turf Herbaceous',
+     'when': [LU_NA, ('Class_name', 'isin', [LV]), ('p_luz', '==', 'TG'), ('p_area', '<', 4046)]},
+    ] + [
+    {'logic': f'ss s_luz {luz} maj', 'lu': lu_name + ' {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [SS]), ('s_luz', '==', luz)]}
+    for luz, lu_name in SS_LUZ.items()
+    ] + [
+    {'logic': f'lvb s_luz {luz} maj', 'lu': lu_name + ' {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [LV, 'Barren']), ('s_luz', '==', luz)]}
+    for luz, lu_name in LVB_LUZ.items()
+    ] + [
+    # Pasture and Crop specific rules for LUZ, rev2 6/2 - removed Crop and Pasture from other loop and build more thresholds
+    {'logic': 's_luz PAS, no cdl conflict, 5ac+', 'lu': 'Pasture {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [LV, 'Barren']), ('p_area', '>', 4046*5), ('s_luz', '==', 'PAS'), ('s_luz', '==', col('p_luz')), ('p_c18_4', '>', col('p_c18_1'))]},
+    {'logic': 's_luz CROP, no cdl conflict, 5ac+', 'lu': 'Cropland {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [LV, 'Barren']), ('p_area', '>', 4046*5), ('s_luz', '==', 'CROP'), ('s_luz', '==', col('p_luz')), ('p_c18_4', '<', col('p_c18_1'))]},
+    # The Extractive (EXT) other impervious/barren rules matched on a nested list and never fired, not carried over.
+    ]
+
+# remaining segments after majority lu (2 of 3)
+REMAINING = [
+    {'logic': 'All remaining Barren', 'lu': 'Developed Barren',
+     'when': [LU_NA, ('Class_name', 'isin', ['Barren'])]},
+    # all remaining herbaceous with building
+    {'logic': 'Remaining LV w/ building in parcel <10ac', 'lu': 'Turf Herbaceous',
+     'when': [LU_NA, ('p_lc_7', '>', 0), ('p_area', '<=', 40468), ('Class_name', 'isin', [LV])]},
+    {'logic': "remaining lv luz 'TG' w/building", 'lu': 'Turf Herbaceous',
+     'when': [LU_NA, ('Class_name', 'isin', [LV]), ('p_lc_7', '>', 0), ('p_luz', '==', 'TG')]},
+    # trees, no build
+    {'logic': 'Remaining LV w/ >30% p_lc_3 no build', 'lu': 'Natural Succession Herbaceous',
+     'when': [LU_NA, ('p_lc_7', '==', 0), ('p_lc_3', '>', col('p_area', 0.3)), ('Class_name', 'isin', [LV, SS])]},
+    {'logic': 'Remaining LV or SS no build EVE or DEC LUZ', 'lu': 'Natural Succession {Class_name}',
+     'when': [LU_NA, ('p_lc_7', '==', 0), ('s_luz', 'isin', ['EVE', 'DEC']), ('Class_name', 'isin', [LV, SS])]},
+    {'logic': 'Remaining SS no limits', 'lu': 'Natural Succession {Class_name}',
+     'when': [LU_NA, ('Class_name', 'isin', [SS])]},
+    ]
+
+# reclass small parcels after remnant adjacency to natural succession
+PASTURE_RECLASS = [
+    # All remaining lv segs with suspended succession if there is no known parcel area (probably roads or public lands)
+    {'logic': 'p_area = 0', 'lu': 'Suspended Succession Herbaceous',
+     'when': [LU_NA, ('p_area', '==', 0), ('Class_name', 'isin', [LV, SS])]},
+    # if pasture in <5 parcel WITH NO build, make nat sus
+    {'logic': 'Reclass Pas to Nat <5ac p', 'lu': 'Natural Succession {Class_name}',
+     'when': [('lu', 'contains', 'Pasture'), ('p_lc_7', '==', 0), ('p_area', '<', 4046*5), ('Class_name', 'isin', [LV, 'Barren', SS])]},
+    # if na or pasture in <5 parcel WITH build, make turf (barren and SS only get the logic, as before)
+    {'logic': 'Reclass Pas to Turf <5ac p w/ building', 'lu': 'Turf Herbaceous',
+     'when': [('or', [('lu', 'contains', 'Pasture'), LU_NA]), ('p_lc_7', '>', 0), ('p_area', '<', 4046*5), ('Class_name', 'isin', [LV])]},
+    {'logic': 'Reclass Pas to Turf <5ac p w/ building', 'lu': None,
+     'when': [('or', [('lu', 'contains', 'Pasture'), LU_NA]), ('p_lc_7', '>', 0), ('p_area', '<', 4046*5), ('Class_name', 'isin', ['Barren', SS])]},
+    ]
+
+# last rules after remnant adjacency to natural succession
+FINAL = [
+    {'logic': 'ag_gen last chance', 'lu': 'Cropland Herbaceous',
+     'when': [LU_NA, ('s_luz', '==', 'AG_GEN'), ('s_area', '>', 10000), ('p_lc_5', '>', col('p_area', 0.5)), ('Class_name', 'isin', [LV])]},
+    # All remaining LV
+    {'logic': 'Whatevers left', 'lu': 'Suspended Succession Herbaceous',
+     'when': [LU_NA, ('Class_name', 'isin', [LV])]},
+    ]
+
+PLANS = {
+    'ruleset1': compile_rules('Ruleset 1', RULESET1),
+    'ag_cdl': compile_rules('ag_cdl', AG_CDL),
+    'natural_succession': compile_rules('natural_succession rules', NATURAL_SUCCESSION),
+    'luz': compile_rules('luz', LUZ),
+    'remaining': compile_rules('remaining lv, barren and ss', REMAINING),
+    'pasture_reclass': compile_rules('p_area = 0 and pasture reclass', PASTURE_RECLASS),
+    'final': compile_rules('ag_gen and whatevers left', FINAL),
+    }
@@ -0,0 +1,107 @@
+"""
+Script: lu_tiles.py
+Purpose: Spatial tiles for the tiled landuse rule chain (landuse_rev2.run_tiled, luconfig.lu_tile_size).
+         Every pseg is owned by one tile (its core). Psegs of a parcel are owned by the tile of the parcel's
+         largest pseg so parcel rules (p_maj_lu) see the whole parcel in exactly one core; psegs without a
+         parcel (PID 0) are a parcel of their own, like in p_maj_lu, and are owned by the tile of their own center.
+         A tile's working set is its core plus a halo closed over the adjacency graph and parcels: every rule step
+         that reads other psegs' state (adjacency_graph or p_maj_lu) can carry state one neighbour or one parcel
+         further, so the halo is expanded by one neighbour ring and to whole parcels once per step.
+         Core results are then the same as a whole county run; halo results are thrown away.
+"""
+import numpy as np
+import pandas as pd
+
+from adjacency import PsegGraph, frontier_edges
+
+
+def parcel_index(pid):
+    """
+    Returns the parcel number of each pseg (0..n-1), every pseg without a parcel (PID 0) is a parcel of its own.
+    """
+    pid = np.asarray(pid)
+    idx, parcels = pd.factorize(pid)
+    idx = idx.astype(np.int64)
+    no_parcel = np.flatnonzero(pid == 0)
+    idx[no_parcel] = len(parcels) + np.arange(len(no_parcel))
+    return pd.factorize(idx)[0].astype(np.int64)
+
+def parcel_members(pidx):
+    """
+    Returns (indptr, members) - CSR of the psegs of every parcel of parcel_index().
+    """
+    members = np.argsort(pidx, kind='stable')
+    indptr = np.zeros(pidx.max() + 2 if len(pidx) > 0 else 1, dtype=np.int64)
+    np.cumsum(np.bincount(pidx, minlength=len(indptr) - 1), out=indptr[1:])
+    return indptr, members
+
+def pseg_tiles(psegs, bounds, pidx, tile_size):
+    """
+    Method: pseg_tiles()
+    Purpose: Owner tile of every pseg, parcels are owned as a whole (see module docstring).
+    Params: psegs - main pseg df with ps_area
+            bounds - n x 4 bounds of the psegs (ie mp_runtime.layer_bounds)
+            pidx - parcel_index() of psegs
+            tile_size - tile width and height in map units
+    Returns: int64 tile id of each pseg
+    """
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    col = np.floor((x - x.min()) / tile_size).astype(np.int64)
+    row = np.floor((y - y.min()) / tile_size).astype(np.int64)
+    tiles = row * (col.max() + 1) + col
+
+    # parcel owner: tile of the largest pseg of the parcel, ties to the first pseg
+    order = np.lexsort((np.arange(len(pidx)), -psegs['ps_area'].values, pidx))
+    first = order[np.r_[True, pidx[order][1:] != pidx[order][:-1]]]
+    owner = np.zeros(pidx.max() + 1, dtype=np.int64)
+    owner[pidx[first]] = tiles[first]
+    return owner[pidx]
+
+def working_set(graph, parcels, pidx, core, reach):
+    """
+    Method: working_set()
+    Purpose: Core psegs of a tile plus the halo they depend on. The halo grows from the psegs added by the previous
+             step only (frontier), through their graph rows and then their whole parcels.
+    Params: graph - county PsegGraph
+            parcels - parcel_members() of pidx
+            pidx - parcel_index() of psegs
+            core - bool array of the tile's core psegs (whole parcels)
+            reach - number of rule steps that read other psegs' state
+    Returns: bool array of the working set
+    """
+    indptr, members = parcels
+    rows = core.copy()
+    frontier = np.flatnonzero(core)
+    for step in range(reach):
+        nbrs = np.unique(graph.indices[frontier_edges(graph, frontier)])
+        new = nbrs[~rows[nbrs]]
+        rows[new] = True
+        p = np.unique(pidx[new])
+        starts, counts = indptr[p], indptr[p + 1] - indptr[p]
+        in_parcels = members[np.repeat(starts - np.r_[0, np.cumsum(counts)[:-1]], counts) + np.arange(counts.sum())]
+        in_parcels = in_parcels[~rows[in_parcels]]
+        rows[in_parcels] = True
+        frontier = np.concatenate([new, in_parcels])
+        if len(frontier) == 0:
+            break
+    return rows
+
+def subgraph(graph, sources, rows):
+    """
+    Method: subgraph()
+    Purpose: Graph of a working set, nodes renumbered to their order in rows. Edges leaving the working set
+             are dropped (only halo psegs lose neighbours).
+    Params: graph - county PsegGraph
+            sources - graph.sources()
+            rows - sorted positions of the working set
+    Returns: PsegGraph
+    """
+    remap = np.full(len(graph), -1, dtype=np.int64)
+    remap[rows] = np.arange(len(rows))
+    keep = (remap[sources] >= 0) & (remap[graph.indices] >= 0)
+    src = remap[sources[keep]]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(rows)), out=indptr[1:])
+    return PsegGraph(graph.psid[rows], graph.perimeter[rows], indptr, remap[graph.indices[keep]].astype(np.int32),
+                     graph.border[keep], graph.nbr_psid[keep])
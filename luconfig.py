@@ -8,6 +8,13 @@ lu_change_csv = r'lu_change/p6lu_change_all_classes.csv'
 TC_Tile_Min = 150000 # thresholds for minimum number of psegs required to generate tiles
 TC_Tile_Max = 500000
 TC_CPUS = 15 # number of cores to be used to help divide total core count and balance processes.
+lcmap_centroid_fallback = False # LCMAP timber harvest: segments smaller than a pixel use the pixel under a surface point
+lu_grow_hops = 1 # hop limit of the region growing rules (shore, building turf, remnant natural succession), 1 is a single adjacency pass
+lu_lazy_geometry = False # keep psegs geometry in an on disk WKB store (temp/psegs_wkb) instead of memory, for the largest counties
+lu_tile_size = None # run the landuse rule chain on spatial tiles of this width (m) in parallel, None runs the county as one frame
+lu_write_logic = False # also write the logic string of the last rule to psegs_lu (derived from the rule events, see provenance.py)
+ta_fractional_res = 2 # tabulate area: rasters with cells larger than this (m) are tabulated on their native grid with exact cell coverage
+ta_native_rasters = {} # tabulate area: generate_TA_dict name -> native resolution raster (under anci_folder) used instead of the 1 m upsampled one, ie {'n16_sid': r'NLCD/NLCD_2016_pashay_maj.tif'}
 
 dest  = f"some_folder"
 azure_test = f"some_other_folder"
@@ -26,6 +33,22 @@ anci_dict = {
     'sucAgeRasPath' : r'lcmap/10m_timbHarv/Sucess_Age_10m.tif', # lcmp succession age
         }
 
+# county partitioned copy of the anci_dict vector layers, built by `python anci_store.py` (see anci_store.py)
+anci_store = f'{anci_folder}/anci_store'
+county_shp = r'census/BayCounties20m_project.shp' # county boundaries (GEOID) used to partition the store
+
+# county clips of the watershed wide rasters, built by `python ras_store.py` (see ras_store.py)
+ras_store = f'{anci_folder}/ras_store'
+ras_dict = {
+    'timHar' : anci_dict['timHarRasPath'],
+    'sucAge' : anci_dict['sucAgeRasPath'],
+    'cdl1719' : r'CDL/CDL_2017_2019_4class_maj_1m.tif',
+    'cdl18' : r'CDL/cdl_2018_4class_maj_1m.tif',
+    'nlcd16' : r'NLCD/NLCD_2016_pashay_maj_1m.tif',
+    'rail' : r'rail/rail_baywide.tif',
+    'slr' : r'wetlands/SLR_1.tif',
+        }
+
 
 dp_file_list = [
         f"psegs.gpkg",
@@ -38,6 +61,14 @@ dp_file_list = [
 
 LUZ_values = ['AG_GEN', 'BAR', 'CAFO', 'CATT', 'CENT', 'CONS', 'CROP', 'DEC', 'EVE', 'EXT', 'FALL', 'NAT', 'OV', 'PAS', 'POUL', 'SUS', 'TG', 'TIM', 'WAT', 'WET', 'WET_NT', 'WET_T', 'no_luz']
 
+# land cover classes of the psegs Class_name field, fixed category table for Class_name (see lu_codes.py)
+LC_classes = ['Water', 'Emergent Wetlands', 'Tree Canopy', 'Scrub\\Shrub', 'Low Vegetation', 'Barren', 'Buildings',
+    'Other Impervious Surfaces', 'Roads', 'Tree Canopy Over Structures', 'Tree Canopy Over Other Impervious Surfaces', 'Tree Canopy Over Roads']
+
+# lu prefixes assigned by landuse rules as "{prefix} {Class_name}", used with LC_classes to build the lu category table
+lu_prefixes = ['Turf', 'Developed', 'Shore', 'Solar', 'Suspended Succession', 'Natural Succession', 'Natural',
+    'Harvested Forest', 'Pasture', 'Cropland', 'Orchard/Vineyard']
+
 lu_code_dict = {
     'Roads' : 2110,
     'Buildings' : 2120, 
@@ -22,6 +22,8 @@ import landuse_rev2 as landuse
 import tc.TC_LU_Submodule_noq_v1 as trees_over
 from tc.createTiles_v1 import createTiles
 import burn_in
+import mp_runtime
+import anci_store
 import lu_change.lu_change_vector_v1_callable as lu_change_module
 
 def intro(cflist):
@@ -85,6 +87,8 @@ if __name__ == "__main__":
     etime("batch", "mount blobfuse", fuse_st)
 
     for cf in cflist: # replace with args/CLI after testing
+        mp_runtime.shutdown_runtime() # one worker runtime per county, release the previous county's
+        anci_store.clear_cache()
         print('--Main.py Test:', test, type(test))
         print("--batch_size: ", batch_size)
         cf_st = time.time()
@@ -162,4 +166,6 @@ if __name__ == "__main__":
         etime(cf, "Copied outputs to blobfuse", copy_st2)
 
 
-        etime("batch", f"{cf} Completed full run", cf_st)
\ No newline at end of file
+        etime("batch", f"{cf} Completed full run", cf_st)
+
+    mp_runtime.shutdown_runtime()
@@ -0,0 +1,431 @@
+"""
+Script: mp_runtime.py
+Purpose: Long-lived multiprocessing runtime shared by the landuse, burn in and TC spatial helpers.
+         One worker pool is started per county run. Geometry is published once as WKB (plus a
+         bounds array) in shared memory and workers attach to it by name, so repeated sjoin and
+         adjacency calls only send index arrays to the workers instead of pickled GeoDataFrames.
+"""
+import os
+import time
+import atexit
+import itertools
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+
+import numpy as np
+import pandas as pd
+import shapely
+
+#####################################################################################
+#------------------------------ SHARED ARRAYS --------------------------------------#
+#####################################################################################
+class SharedArray:
+    """
+    Picklable handle to a numpy array living in a shared memory block.
+    Only the block name, dtype and shape are sent to the workers.
+    """
+    def __init__(self, name, dtype, shape):
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+
+    def attach(self):
+        """
+        Method: attach()
+        Purpose: Map the shared block into the current process.
+        Returns: (array, shm) - array view of the block and the SharedMemory handle keeping it alive
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        ary = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+        return ary, shm
+
+
+class MappedArray:
+    """
+    Picklable handle to a read only, memory mapped array on disk (.npy, or a raw uint8 file).
+    Same attach() interface as SharedArray.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+
+    def attach(self):
+        if self.path.endswith('.npy'):
+            return np.load(self.path, mmap_mode='r'), None
+        if os.path.getsize(self.path) == 0:
+            return np.empty(0, dtype=np.uint8), None
+        return np.memmap(self.path, dtype=np.uint8, mode='r'), None
+
+
+class SharedLayer:
+    """
+    Picklable handle to a published geometry layer.
+    Params: key - layer name used by the callers (ie 'psegs')
+            version - incremented every time a key is (re)published, used to expire worker caches
+            n - number of geometries
+            wkb - SharedArray (or MappedArray) of the concatenated WKB bytes
+            offsets - SharedArray of WKB offsets (n + 1)
+            bounds - SharedArray of geometry bounds (n x 4)
+            cache_geoms - keep decoded geometries in the workers, False decodes them on every request
+    """
+    def __init__(self, key, version, n, wkb, offsets, bounds, cache_geoms=True):
+        self.key = key
+        self.version = version
+        self.n = n
+        self.wkb = wkb
+        self.offsets = offsets
+        self.bounds = bounds
+        self.cache_geoms = cache_geoms
+
+
+#####################################################################################
+#------------------------------ WORKER SIDE ----------------------------------------#
+#####################################################################################
+_worker_layers = {} # key -> dict of cached arrays/geometries for the attached version
+
+def _layer_cache(layer):
+    """
+    Method: _layer_cache()
+    Purpose: Attach a published layer in the current process, reusing the cached copy if the
+             version has not changed. Geometries are decoded lazily as they are requested.
+    Params: layer - SharedLayer
+    Returns: cache - dict with wkb, offsets, bounds, geoms, decoded and tree
+    """
+    cache = _worker_layers.get(layer.key)
+    if cache is not None and cache['version'] == layer.version:
+        return cache
+    if cache is not None:
+        _release_cache(layer.key)
+
+    wkb, wkb_shm = layer.wkb.attach()
+    offsets, off_shm = layer.offsets.attach()
+    bounds, bnd_shm = layer.bounds.attach()
+    cache = {
+        'version': layer.version,
+        'wkb': wkb,
+        'offsets': offsets,
+        'bounds': bounds,
+        'geoms': np.empty(layer.n, dtype=object),
+        'decoded': np.zeros(layer.n, dtype=bool),
+        'tree': None,
+        'shm': [wkb_shm, off_shm, bnd_shm],
+        }
+    _worker_layers[layer.key] = cache
+    return cache
+
+def _release_cache(key):
+    cache = _worker_layers.pop(key, None)
+    if cache is None:
+        return
+    for k in ('wkb', 'offsets', 'bounds'):
+        cache[k] = None
+    for shm in cache['shm']:
+        if shm is None:
+            continue # memory mapped file
+        try:
+            shm.close()
+        except BufferError:
+            pass # a view is still referenced, block is freed when the process exits
+
+def decode_geoms(layer, idx):
+    """
+    Returns shapely geometries of a published layer for the requested positions, decoded without caching
+    (ie for a subset needed once in the main process).
+    """
+    cache = _layer_cache(layer)
+    offsets = cache['offsets']
+    buf = cache['wkb']
+    return shapely.from_wkb([buf[offsets[i]:offsets[i + 1]].tobytes() for i in np.asarray(idx, dtype=np.int64)])
+
+def layer_geoms(layer, idx):
+    """
+    Method: layer_geoms()
+    Purpose: Return shapely geometries of a published layer for the requested positions,
+             decoding WKB from shared memory only for positions not decoded yet. Layers published
+             with cache_geoms=False (file backed psegs of the geometry-lazy mode) are decoded every call.
+    Params: layer - SharedLayer
+            idx - array of positions in the layer
+    Returns: numpy array of shapely geometries
+    """
+    if not layer.cache_geoms:
+        return decode_geoms(layer, idx)
+    cache = _layer_cache(layer)
+    idx = np.asarray(idx, dtype=np.int64)
+    todo = np.unique(idx[~cache['decoded'][idx]])
+    if len(todo) > 0:
+        offsets = cache['offsets']
+        buf = cache['wkb']
+        wkbs = [buf[offsets[i]:offsets[i + 1]].tobytes() for i in todo]
+        cache['geoms'][todo] = shapely.from_wkb(wkbs)
+        cache['decoded'][todo] = True
+    return cache['geoms'][idx]
+
+def layer_bounds(layer):
+    """
+    Returns a copy of the bounds (n x 4) of a published layer.
+    """
+    return np.array(_layer_cache(layer)['bounds'])
+
+def layer_tree(layer):
+    """
+    Method: layer_tree()
+    Purpose: STRtree over the bounding boxes of a published layer, built once per worker.
+             Queries return bbox candidates; exact predicates are evaluated on the pairs after.
+    Params: layer - SharedLayer
+    Returns: shapely STRtree
+    """
+    cache = _layer_cache(layer)
+    if cache['tree'] is None:
+        b = cache['bounds']
+        cache['tree'] = shapely.STRtree(shapely.box(b[:, 0], b[:, 1], b[:, 2], b[:, 3]))
+    return cache['tree']
+
+def query_pairs(left, left_idx, right, right_mask=None, predicate='intersects'):
+    """
+    Method: query_pairs()
+    Purpose: Spatial join of a subset of one published layer against another (or the same) layer.
+    Params: left - SharedLayer of the left geometries
+            left_idx - positions in left to join
+            right - SharedLayer of the right geometries
+            right_mask - SharedArray (bool, len right.n) of right positions allowed in the join, None for all
+            predicate - shapely binary predicate name; 'intersects', 'within', 'contains', ... (left.predicate(right))
+    Returns: (left_pos, right_pos) - arrays of matching positions
+    """
+    left_idx = np.asarray(left_idx, dtype=np.int64)
+    lg = layer_geoms(left, left_idx)
+    li, ri = layer_tree(right).query(lg)
+    if right_mask is not None:
+        mask, shm = right_mask.attach()
+        keep = mask[ri].copy()
+        del mask
+        shm.close()
+        li, ri = li[keep], ri[keep]
+    if predicate is not None and len(li) > 0:
+        keep = getattr(shapely, predicate)(lg[li], layer_geoms(right, ri))
+        li, ri = li[keep], ri[keep]
+    return left_idx[li], ri
+
+def _query_task(args):
+    left, left_idx, right, right_mask, predicate = args
+    return query_pairs(left, left_idx, right, right_mask, predicate)
+
+
+#####################################################################################
+#------------------------------ RUNTIME --------------------------------------------#
+#####################################################################################
+class WorkerRuntime:
+    """
+    One long-lived pool plus the shared memory blocks published to it.
+    Use get_runtime() rather than building one directly so a county run shares a single runtime.
+    """
+    _versions = itertools.count(1)
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pid = os.getpid()
+        # start the resource tracker before forking so workers attaching to blocks share it,
+        # otherwise each worker starts its own tracker and unlinks the blocks when it exits
+        resource_tracker.ensure_running()
+        self.pool = mp.Pool(processes=processes)
+        self.layers = {} # key -> SharedLayer
+        self.arrays = {} # key -> SharedArray
+        self._blocks = {} # key -> list of SharedMemory owned by this process
+        self.closed = False
+        print(f'--Started worker runtime with {processes} processes')
+
+    def _share(self, ary):
+        ary = np.ascontiguousarray(ary)
+        shm = shared_memory.SharedMemory(create=True, size=max(ary.nbytes, 1))
+        view = np.ndarray(ary.shape, dtype=ary.dtype, buffer=shm.buf)
+        view[...] = ary
+        del view
+        return SharedArray(shm.name, ary.dtype.str, ary.shape), shm
+
+    def publish(self, key, geoms):
+        """
+        Method: publish()
+        Purpose: Publish geometries to shared memory as WKB. Republishing a key replaces it.
+        Params: key - name of layer
+                geoms - GeoSeries, GeometryArray or array of shapely geometries
+        Returns: SharedLayer handle
+        """
+        pt = time.time()
+        self.release(key)
+        geoms = np.asarray(getattr(geoms, 'values', geoms), dtype=object)
+        wkb = shapely.to_wkb(geoms)
+        lengths = np.fromiter((len(w) for w in wkb), dtype=np.int64, count=len(wkb))
+        offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        buf = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+        del wkb
+
+        wkb_sa, wkb_shm = self._share(buf)
+        off_sa, off_shm = self._share(offsets)
+        bnd_sa, bnd_shm = self._share(shapely.bounds(geoms))
+        self._blocks[key] = [wkb_shm, off_shm, bnd_shm]
+        layer = SharedLayer(key, next(self._versions), len(geoms), wkb_sa, off_sa, bnd_sa)
+        self.layers[key] = layer
+        print(f'----Published {key}: {len(geoms)} geometries ({round(buf.nbytes / 1e6, 1)} MB WKB) in {round(time.time()-pt, 2)} seconds')
+        return layer
+
+    def publish_store(self, key, store):
+        """
+        Method: publish_store()
+        Purpose: Publish a geom_store.GeometryStore as a file backed layer. Workers memory map the store
+                 files instead of a shared memory copy and do not cache decoded geometries.
+        Params: key - name of layer
+                store - GeometryStore
+        Returns: SharedLayer handle
+        """
+        self.release(key)
+        layer = SharedLayer(key, next(self._versions), len(store), *[MappedArray(p) for p in store.paths()], cache_geoms=False)
+        self.layers[key] = layer
+        print(f'----Published {key}: {len(store)} geometries from {store.folder}')
+        return layer
+
+    def share_array(self, key, ary):
+        """
+        Method: share_array()
+        Purpose: Publish an attribute or mask array to shared memory.
+        Params: key - name of array
+                ary - numpy array
+        Returns: SharedArray handle
+        """
+        self.release(key)
+        sa, shm = self._share(ary)
+        self._blocks[key] = [shm]
+        self.arrays[key] = sa
+        return sa
+
+    def release(self, key):
+        """
+        Method: release()
+        Purpose: Unlink the shared memory behind a published layer or array, and drop the copy attached in this
+                 process (layer_bounds, decode_geoms and layer_tree called from the parent).
+        """
+        _release_cache(key)
+        self.layers.pop(key, None)
+        self.arrays.pop(key, None)
+        for shm in self._blocks.pop(key, []):
+            shm.close()
+            shm.unlink()
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def imap(self, func, iterable):
+        """
+        Ordered, lazy map: results are handed back one at a time in task order (ie to write them as they arrive).
+        """
+        return self.pool.imap(func, iterable)
+
+    def chunks(self, idx, batch_size):
+        """
+        Method: chunks()
+        Purpose: Split an index array into chunks of at most batch_size, using at least one chunk per process.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        if len(idx) == 0:
+            return []
+        size = min(batch_size, int(len(idx) / self.processes) + 1)
+        return [idx[i:i + size] for i in range(0, len(idx), size)]
+
+    def query(self, left_key, left_idx, right_key, right_idx=None, predicate='intersects', batch_size=100000):
+        """
+        Method: query()
+        Purpose: Multiprocessed spatial join between published layers, sending only index arrays.
+        Params: left_key - published layer of left geometries
+                left_idx - positions in left layer to join
+                right_key - published layer of right geometries
+                right_idx - positions in right layer allowed in the join, None for the whole layer
+                predicate - 'intersects', 'within', 'contains', ...
+                batch_size - max positions per task
+        Returns: (left_pos, right_pos) - arrays of matching positions
+        """
+        left = self.layers[left_key]
+        right = self.layers[right_key]
+        right_mask = None
+        if right_idx is not None:
+            mask = np.zeros(right.n, dtype=bool)
+            mask[np.asarray(right_idx, dtype=np.int64)] = True
+            right_mask = self.share_array(f'_{right_key}_mask', mask)
+
+        chunk_iterator = [(left, c, right, right_mask, predicate) for c in self.chunks(left_idx, batch_size)]
+        results = self.map(_query_task, chunk_iterator)
+        if right_mask is not None:
+            self.release(f'_{right_key}_mask')
+        if len(results) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def sjoin_frames(self, df1, df2, sjoin_op, sjoinCols, batch_size=100000):
+        """
+        Method: sjoin_frames()
+        Purpose: sjoin two (Geo)DataFrames on the runtime and keep the requested columns, matching
+                 the output of the old sjoin_mp6 helpers. Both frames are published for the call only.
+        Params: df1 - left gdf
+                df2 - right gdf
+                sjoin_op - 'intersects', 'within', 'contains'
+                sjoinCols - list of column names to retain
+                batch_size - max left rows per task
+        Returns: sjoinSeg - df of sjoined data with sjoinCols retained and duplicates dropped
+        """
+        if len(df1) == 0:
+            print('df1 is empty')
+        self.publish('_sjoin_left', df1.geometry)
+        self.publish('_sjoin_right', df2.geometry)
+        lp, rp = self.query('_sjoin_left', np.arange(len(df1)), '_sjoin_right', None, sjoin_op, batch_size)
+        self.release('_sjoin_left')
+        self.release('_sjoin_right')
+
+        # same suffix handling as gpd.sjoin for columns in both frames
+        shared = (set(df1.columns) & set(df2.columns)) - {'geometry'}
+        data = {}
+        for col in df1.columns:
+            if col != 'geometry':
+                data[f'{col}_left' if col in shared else col] = df1[col].values[lp]
+        for col in df2.columns:
+            if col != 'geometry':
+                data[f'{col}_right' if col in shared else col] = df2[col].values[rp]
+        sjoinSeg = pd.DataFrame(data)[sjoinCols]
+        sjoinSeg.drop_duplicates(inplace=True)
+        return sjoinSeg
+
+    def close(self):
+        if self.closed:
+            return
+        for key in set(self._blocks) | set(self.layers): # file backed layers have no blocks
+            self.release(key)
+        self.pool.close()
+        self.pool.join()
+        self.closed = True
+
+
+_runtime = None
+
+def get_runtime(processes=None):
+    """
+    Method: get_runtime()
+    Purpose: Return the runtime for the current process, starting it on first use. Forked children
+             (ie TC tile workers) get their own runtime instead of the parent's pool.
+    Params: processes - pool size used when the runtime is started, default cpu_count - 1
+    Returns: WorkerRuntime
+    """
+    global _runtime
+    if _runtime is None or _runtime.closed or _runtime.pid != os.getpid():
+        if processes is None:
+            processes = mp.cpu_count() - 1
+        _runtime = WorkerRuntime(max(int(processes), 1))
+    return _runtime
+
+def shutdown_runtime():
+    """
+    Method: shutdown_runtime()
+    Purpose: Close the pool and unlink all shared memory of the current process' runtime.
+    """
+    global _runtime
+    if _runtime is not None and _runtime.pid == os.getpid():
+        _runtime.close()
+    _runtime = None
+
+atexit.register(shutdown_runtime)
@@ -0,0 +1,93 @@
+"""
+Script: overlay.py
+Purpose: In-process segment by parcel overlay building the psegs for data_prep.py, in place of loading both layers
+         into PostGIS and running ST_Intersection in PID ranges. Segments and parcels are published once on the
+         worker runtime (mp_runtime), parcels are partitioned into spatially compact chunks (grid cells of their
+         centers) and every worker intersects a chunk with its candidate segments from the STRtree of the segment
+         bounds. Intersections are exploded to single polygons with area (edge and corner touches are dropped), the
+         same psegs the PostGIS path produced after fixing geometries and splitting multiparts.
+         psegs are returned in (PID, SID) order, PSIDs are numbered in that order, so the output does not depend on
+         the partitioning or the number of processes.
+"""
+import time
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+import mp_runtime
+
+
+def spatial_chunks(bounds, batch_size, cell_size):
+    """
+    Method: spatial_chunks()
+    Purpose: Partition features into spatially compact chunks: features are ordered by the grid cell of their
+             bbox center (row by row, cells of cell_size map units) and cut into chunks of at most batch_size.
+    Params: bounds - n x 4 bounds of the features
+            batch_size - max features per chunk
+            cell_size - grid cell width and height in map units
+    Returns: list of int64 position arrays
+    """
+    if len(bounds) == 0:
+        return []
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    col = np.floor((x - x.min()) / cell_size).astype(np.int64)
+    row = np.floor((y - y.min()) / cell_size).astype(np.int64)
+    order = np.lexsort((x, col, row))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def overlay_part(segs, parcels, idx):
+    """
+    Method: overlay_part()
+    Purpose: Intersect a chunk of parcels with the segments. Geometries are decoded for the chunk only (not cached)
+             so worker memory is bound by the chunk.
+    Params: segs - SharedLayer of the segments
+            parcels - SharedLayer of the parcels
+            idx - parcel positions of the chunk
+    Returns: (seg_pos, parcel_pos, wkb) - segment and parcel position and WKB of every single polygon part
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    pg = mp_runtime.decode_geoms(parcels, idx)
+    pi, si = mp_runtime.layer_tree(segs).query(pg) # bbox candidates
+    sg = mp_runtime.decode_geoms(segs, si)
+    hit = shapely.intersects(sg, pg[pi])
+    pi, si, sg = pi[hit], si[hit], sg[hit]
+    parts, part_idx = shapely.get_parts(shapely.intersection(sg, pg[pi]), return_index=True)
+    keep = (shapely.get_type_id(parts) == 3) & (shapely.area(parts) > 0) # polygons, not touching lines/points
+    return si[part_idx[keep]], idx[pi[part_idx[keep]]], shapely.to_wkb(parts[keep])
+
+def _overlay_task(args):
+    segs, parcels, idx = args
+    return overlay_part(segs, parcels, idx)
+
+def overlay_psegs(segs, parcels, runtime, batch_size=20000, cell_size=2000):
+    """
+    Method: overlay_psegs()
+    Purpose: Build the psegs, the intersection of the land cover segments and the parcels, on the worker runtime.
+    Params: segs - segments gdf with SID and Class_name
+            parcels - parcels gdf with PID
+            runtime - mp_runtime.WorkerRuntime
+            batch_size - max parcels per task
+            cell_size - grid cell size (map units) of the spatial partitioning
+    Returns: psegs gdf of SID, PID, Class_name, PSID (1..n) and geometry, the psegs input of the landuse stage
+    """
+    ot = time.time()
+    seg_layer = runtime.publish('_overlay_segs', segs.geometry)
+    parcel_layer = runtime.publish('_overlay_parcels', parcels.geometry)
+    chunks = spatial_chunks(mp_runtime.layer_bounds(parcel_layer), min(batch_size, int(len(parcels) / runtime.processes) + 1), cell_size)
+    results = runtime.map(_overlay_task, [(seg_layer, parcel_layer, c) for c in chunks])
+    runtime.release('_overlay_segs')
+    runtime.release('_overlay_parcels')
+
+    si = np.concatenate([r[0] for r in results]) if results else np.empty(0, dtype=np.int64)
+    pi = np.concatenate([r[1] for r in results]) if results else np.empty(0, dtype=np.int64)
+    wkb = np.concatenate([r[2] for r in results]) if results else np.empty(0, dtype=object)
+    pid = parcels['PID'].values.astype(np.int32)[pi]
+    sid = segs['SID'].values.astype(np.int32)[si]
+    order = np.lexsort((sid, pid)) # stable, parts of one (SID, PID) pair keep their order
+    psegs = gpd.GeoDataFrame({'SID': sid[order], 'PID': pid[order], 'Class_name': segs['Class_name'].values[si[order]],
+                              'PSID': np.arange(1, len(order) + 1, dtype=np.int32)},
+                             geometry=shapely.from_wkb(wkb[order]), crs=segs.crs)
+    print(f'----Overlay: {len(psegs)} psegs from {len(segs)} segments and {len(parcels)} parcels in {round(time.time()-ot, 2)} seconds')
+    return psegs
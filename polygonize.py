@@ -0,0 +1,203 @@
+"""
+Script: polygonize.py
+Purpose: Tiled raster to polygon conversion shared by data_prep, raster_psegs, burn_in and lu_change. The grid is cut
+         into tiles aligned to the raster blocks and every tile is polygonized on its own (rasterio.features.shapes,
+         on the worker runtime when one is given), so a worker only ever holds one tile. Polygons that do not touch
+         an inner tile edge are final and handed back (or written) as their tile finishes; polygons on a seam are
+         merged by label once all tiles are done.
+         Tiles are polygonized in pixel coordinates, so both sides of a seam share exact vertex coordinates and the
+         merge is exact; polygons are moved to map coordinates when they are handed back. Seam parts of a label are
+         unioned and split into connected parts again, parts touching only at a corner stay separate like in the
+         4 connected shapes() output.
+         Cells equal to 0 (and the raster nodata) are not polygonized.
+"""
+import itertools
+
+import geopandas as gpd
+import numpy as np
+import pyogrio
+import rasterio as rio
+import shapely
+from affine import Affine
+from rasterio.features import shapes
+from rasterio.windows import Window
+
+
+def tile_windows(height, width, tile_size, block_shape=(1, 1)):
+    """
+    Returns (row_off, col_off, height, width) of the tiles of a grid, tile_size rounded up to whole blocks.
+    """
+    th = -(-tile_size // block_shape[0]) * block_shape[0]
+    tw = -(-tile_size // block_shape[1]) * block_shape[1]
+    return [(r, c, min(th, height - r), min(tw, width - c)) for r in range(0, height, th) for c in range(0, width, tw)]
+
+def read_tile(source, window):
+    """
+    Returns the cells of a tile and the mask of the cells to polygonize.
+    source - ('array', mp_runtime.SharedArray), ('local', in process array) or ('path', raster path)
+    """
+    kind, src = source
+    row_off, col_off, h, w = window
+    if kind == 'local':
+        tile = src[row_off:row_off + h, col_off:col_off + w]
+        return tile, tile != 0
+    if kind == 'array':
+        ary, shm = src.attach()
+        tile = np.array(ary[row_off:row_off + h, col_off:col_off + w])
+        del ary
+        shm.close()
+        return tile, tile != 0
+    with rio.open(src) as ras:
+        tile = ras.read(1, window=Window(col_off, row_off, w, h))
+        mask = tile != 0
+        if ras.nodata is not None:
+            mask &= tile != ras.nodata
+    return tile, mask
+
+def build_polygons(rings, ring_poly):
+    """
+    Builds polygons from shapes() rings in one call (instead of one shapely.geometry.shape per polygon).
+    rings - coordinate lists, the shell of every polygon followed by its holes
+    ring_poly - polygon index of each ring
+    """
+    if len(rings) == 0:
+        return np.empty(0, dtype=object)
+    lengths = np.fromiter((len(r) for r in rings), dtype=np.int64, count=len(rings))
+    coords = np.array(list(itertools.chain.from_iterable(rings)), dtype=np.float64)
+    lr = shapely.linearrings(coords, indices=np.repeat(np.arange(len(rings)), lengths))
+    return shapely.polygons(lr, indices=np.asarray(ring_poly, dtype=np.int64))
+
+def polygonize_tile(source, window, shape):
+    """
+    Method: polygonize_tile()
+    Purpose: Polygons of one tile in pixel coordinates of the whole grid.
+    Params: source - see read_tile()
+            window - (row_off, col_off, height, width) of the tile
+            shape - (height, width) of the grid
+    Returns: (values, wkb, seam) - label, WKB and whether the polygon touches an inner tile edge
+    """
+    row_off, col_off, h, w = window
+    tile, mask = read_tile(source, window)
+    if tile.dtype not in (np.int16, np.int32, np.uint8, np.uint16, np.float32):
+        tile = tile.astype(np.int32)
+    values, rings, ring_poly = [], [], []
+    for geom, value in shapes(tile, mask=mask, connectivity=4, transform=Affine(1, 0, col_off, 0, 1, row_off)):
+        rings.extend(geom['coordinates'])
+        ring_poly.extend([len(values)] * len(geom['coordinates']))
+        values.append(value)
+    del tile, mask
+    geoms = build_polygons(rings, ring_poly)
+    b = shapely.bounds(geoms).reshape(-1, 4)
+    seam = ((b[:, 0] == col_off) & (col_off > 0)) | ((b[:, 2] == col_off + w) & (col_off + w < shape[1])) | \
+           ((b[:, 1] == row_off) & (row_off > 0)) | ((b[:, 3] == row_off + h) & (row_off + h < shape[0]))
+    return np.asarray(values, dtype=np.int64), shapely.to_wkb(geoms), seam
+
+def _tile_task(args):
+    source, window, shape = args
+    return polygonize_tile(source, window, shape)
+
+def stitch(values, geoms):
+    """
+    Method: stitch()
+    Purpose: Merge the seam polygons of all tiles by label.
+    Params: values - label of each polygon
+            geoms - seam polygons (pixel coordinates)
+    Returns: (values, geoms) of the merged polygons
+    """
+    if len(values) == 0:
+        return values, geoms
+    order = np.argsort(values, kind='stable')
+    values, geoms = values[order], geoms[order]
+    labels, first, counts = np.unique(values, return_index=True, return_counts=True)
+    out_values, out_geoms = [values[first[counts == 1]]], [geoms[first[counts == 1]]]
+    for label, s, n in zip(labels[counts > 1], first[counts > 1], counts[counts > 1]):
+        parts = shapely.get_parts(shapely.union_all(geoms[s:s + n]))
+        out_values.append(np.full(len(parts), label, dtype=np.int64))
+        out_geoms.append(parts)
+    return np.concatenate(out_values), np.concatenate(out_geoms)
+
+def iter_polygons(source, shape, transform, tile_size=2048, block_shape=(1, 1), runtime=None):
+    """
+    Method: iter_polygons()
+    Purpose: Polygonize a grid tile by tile.
+    Params: source - see read_tile()
+            shape - (height, width) of the grid
+            transform - affine transform of the grid
+            tile_size - tile rows/cols (rounded up to whole blocks)
+            block_shape - (rows, cols) of the raster blocks
+            runtime - optional mp_runtime.WorkerRuntime, tiles are polygonized in its workers
+    Returns: generator of (values, geoms) batches in map coordinates: the final polygons of every tile in tile order,
+             then the merged seam polygons
+    """
+    tasks = [(source, w, shape) for w in tile_windows(shape[0], shape[1], tile_size, block_shape)]
+    results = runtime.imap(_tile_task, tasks) if runtime is not None else map(_tile_task, tasks)
+    to_map = lambda geoms: shapely.transform(geoms, lambda xy: np.column_stack(transform * (xy[:, 0], xy[:, 1])))
+    seam_values, seam_geoms = [], []
+    for values, wkb, seam in results:
+        geoms = shapely.from_wkb(wkb)
+        seam_values.append(values[seam])
+        seam_geoms.append(geoms[seam])
+        if (~seam).any():
+            yield values[~seam], to_map(geoms[~seam])
+    if len(seam_values) > 0:
+        values, geoms = stitch(np.concatenate(seam_values), np.concatenate(seam_geoms))
+        if len(values) > 0:
+            yield values, to_map(geoms)
+
+def polygonize_array(ary, transform, tile_size=2048, runtime=None):
+    """
+    Method: polygonize_array()
+    Purpose: Polygons of the non zero regions of an in memory array (same regions as shapes(ary, mask=ary != 0,
+             connectivity=4)).
+    Params: ary - 2d array of labels
+            transform - affine transform of the array
+            tile_size - tile rows/cols
+            runtime - optional mp_runtime.WorkerRuntime, the array is shared with its workers for the call
+    Returns: (values, geoms) - label and polygon of every region
+    """
+    source = ('array', runtime.share_array('_polygonize', ary)) if runtime is not None else ('local', ary)
+    try:
+        batches = list(iter_polygons(source, ary.shape, transform, tile_size, runtime=runtime))
+    finally:
+        if runtime is not None:
+            runtime.release('_polygonize')
+    if len(batches) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=object)
+    return np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+
+def polygonize_raster(ras_path, tile_size=2048, runtime=None):
+    """
+    Method: polygonize_raster()
+    Purpose: Polygons of the labelled regions of a raster, tiles read from the file by the workers.
+    Params: ras_path - raster path
+            tile_size - tile rows/cols (rounded up to whole raster blocks)
+            runtime - optional mp_runtime.WorkerRuntime
+    Returns: (values, geoms) - label and polygon of every region
+    """
+    with rio.open(ras_path) as src:
+        shape, transform, block_shape = src.shape, src.transform, src.block_shapes[0]
+    batches = list(iter_polygons(('path', str(ras_path)), shape, transform, tile_size, block_shape, runtime))
+    if len(batches) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=object)
+    return np.concatenate([b[0] for b in batches]), np.concatenate([b[1] for b in batches])
+
+def polygonize_to_file(ras_path, out_path, layer, field='VALUE', tile_size=2048, runtime=None):
+    """
+    Method: polygonize_to_file()
+    Purpose: Polygonize a raster straight to a vector layer, every batch is appended as it is done.
+    Params: ras_path - raster path
+            out_path - output gpkg
+            layer - output layer name
+            field - name of the label field
+            tile_size - tile rows/cols (rounded up to whole raster blocks)
+            runtime - optional mp_runtime.WorkerRuntime
+    Returns: number of polygons written
+    """
+    with rio.open(ras_path) as src:
+        shape, transform, block_shape, crs = src.shape, src.transform, src.block_shapes[0], src.crs
+    n = 0
+    for values, geoms in iter_polygons(('path', str(ras_path)), shape, transform, tile_size, block_shape, runtime):
+        gdf = gpd.GeoDataFrame({field: values}, geometry=geoms, crs=crs)
+        pyogrio.write_dataframe(gdf, out_path, layer=layer, driver='GPKG', promote_to_multi=False, append=n > 0)
+        n += len(gdf)
+    return n
@@ -0,0 +1,204 @@
+"""
+Script: provenance.py
+Purpose: Rule provenance of the landuse stage, replacing the logic string column. Every rule that classifies
+         psegs records one event (psegs positions, rule id) in the event log of the run. Rule ids are stable
+         across counties (crc32 of the rule label), so the event tables of all counties can be analysed with
+         one rule catalogue. The logic of a pseg (label of its last event) is only derived on request
+         (logic_labels, luconfig.lu_write_logic).
+
+         Output (landuse_rev2.RUN): psegs_lu carries rule_id (last rule of each pseg), the lu_rules layer holds
+         the catalogue (rule_id, logic, with_class) and lu_events the events (PSID, rule_id, order), order is
+         1 for the first rule that classified a pseg, 2 for the next, ...
+
+         The event log of the current process is module level like the worker runtime (mp_runtime): start()
+         once psegs rows are final (datacheck), record() from the rules. Tiles of the tiled rule chain run on a
+         subset() of the log and hand back the events recorded since.
+"""
+import zlib
+
+import numpy as np
+import pandas as pd
+
+_log = None
+
+
+def rule_id(label, with_class=False):
+    """
+    Returns the stable id of a rule label (with_class rules append the pseg Class_name to the label).
+    """
+    return zlib.crc32(f'{label}|{int(with_class)}'.encode()) & 0x7fffffff
+
+
+class EventLog:
+    """
+    Events of one run in record order.
+    Params: n - number of psegs
+    """
+    def __init__(self, n):
+        self.n = n
+        self.positions = [] # int32 positions of each event
+        self.rules = [] # rule id of each event
+        self.catalogue = {} # rule id -> (label, with_class)
+
+    def record(self, positions, label, with_class=False):
+        rid = rule_id(label, with_class)
+        self.catalogue[rid] = (label, with_class)
+        positions = np.asarray(positions, dtype=np.int32)
+        if len(positions) > 0:
+            self.positions.append(positions)
+            self.rules.append(rid)
+
+    def extend(self, other, positions):
+        """
+        Append the events of another log (ie of a tile) whose positions map to positions in this log,
+        events of psegs mapped to -1 are dropped.
+        """
+        self.catalogue.update(other.catalogue)
+        for pos, rid in zip(other.positions, other.rules):
+            pos = positions[pos]
+            pos = pos[pos >= 0]
+            if len(pos) > 0:
+                self.positions.append(pos.astype(np.int32))
+                self.rules.append(rid)
+
+    def subset(self, rows):
+        """
+        Returns a log of the psegs at positions rows (ie a tile working set), renumbered to their order in rows.
+        """
+        remap = np.full(self.n, -1, dtype=np.int64)
+        remap[rows] = np.arange(len(rows))
+        sub = EventLog(len(rows))
+        sub.extend(self, remap)
+        return sub
+
+    def since(self, start):
+        """
+        Returns a log of the events recorded after the first start events (chunks).
+        """
+        new = EventLog(self.n)
+        new.catalogue = dict(self.catalogue)
+        new.positions, new.rules = self.positions[start:], self.rules[start:]
+        return new
+
+    @classmethod
+    def from_arrays(cls, n, positions, rules, catalogue):
+        """
+        Rebuild a log from arrays() and its catalogue (ie a checkpoint), one chunk per run of equal rule ids.
+        """
+        log = cls(n)
+        log.catalogue = dict(catalogue)
+        bounds = np.r_[0, np.flatnonzero(rules[1:] != rules[:-1]) + 1, len(rules)] if len(rules) > 0 else [0]
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            log.positions.append(np.asarray(positions[s:e], dtype=np.int32))
+            log.rules.append(int(rules[s]))
+        return log
+
+    def arrays(self):
+        """
+        Returns (positions, rule ids) of every event in record order.
+        """
+        if len(self.positions) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32)
+        counts = [len(p) for p in self.positions]
+        return np.concatenate(self.positions), np.repeat(np.asarray(self.rules, dtype=np.int32), counts)
+
+    def current(self):
+        """
+        Returns the rule id of the last event of every pseg, 0 for psegs without events.
+        """
+        cur = np.zeros(self.n, dtype=np.int32)
+        for pos, rid in zip(self.positions, self.rules):
+            cur[pos] = rid
+        return cur
+
+    def logic_labels(self, classes):
+        """
+        Method: logic_labels()
+        Purpose: Derive the logic strings of the old logic column from the last event of every pseg.
+        Params: classes - Class_name of the psegs (categorical or array)
+        Returns: object array, None for psegs without events
+        """
+        classes = pd.Categorical(classes)
+        cur = self.current()
+        rids, inv = np.unique(cur, return_inverse=True)
+        labels = np.empty(len(cur), dtype=object)
+        for i, rid in enumerate(rids):
+            rows = np.flatnonzero(inv == i)
+            if rid == 0:
+                continue
+            label, with_class = self.catalogue[rid]
+            if with_class:
+                table = np.array([f'{label} {c}' for c in classes.categories], dtype=object)
+                labels[rows] = table[classes.codes[rows]]
+            else:
+                labels[rows] = label
+        return labels
+
+    def table(self, psid):
+        """
+        Returns the event table (PSID, rule_id, order) sorted by PSID position and order.
+        """
+        pos, rules = self.arrays()
+        sort = np.argsort(pos, kind='stable') # events of a pseg stay in record order
+        pos, rules = pos[sort], rules[sort]
+        first = np.r_[True, pos[1:] != pos[:-1]] if len(pos) > 0 else np.empty(0, dtype=bool)
+        start = np.maximum.accumulate(np.where(first, np.arange(len(pos)), 0))
+        return pd.DataFrame({'PSID': np.asarray(psid)[pos], 'rule_id': rules,
+                             'order': (np.arange(len(pos)) - start + 1).astype(np.int16)})
+
+    def catalogue_table(self, area):
+        """
+        Method: catalogue_table()
+        Purpose: Rule catalogue of the run with how often and over what area every rule fired.
+        Params: area - ps_area of the psegs
+        Returns: df of rule_id, logic, with_class, n_events/event_area (every event of the rule) and
+                 n_final/final_area (psegs whose last rule it is)
+        """
+        rids = np.asarray(sorted(self.catalogue), dtype=np.int32)
+        area = np.asarray(area, dtype=np.float64)
+        pos, rules = self.arrays()
+        cur = self.current()
+        r_idx = np.searchsorted(rids, rules)
+        c_mask = cur > 0
+        c_idx = np.searchsorted(rids, cur[c_mask])
+        return pd.DataFrame({'rule_id': rids,
+                             'logic': [self.catalogue[r][0] for r in rids],
+                             'with_class': [self.catalogue[r][1] for r in rids],
+                             'n_events': np.bincount(r_idx, minlength=len(rids)).astype(np.int64),
+                             'event_area': np.bincount(r_idx, weights=area[pos], minlength=len(rids)),
+                             'n_final': np.bincount(c_idx, minlength=len(rids)).astype(np.int64),
+                             'final_area': np.bincount(c_idx, weights=area[c_mask], minlength=len(rids))})
+
+
+def start(n):
+    """
+    Start the event log of the current process for n psegs.
+    """
+    global _log
+    _log = EventLog(n)
+    return _log
+
+def log():
+    return _log
+
+def resume(log):
+    """
+    Continue recording into log (ie restored from a checkpoint or the seed log of a tile).
+    """
+    global _log
+    _log = log
+    return _log
+
+def record(positions, label, with_class=False):
+    """
+    Method: record()
+    Purpose: Record that the rule label classified psegs at positions.
+    Params: positions - psegs positions (array or bool mask)
+            label - logic label of the rule ('{label} {Class_name}' if with_class)
+            with_class - the rule logic is suffixed with the pseg Class_name
+    Returns: N/A
+    """
+    positions = np.asarray(positions)
+    if positions.dtype == bool:
+        positions = np.flatnonzero(positions)
+    _log.record(positions, label, with_class)
@@ -0,0 +1,245 @@
+"""
+Script: psegs_schema.py
+Purpose: Declared schema of the psegs table used by the landuse model and a columnar loader for it.
+         read_psegs() reads only the schema columns present in the layer through pyogrio's Arrow reader
+         and converts each column straight to its target dtype (ints to int32 with nulls as 0), so the
+         GeoDataFrame is built once instead of being copied by one astype per column.
+         conform() validates a psegs gdf against the schema (after joinData or read_psegs) and builds the
+         final table in the same pass: unknown columns are dropped, flex columns added as 0, added columns
+         as None, missing area columns computed from the geometry.
+         With a worker runtime the layer is split into feature ranges (skip/max features, fast on GPKG) read and
+         converted by the workers in parallel; with a bbox only the features found through the GPKG R-tree are
+         read (tile consumers, ie the TC stage).
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyogrio
+import shapely
+
+import geom_store
+
+# column -> target dtype, in output order. 'int32' columns are filled with 0 where null.
+SCHEMA = {
+    'SID': 'int32', 'PID': 'int32', 'Class_name': 'str', 'PSID': 'int32',
+    'p_area': 'int32', 's_area': 'int32', 'ps_area': 'int32',
+    'p_lc_1': 'int32', 'p_lc_2': 'int32', 'p_lc_3': 'int32', 'p_lc_4': 'int32', 'p_lc_5': 'int32', 'p_lc_6': 'int32',
+    'p_lc_7': 'int32', 'p_lc_8': 'int32', 'p_lc_9': 'int32', 'p_lc_10': 'int32', 'p_lc_11': 'int32', 'p_lc_12': 'int32',
+    's_c18_0': 'int32', 's_c18_1': 'int32', 's_c18_2': 'int32', 's_c18_3': 'int32', 's_c18_4': 'int32',
+    'p_c18_0': 'int32', 'p_c18_1': 'int32', 'p_c18_2': 'int32', 'p_c18_3': 'int32', 'p_c18_4': 'int32',
+    's_c1719_0': 'int32', 's_c1719_1': 'int32', 's_c1719_2': 'int32', 's_c1719_3': 'int32', 's_c1719_4': 'int32',
+    's_n16_0': 'int32', 's_n16_1': 'int32',
+    'p_luz': 'str', 's_luz': 'str',
+    'lu': 'str',
+    }
+
+# required values that could realistically be missing from an entire county resulting in no column
+FLEX_COLUMNS = [
+    'p_lc_1', 'p_lc_2', 'p_lc_4', 'p_lc_6',
+    's_c18_1', 's_c18_2', 's_c18_3', 's_c18_4',
+    'p_c18_1', 'p_c18_2', 'p_c18_3', 'p_c18_4',
+    's_c1719_1', 's_c1719_2', 's_c1719_3', 's_c1719_4',
+    'p_luz', 's_luz',
+    ]
+
+# columns the model adds itself (as None) if the input does not have them
+ADDED_COLUMNS = ['lu', 's_luz', 'p_luz']
+
+# columns regenerated by datacheck if missing or not unique, added as 0
+GENERATED_COLUMNS = ['PSID']
+
+# area columns computed from the geometry if missing, column -> zone summed over (None is per pseg)
+AREA_COLUMNS = {'ps_area': None, 'p_area': 'PID', 's_area': 'SID'}
+
+# columns joined from the tabulate area tables by helpers.joinData
+JOIN_COLUMNS = ['p_area', 's_area', 'p_lc_1', 'p_lc_3', 'p_lc_4', 'p_lc_5', 'p_lc_6', 'p_lc_7', 'p_lc_8', 'p_lc_9', 'p_lc_10', 'p_lc_11', 'p_lc_12',
+    's_c18_0', 'p_c18_0', 's_c1719_0', 's_n16_0', 'p_luz', 's_luz']
+
+# columns kept when the join columns have to be joined again
+BASE_COLUMNS = ['PSID', 'PID', 'SID', 'Class_name']
+
+
+def layer_columns(path, layer):
+    """
+    Returns the attribute column names of a layer without reading it.
+    """
+    return list(pyogrio.read_info(path, layer=layer)['fields'])
+
+def to_dtype(values, dtype):
+    """
+    Method: to_dtype()
+    Purpose: Convert one column to its schema dtype without touching the rest of the table.
+    Params: values - numpy array, pandas Series or pyarrow (Chunked)Array
+            dtype - 'int32' or 'str'
+    Returns: numpy array (int32, or object with None for missing strings)
+    """
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = values.to_numpy(zero_copy_only=False) # int columns with nulls come back as float/nan
+    if dtype == 'int32':
+        values = np.asarray(values)
+        if values.dtype.kind == 'f':
+            values = np.nan_to_num(values, nan=0)
+        elif values.dtype.kind == 'O':
+            values = pd.to_numeric(pd.Series(values, copy=False)).fillna(0).to_numpy()
+        return values.astype(np.int32, copy=False)
+    values = pd.Series(values, copy=False)
+    return np.asarray(values.astype(object).where(values.notna(), None))
+
+def _read_columns(path, layer, columns):
+    fields = layer_columns(path, layer)
+    wanted = set(columns if columns is not None else SCHEMA)
+    return [c for c in fields if c in wanted]
+
+def _read_part(args):
+    """
+    Worker for read_parts. Read one feature range (or bbox) of a layer.
+    Returns: ({column: array at its schema dtype}, WKB object array, crs)
+    """
+    path, layer, columns, skip, count, bbox = args
+    meta, table = pyogrio.read_arrow(path, layer=layer, columns=columns, skip_features=skip, max_features=count, bbox=bbox)
+    data = {col: to_dtype(table.column(col), SCHEMA.get(col, 'str')) for col in columns}
+    wkb = table.column(meta['geometry_name'] or 'wkb_geometry').to_numpy(zero_copy_only=False)
+    return data, wkb, meta['crs']
+
+def read_parts(path, layer, columns, runtime=None, part_size=500000, bbox=None):
+    """
+    Method: read_parts()
+    Purpose: Read a layer as consecutive feature ranges, in parallel on the runtime when there is more than one.
+    Params: path - psegs gpkg
+            layer - layer name
+            columns - columns to read (present in the layer)
+            runtime - mp_runtime.WorkerRuntime, None reads in this process
+            part_size - max features per range (at least one range per worker)
+            bbox - (xmin, ymin, xmax, ymax), read only features intersecting it in one range
+    Returns: iterator of _read_part results in layer order
+    """
+    if bbox is not None or runtime is None:
+        return iter([_read_part((path, layer, columns, 0, None, bbox))])
+    n = pyogrio.read_info(path, layer=layer)['features']
+    chunks = runtime.chunks(np.arange(n), part_size)
+    if len(chunks) <= 1:
+        return iter([_read_part((path, layer, columns, 0, None, None))])
+    print(f'----Reading {n} features in {len(chunks)} parts')
+    return runtime.imap(_read_part, [(path, layer, columns, int(c[0]), len(c), None) for c in chunks])
+
+def read_psegs(path, layer, columns=None, runtime=None, part_size=500000, bbox=None):
+    """
+    Method: read_psegs()
+    Purpose: Read the schema columns of a psegs layer through the Arrow reader, straight into their
+             target dtypes.
+    Params: path - psegs gpkg
+            layer - layer name
+            columns - columns to read, default every SCHEMA column in the layer
+            runtime - mp_runtime.WorkerRuntime to read feature ranges in parallel, None reads in this process
+            part_size - max features per parallel range
+            bbox - (xmin, ymin, xmax, ymax), read only the psegs intersecting it (GPKG R-tree)
+    Returns: gdf with the columns present in the layer (in layer order) and geometry
+    """
+    columns = _read_columns(path, layer, columns)
+    parts = {col: [] for col in columns}
+    wkbs = []
+    for data, wkb, crs in read_parts(path, layer, columns, runtime, part_size, bbox):
+        for col in columns:
+            parts[col].append(data[col])
+        wkbs.append(wkb)
+    data = {col: np.concatenate(parts[col]) for col in columns}
+    geometry = shapely.from_wkb(np.concatenate(wkbs))
+    del parts, wkbs
+    return gpd.GeoDataFrame(data, geometry=geometry, crs=crs)
+
+def read_psegs_lazy(path, layer, folder, columns=None, batch_size=500000, runtime=None):
+    """
+    Method: read_psegs_lazy()
+    Purpose: read_psegs() for the geometry-lazy mode. The layer is streamed in Arrow batches (or read in parallel
+             feature ranges of batch_size, written in order as they arrive), attributes are converted to their
+             target dtypes and the WKB is written to a geom_store.GeometryStore without keeping the geometry of
+             the county in memory.
+    Params: path - psegs gpkg
+            layer - layer name
+            folder - GeometryStore folder (replaced)
+            columns - columns to read, default every SCHEMA column in the layer
+            batch_size - features per batch
+            runtime - mp_runtime.WorkerRuntime to read feature ranges in parallel, None streams in this process
+    Returns: (df, store) - attributes (no geometry) and the GeometryStore, same row order
+    """
+    columns = _read_columns(path, layer, columns)
+    parts = {col: [] for col in columns}
+    if runtime is not None:
+        writer = None
+        for data, wkb, crs in read_parts(path, layer, columns, runtime, batch_size):
+            if writer is None:
+                writer = geom_store.StoreWriter(folder, crs)
+            for col in columns:
+                parts[col].append(data[col])
+            writer.append(wkb)
+    else:
+        with pyogrio.open_arrow(path, layer=layer, columns=columns, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+            writer = geom_store.StoreWriter(folder, meta['crs'])
+            geom_col = meta['geometry_name'] or 'wkb_geometry'
+            for batch in reader:
+                for col in columns:
+                    parts[col].append(to_dtype(batch.column(col), SCHEMA.get(col, 'str')))
+                writer.append(batch.column(geom_col).to_numpy(zero_copy_only=False))
+    store = writer.close()
+    df = pd.DataFrame({col: np.concatenate(parts[col]) if parts[col] else np.empty(0) for col in columns})
+    return df, store
+
+def conform(psegs, rows=None, store=None):
+    """
+    Method: conform()
+    Purpose: Validate psegs against SCHEMA and build the schema table in one pass. Columns not in the schema
+             are dropped, missing flex columns are added as 0, missing ADDED_COLUMNS as None and missing
+             AREA_COLUMNS are computed from the geometry (summed per PID/SID for parcel/segment area).
+    Params: psegs - pseg gdf (read_psegs or joinData output)
+            rows - optional bool mask of psegs to keep
+            store - geom_store.GeometryStore holding the geometry of psegs (geometry-lazy mode), rows not kept
+                    are removed from it
+    Returns: new gdf with every SCHEMA column at its dtype and geometry (a df without geometry if store is given)
+    """
+    missing = [c for c in SCHEMA if c not in psegs.columns and c not in FLEX_COLUMNS
+               and c not in ADDED_COLUMNS and c not in AREA_COLUMNS and c not in GENERATED_COLUMNS]
+    if len(missing) > 0:
+        print(f"Required column missing! - {missing}")
+        raise TypeError(f"Required column missing! - {missing}")
+    for col in psegs.columns:
+        if col not in SCHEMA and col != 'geometry':
+            print(f'Pseg file has a column that is not required! : deleting {col}!')
+
+    take = slice(None) if rows is None else np.asarray(rows)
+    n = len(psegs) if rows is None else int(np.count_nonzero(take))
+    if store is None:
+        geometry = psegs.geometry.values[take]
+    elif rows is not None:
+        store.keep(take)
+    data = {}
+    for col, dtype in SCHEMA.items():
+        if col in psegs.columns:
+            data[col] = to_dtype(psegs[col].values[take], dtype)
+        elif col in AREA_COLUMNS:
+            continue
+        elif col in ADDED_COLUMNS:
+            print(f"adding {col} column as Str/None")
+            data[col] = np.full(n, None, dtype=object)
+        elif col in GENERATED_COLUMNS:
+            data[col] = np.zeros(n, dtype=np.int32)
+        else:
+            print(f'Flex column missing! - {col} \n--Adding {col} to table as zero...')
+            data[col] = np.zeros(n, dtype=np.int32)
+
+    area = None
+    for col, zone in AREA_COLUMNS.items():
+        if col in data:
+            continue
+        print(f"--Adding '{col}' from geometry")
+        if area is None:
+            area = shapely.area(np.asarray(geometry)) if store is None else store.area()
+        if zone is None:
+            data[col] = area.astype(np.int32)
+        else:
+            zone_idx, zones = pd.factorize(data[zone])
+            data[col] = np.bincount(zone_idx, weights=area, minlength=len(zones))[zone_idx].astype(np.int32)
+
+    if store is not None:
+        return pd.DataFrame({c: data[c] for c in SCHEMA})
+    return gpd.GeoDataFrame({c: data[c] for c in SCHEMA}, geometry=geometry, crs=psegs.crs)
@@ -0,0 +1,156 @@
+"""
+Script: ras_store.py
+Purpose: County clips of the watershed wide ancillary rasters (luconfig.ras_dict). Run once (and again whenever a
+         source raster is updated) before the county runs:
+
+            python ras_store.py               # build/refresh every registered raster
+            python ras_store.py -layers rail slr --force
+
+         Every raster is clipped to each county boundary (luconfig.county_shp, the same 20m buffered boundaries
+         burn_in and lu_change mask with) into {ras_store}/{key}/{GEOID}.tif: the clip is the window of the
+         raster over the county bounds (no mask, cells are copied as is) on the source grid, with the source
+         dtype and nodata, written tiled and compressed. manifest.json records the content hash of every source
+         like anci_store.py, so unchanged rasters are not clipped again.
+         Consumers resolve() a source path for a county and get the county clip, or the source itself when the
+         raster is not in the store or changed after the store was built.
+"""
+import argparse
+import os
+import shutil
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import rasterio as rio
+from rasterio.errors import WindowError
+from rasterio.features import geometry_window
+from rasterio.windows import Window
+
+import luconfig
+import anci_store
+
+PROFILE = {'driver': 'GTiff', 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'LZW', 'BIGTIFF': 'IF_SAFER'}
+
+
+def clip_county(src, geom, outpath):
+    """
+    Method: clip_county()
+    Purpose: Write the window of src covering a county boundary, on the source grid. Cells are copied as is (no
+             mask), so any area inside the county bounds reads the same from the clip as from the source.
+    Params: src - open rasterio dataset
+            geom - county boundary in the raster crs
+            outpath - output tif
+    Returns: False if the county does not overlap the raster (nothing written)
+    """
+    try:
+        window = geometry_window(src, [geom])
+    except WindowError: # shapes do not overlap raster
+        return False
+    meta = src.meta.copy()
+    meta.update(PROFILE)
+    meta.update({'height': window.height, 'width': window.width, 'transform': src.window_transform(window)})
+    with rio.open(outpath, 'w', **meta) as dst:
+        for ji, w in dst.block_windows(1):
+            dst.write(src.read(window=Window(window.col_off + w.col_off, window.row_off + w.row_off, w.width, w.height)), window=w)
+    return True
+
+def covers(raspath, bounds):
+    """
+    Returns True if the raster at raspath covers bounds (left, bottom, right, top).
+    """
+    with rio.open(raspath) as src:
+        b = src.bounds
+    return b.left <= bounds[0] and b.bottom <= bounds[1] and b.right >= bounds[2] and b.top >= bounds[3]
+
+def prepare(anci_folder, ras_dict, store, county_shp, layers=None, force=False):
+    """
+    Method: prepare()
+    Purpose: Build or refresh the county raster clips. A raster is clipped again only if the content hash of its
+             source changed (or force); sources whose size and mtime did not change are not hashed again.
+    Params: anci_folder - base ancillary folder
+            ras_dict - luconfig.ras_dict
+            store - store folder (luconfig.ras_store)
+            county_shp - county boundaries relative to anci_folder (luconfig.county_shp)
+            layers - ras_dict keys to prepare, default every raster
+            force - rebuild even if the source did not change
+    Returns: N/A
+    """
+    os.makedirs(store, exist_ok=True)
+    manifest = anci_store.load_manifest(store)
+    counties = None
+    for key in layers or list(ras_dict):
+        raspath = Path(anci_folder, ras_dict[key])
+        lt = time.time()
+        if not raspath.is_file():
+            print(f'--{key}: {raspath} does not exist, skipping')
+            continue
+        signature = anci_store.source_signature(raspath)
+        entry = manifest.get(key, {})
+        if not force and entry.get('source') == str(raspath) and entry.get('signature') == signature:
+            print(f'--{key}: unchanged, skipping')
+            continue
+        sha = anci_store.source_hash(raspath)
+        if not force and entry.get('source') == str(raspath) and entry.get('sha1') == sha:
+            print(f'--{key}: same content, updating signature')
+            entry['signature'] = signature
+            anci_store.save_manifest(store, manifest)
+            continue
+
+        print(f'--{key}: clipping {raspath}')
+        if counties is None:
+            counties = gpd.read_file(Path(anci_folder, county_shp))[['GEOID', 'geometry']]
+        outdir = Path(store, key)
+        tmpdir = Path(store, f'{key}.tmp')
+        if tmpdir.exists():
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+        written = []
+        with rio.open(raspath) as src:
+            for geoid, geom in zip(counties['GEOID'], counties.to_crs(src.crs).geometry):
+                if clip_county(src, geom, Path(tmpdir, f'{geoid}.tif')):
+                    written.append(str(geoid))
+        if outdir.exists():
+            shutil.rmtree(outdir)
+        os.replace(tmpdir, outdir)
+        manifest[key] = {'source': str(raspath), 'sha1': sha, 'signature': signature, 'counties': written}
+        anci_store.save_manifest(store, manifest)
+        print(f'----{len(written)} county clips in {round(time.time()-lt)} seconds')
+
+def resolve(raspath, cf, bounds=None, store=None):
+    """
+    Method: resolve()
+    Purpose: Path to read a watershed wide raster from for a county: its county clip when the store holds an
+             up to date one, otherwise the source.
+    Params: raspath - source raster path
+            cf - county fips
+            bounds - optional (left, bottom, right, top) the caller reads, ie the extent of a county raster it
+                     clips to; the source is returned if the county clip does not cover it
+            store - store folder, default luconfig.ras_store
+    Returns: path (str)
+    """
+    store = store or luconfig.ras_store
+    geoid = anci_store.county_id(cf)
+    for key, entry in anci_store.load_manifest(store).items():
+        if entry['source'] != str(Path(raspath)):
+            continue
+        if geoid not in entry['counties']:
+            break
+        if entry['signature'] != anci_store.source_signature(raspath):
+            print(f'----{key} source changed since the raster store was built, reading source (rerun ras_store.py)')
+            break
+        clip = Path(store, key, f'{geoid}.tif')
+        if bounds is not None and not covers(clip, bounds):
+            break
+        return str(clip)
+    return str(raspath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the county clips of the ancillary rasters')
+    parser.add_argument('-layers', nargs='+', help='ras_dict keys to prepare (default all rasters)')
+    parser.add_argument('--force', default=False, action='store_true')
+    args = parser.parse_args()
+
+    st = time.time()
+    prepare(luconfig.anci_folder, luconfig.ras_dict, luconfig.ras_store, luconfig.county_shp, args.layers, args.force)
+    print(f'--ras_store complete in {round(time.time()-st)} seconds')
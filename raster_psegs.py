@@ -0,0 +1,160 @@
+"""
+Script: raster_psegs.py
+Purpose: Raster domain psegs (data_prep.py --raster). The segment (SID) and parcel (PID) label grids are burned on
+         the land cover grid (ps_segs.tif / ps_parcels.tif) and every distinct (SID, PID) pair of pixels is a pseg,
+         instead of intersecting the polygons and tabulating areas afterwards:
+            pseg_table() - one block wise pass over the SID, PID and land cover grids counting pixels per
+                           (SID, PID, land cover class): psegs with ps_area and their land cover composition,
+                           p_area / p_lc_* per parcel and s_area per segment
+            write_labels() - PSID label grid (ps_psegs.tif)
+            vectorize() - pseg polygons from the label grid (polygonize.py), only for the stages that still need
+                          geometry
+         PSIDs are numbered in (PID, SID) order like overlay.py. A pseg is the whole (SID, PID) pair, the pixels of a
+         pair split into several parts by the parcel are one (multipart) pseg.
+"""
+import numpy as np
+import pandas as pd
+import pyogrio
+import rasterio as rio
+import shapely
+from rasterio.windows import Window
+
+import polygonize
+import zone_raster
+
+
+def pseg_table(sid_path, pid_path, lc_path, lc_vals, block_size=4096):
+    """
+    Method: pseg_table()
+    Purpose: Psegs and zone areas from pixel counts of the label grids, in one block wise pass.
+    Params: sid_path - segment label grid (ps_segs.tif, 0 is no segment)
+            pid_path - parcel label grid on the same grid (ps_parcels.tif, 0 is no parcel)
+            lc_path - land cover raster on the same grid
+            lc_vals - land cover values of the composition columns
+            block_size - max rows/cols read at a time
+    Returns: (psegs, parcels, segs) dfs
+                psegs - PSID, SID, PID, ps_area and ps_lc_{v} per land cover value
+                parcels - PID, p_area and p_lc_{v}
+                segs - SID, s_area
+    """
+    vals = np.asarray(lc_vals, dtype=np.int64)
+    order = np.argsort(vals)
+    nv = len(vals)
+    trip, counts = [], []
+    with rio.open(sid_path) as sid_src, rio.open(pid_path) as pid_src, rio.open(lc_path) as lc_src:
+        cell_area = abs(sid_src.res[0] * sid_src.res[1])
+        for w in zone_raster.block_windows(sid_src, sid_src.bounds, block_size):
+            window = Window(*w)
+            s = sid_src.read(1, window=window).astype(np.int64)
+            p = pid_src.read(1, window=window).astype(np.int64)
+            lc = lc_src.read(1, window=window).astype(np.int64)
+            inside = (s > 0) | (p > 0)
+            s, p, lc = s[inside], p[inside], lc[inside]
+            pos = np.searchsorted(vals, lc, sorter=order)
+            pos[pos >= nv] = 0
+            cls = np.where(vals[order[pos]] == lc, order[pos], nv) # nv is any other value (or nodata)
+            np1 = p.max() + 1 if len(p) > 0 else 1
+            k, c = zone_raster.block_pairs((s * np1 + p) * (nv + 1) + cls)
+            trip.append(np.stack([k // (nv + 1) // np1, k // (nv + 1) % np1, k % (nv + 1)]))
+            counts.append(c)
+
+    trip = np.concatenate(trip, axis=1) if trip else np.empty((3, 0), dtype=np.int64)
+    counts = np.concatenate(counts) if counts else np.empty(0, dtype=np.int64)
+    s, p, cls = trip
+    np1 = p.max() + 1 if len(p) > 0 else 1
+    keys, inv = np.unique((s * np1 + p) * (nv + 1) + cls, return_inverse=True)
+    area = np.bincount(inv, weights=counts, minlength=len(keys)) * cell_area
+    pair, cls = keys // (nv + 1), keys % (nv + 1)
+    s, p = pair // np1, pair % np1
+
+    # psegs: pairs with a segment and a parcel, numbered by PID then SID
+    ps = (s > 0) & (p > 0)
+    pairs, pinv = np.unique(pair[ps], return_inverse=True)
+    psid_order = np.lexsort((pairs // np1, pairs % np1))
+    psid = np.empty(len(pairs), dtype=np.int32)
+    psid[psid_order] = np.arange(1, len(pairs) + 1)
+    comp = np.zeros((len(pairs), nv + 1), dtype=np.float64)
+    np.add.at(comp, (pinv, cls[ps]), area[ps])
+    psegs = pd.DataFrame({'PSID': psid, 'SID': (pairs // np1).astype(np.int32), 'PID': (pairs % np1).astype(np.int32),
+                          'ps_area': np.round(comp.sum(axis=1)).astype(np.int64)})
+    for i, v in enumerate(lc_vals):
+        psegs[f'ps_lc_{v}'] = np.round(comp[:, i]).astype(np.int64)
+    psegs = psegs.iloc[psid_order].reset_index(drop=True)
+
+    # parcels and segments over all their pixels (also where the other grid is 0)
+    pids, pinv = np.unique(p[p > 0], return_inverse=True)
+    pcomp = np.zeros((len(pids), nv + 1), dtype=np.float64)
+    np.add.at(pcomp, (pinv, cls[p > 0]), area[p > 0])
+    parcels = pd.DataFrame({'PID': pids.astype(np.int32), 'p_area': np.round(pcomp.sum(axis=1)).astype(np.int64)})
+    for i, v in enumerate(lc_vals):
+        parcels[f'p_lc_{v}'] = np.round(pcomp[:, i]).astype(np.int64)
+    sids, sinv = np.unique(s[s > 0], return_inverse=True)
+    segs = pd.DataFrame({'SID': sids.astype(np.int32),
+                         's_area': np.round(np.bincount(sinv, weights=area[s > 0], minlength=len(sids))).astype(np.int64)})
+    return psegs, parcels, segs
+
+def write_labels(sid_path, pid_path, psegs, out_path, block_size=4096):
+    """
+    Method: write_labels()
+    Purpose: Write the PSID label grid (int32, 0 outside psegs) block by block.
+    Params: sid_path, pid_path - label grids of pseg_table()
+            psegs - psegs df of pseg_table()
+            out_path - output tif
+            block_size - max rows/cols read at a time
+    Returns: N/A
+    """
+    np1 = int(psegs['PID'].max()) + 1 if len(psegs) > 0 else 1
+    pairs = psegs['SID'].values.astype(np.int64) * np1 + psegs['PID'].values
+    order = np.argsort(pairs)
+    pairs, psid = pairs[order], psegs['PSID'].values.astype(np.int32)[order]
+    with rio.open(sid_path) as sid_src, rio.open(pid_path) as pid_src:
+        meta = sid_src.meta.copy()
+        meta.update({'driver': 'GTiff', 'dtype': 'int32', 'nodata': 0, 'compress': 'LZW', 'tiled': True,
+                     'blockxsize': 512, 'blockysize': 512, 'BIGTIFF': 'IF_SAFER'})
+        with rio.open(out_path, 'w', **meta) as dst:
+            for w in zone_raster.block_windows(sid_src, sid_src.bounds, block_size):
+                window = Window(*w)
+                s = sid_src.read(1, window=window).astype(np.int64)
+                p = pid_src.read(1, window=window).astype(np.int64)
+                out = np.zeros(s.shape, dtype=np.int32)
+                inside = (s > 0) & (p > 0) & (p < np1)
+                if len(pairs) > 0:
+                    key = s[inside] * np1 + p[inside]
+                    pos = np.minimum(np.searchsorted(pairs, key), len(pairs) - 1)
+                    out[inside] = np.where(pairs[pos] == key, psid[pos], 0)
+                dst.write(out, 1, window=window)
+
+def vectorize(label_path, runtime=None):
+    """
+    Method: vectorize()
+    Purpose: Pseg polygons from the PSID label grid (tiled, polygonize.py), 4 connected parts of one PSID are
+             combined into a multipolygon.
+    Params: label_path - PSID label grid of write_labels()
+            runtime - optional mp_runtime.WorkerRuntime to polygonize the tiles in parallel
+    Returns: (psid, geoms) - sorted PSIDs and their polygons
+    """
+    ids, parts = polygonize.polygonize_raster(label_path, runtime=runtime)
+    order = np.argsort(ids, kind='stable')
+    parts, ids = parts[order], ids[order]
+    psid, first, n = np.unique(ids, return_index=True, return_counts=True)
+    geoms = parts[first]
+    multi = np.flatnonzero(n > 1)
+    if len(multi) > 0:
+        rows = np.isin(ids, psid[multi])
+        geoms[multi] = shapely.multipolygons(parts[rows], indices=np.searchsorted(psid[multi], ids[rows]))
+    return psid, geoms
+
+def write_tables(parcels, segs, lc_vals, temp_folder):
+    """
+    Method: write_tables()
+    Purpose: Write the land cover and area tables of the parcels and segments in the tabulate area format read by
+             helpers.joinData (lc_pid_ta.dbf, parcelstable.dbf, segtable.dbf).
+    Params: parcels, segs - dfs of pseg_table()
+            lc_vals - land cover values of pseg_table()
+            temp_folder - county temp folder
+    Returns: N/A
+    """
+    lc = parcels[['PID'] + [f'p_lc_{v}' for v in lc_vals]].rename(columns={'PID': 'VALUE', **{f'p_lc_{v}': f'VALUE_{v}' for v in lc_vals}})
+    pyogrio.write_dataframe(lc, f'{temp_folder}/lc_pid_ta.dbf', driver='ESRI Shapefile')
+    pyogrio.write_dataframe(parcels[['PID', 'p_area']].rename(columns={'PID': 'Value', 'p_area': 'Count'}), f'{temp_folder}/parcelstable.dbf', driver='ESRI Shapefile')
+    pyogrio.write_dataframe(segs.rename(columns={'SID': 'Value', 's_area': 'Count'}), f'{temp_folder}/segtable.dbf', driver='ESRI Shapefile')
@@ -0,0 +1,145 @@
+"""
+Script: rasterizer.py
+Purpose: Tiled vector to grid burns shared by data_prep, burn_in and lu_change. The grid of a snap raster is cut into
+         tiles aligned to the output blocks and every tile burns only the features whose bounds intersect it
+         (STRtree over the feature bounds), on the worker runtime when one is given. Geometry is published once on
+         the runtime (mp_runtime) and workers decode only the candidates of their tile.
+         Candidates are burned in feature order, so where features overlap the later feature wins like in one
+         rasterio.features.rasterize call over the whole grid; pixels are burned by the same pixel center rule
+         (all_touched=False by default).
+            rasterize_to_file() - tiled, LZW compressed GeoTIFF on the snap raster grid, written window by window
+            rasterize_array() - in memory array (ie for burns combined with other county arrays)
+"""
+import numpy as np
+import rasterio as rio
+import shapely
+from rasterio.features import rasterize
+from rasterio.transform import array_bounds
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+import mp_runtime
+
+PROFILE = {'driver': 'GTiff', 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'LZW', 'BIGTIFF': 'IF_SAFER'}
+
+
+def burn_source(geoms, values, runtime=None):
+    """
+    Method: burn_source()
+    Purpose: Features to burn, published on the runtime or kept in process. Missing and empty geometries are dropped.
+    Params: geoms - GeoSeries or array of shapely geometries
+            values - burn value of each geometry
+            runtime - optional mp_runtime.WorkerRuntime
+    Returns: ('layer', SharedLayer, SharedArray) or ('local', geoms, values, STRtree)
+    """
+    geoms = np.asarray(getattr(geoms, 'values', geoms), dtype=object)
+    values = np.asarray(values)
+    keep = ~(shapely.is_missing(geoms) | shapely.is_empty(geoms))
+    geoms, values = geoms[keep], values[keep]
+    if runtime is not None:
+        return ('layer', runtime.publish('_burn', geoms), runtime.share_array('_burn_values', values))
+    return ('local', geoms, values, shapely.STRtree(geoms))
+
+def release_source(source, runtime=None):
+    if runtime is not None and source[0] == 'layer':
+        runtime.release('_burn')
+        runtime.release('_burn_values')
+
+def rasterize_tile(source, shape, transform, dtype, fill=0, all_touched=False):
+    """
+    Method: rasterize_tile()
+    Purpose: Burn the features intersecting one tile.
+    Params: source - burn_source()
+            shape - (rows, cols) of the tile
+            transform - affine transform of the tile
+            dtype - output dtype
+            fill - value of pixels without a feature
+            all_touched - burn every pixel touched by a feature
+    Returns: array of the tile
+    """
+    box = shapely.box(*array_bounds(shape[0], shape[1], transform))
+    if source[0] == 'local':
+        geoms, values, tree = source[1:]
+        cand = np.sort(tree.query(box))
+        geoms, values = geoms[cand], values[cand]
+    else:
+        layer, values_sa = source[1:]
+        cand = np.sort(mp_runtime.layer_tree(layer).query(box)) # feature order, later features burn over earlier
+        geoms = mp_runtime.decode_geoms(layer, cand)
+        ary, shm = values_sa.attach()
+        values = np.array(ary[cand])
+        del ary
+        shm.close()
+    if len(cand) == 0:
+        return np.full(shape, fill, dtype=dtype)
+    return rasterize(zip(geoms, values.tolist()), out_shape=shape, transform=transform, fill=fill,
+                     all_touched=all_touched, dtype=dtype)
+
+def _tile_task(args):
+    return rasterize_tile(*args)
+
+def tile_windows(height, width, tile_size):
+    """
+    Returns Windows of tile_size x tile_size (the last row/col of tiles is cut to the grid).
+    """
+    return [Window(c, r, min(tile_size, width - c), min(tile_size, height - r))
+            for r in range(0, height, tile_size) for c in range(0, width, tile_size)]
+
+def _tiles(source, windows, transform, dtype, fill, all_touched, runtime):
+    tasks = [(source, (w.height, w.width), window_transform(w, transform), dtype, fill, all_touched) for w in windows]
+    return runtime.imap(_tile_task, tasks) if runtime is not None else map(_tile_task, tasks)
+
+def rasterize_to_file(snap_path, geoms, values, out_path, dtype, fill=0, all_touched=False, tile_size=2048, runtime=None):
+    """
+    Method: rasterize_to_file()
+    Purpose: Burn features on the grid of a snap raster into a tiled, compressed GeoTIFF, window by window.
+    Params: snap_path - raster whose grid, crs and nodata the output takes (ie the county land cover)
+            geoms - GeoSeries or array of shapely geometries
+            values - burn value of each geometry
+            out_path - output tif
+            dtype - output dtype
+            fill - value of pixels without a feature
+            all_touched - burn every pixel touched by a feature
+            tile_size - tile rows/cols, a multiple of the 512 output block
+            runtime - optional mp_runtime.WorkerRuntime, tiles are burned in its workers
+    Returns: out_path
+    """
+    with rio.open(snap_path) as snap:
+        meta = snap.meta.copy()
+    meta.update(PROFILE)
+    meta.update({'dtype': dtype, 'count': 1})
+    tile_size = max(512, tile_size // 512 * 512)
+    windows = tile_windows(meta['height'], meta['width'], tile_size)
+    source = burn_source(geoms, values, runtime)
+    try:
+        with rio.open(out_path, 'w', **meta) as dst:
+            for window, tile in zip(windows, _tiles(source, windows, meta['transform'], dtype, fill, all_touched, runtime)):
+                dst.write(tile, 1, window=window)
+    finally:
+        release_source(source, runtime)
+    return out_path
+
+def rasterize_array(geoms, values, shape, transform, dtype, fill=0, all_touched=False, tile_size=2048, runtime=None):
+    """
+    Method: rasterize_array()
+    Purpose: Burn features into an in memory array, tile by tile.
+    Params: geoms - GeoSeries or array of shapely geometries
+            values - burn value of each geometry
+            shape - (rows, cols) of the grid
+            transform - affine transform of the grid
+            dtype - output dtype
+            fill - value of pixels without a feature
+            all_touched - burn every pixel touched by a feature
+            tile_size - tile rows/cols
+            runtime - optional mp_runtime.WorkerRuntime, tiles are burned in its workers
+    Returns: array of shape
+    """
+    out = np.empty(shape, dtype=dtype)
+    windows = tile_windows(shape[0], shape[1], tile_size)
+    source = burn_source(geoms, values, runtime)
+    try:
+        for w, tile in zip(windows, _tiles(source, windows, transform, dtype, fill, all_touched, runtime)):
+            out[w.row_off:w.row_off + w.height, w.col_off:w.col_off + w.width] = tile
+    finally:
+        release_source(source, runtime)
+    return out
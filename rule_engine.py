@@ -0,0 +1,207 @@
+"""
+Script: rule_engine.py
+Purpose: Compile ordered landuse rule tables (lu_rules.py) into plans and run them on psegs.
+         Derived features (ie p_lc_* sums) are computed once, every predicate is evaluated once on
+         numpy arrays, lu is assigned and every rule that matches psegs records a provenance event. Rule table format:
+
+            {'logic': 'Occupied parcel turf',          # rule label recorded for matching psegs (provenance.py)
+             'lu': 'Turf Herbaceous',                  # lu written, '{Class_name}' is filled per pseg, None leaves lu
+             'when': [LU_NA,                           # conditions are and-ed
+                      ('Class_name', '==', 'Low Vegetation'),
+                      ('p_area', '<=', 4046),
+                      ('p_lc_dev', '>=', 93),          # derived feature, see DERIVED
+                      ('p_lc_3', '>', col('p_area', 0.45))]} # column reference with factor
+
+         Operators: '==', '!=', '<', '<=', '>', '>=', 'isin', 'isna', 'contains' and ('or', [cond, ...]).
+         Conditions on 'lu' are evaluated against the state left by the previous rules,
+         all other conditions are static for the run and evaluated before the first rule.
+         Coded columns (lu_codes.py) are compared once per category and mapped to psegs through their codes.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+import lu_codes
+import provenance
+from helpers import lu_etime as etime
+
+# derived features shared by rules, name -> columns summed
+DERIVED = {
+    'p_lc_dev': ['p_lc_7', 'p_lc_8', 'p_lc_9', 'p_lc_10', 'p_lc_11', 'p_lc_12'], # parcel structures, roads, other imp
+    's_c18_0123': ['s_c18_0', 's_c18_1', 's_c18_2', 's_c18_3'],
+    }
+
+LU_NA = ('lu', 'isna', None)
+
+def col(name, factor=1):
+    """
+    Reference to a column (or derived feature) as the right side of a condition, optionally scaled.
+    """
+    return ('col', name, factor)
+
+def _is_col(value):
+    return isinstance(value, tuple) and len(value) == 3 and value[0] == 'col'
+
+def _cond_columns(cond):
+    if cond[0] == 'or':
+        return set().union(*[_cond_columns(c) for c in cond[1]])
+    names = {cond[0]}
+    if _is_col(cond[2]):
+        names.add(cond[2][1])
+    return names
+
+def _is_dynamic(cond):
+    return len(_cond_columns(cond) & set(lu_codes.STATE_COLUMNS)) > 0
+
+
+class CompiledRule:
+    def __init__(self, rule):
+        self.logic = rule['logic']
+        self.lu = rule.get('lu')
+        self.static = [c for c in rule['when'] if not _is_dynamic(c)]
+        self.dynamic = [c for c in rule['when'] if _is_dynamic(c)]
+
+
+class RulePlan:
+    """
+    Ordered rules of one table plus the columns and derived features they need.
+    """
+    def __init__(self, name, rules):
+        self.name = name
+        self.rules = [CompiledRule(r) for r in rules]
+        self.features = set()
+        for r in rules:
+            for c in r['when']:
+                self.features |= _cond_columns(c)
+        self.features -= set(lu_codes.STATE_COLUMNS)
+
+def compile_rules(name, rules):
+    """
+    Method: compile_rules()
+    Purpose: Compile an ordered rule table into a RulePlan. Checks operators up front so a bad
+             table fails before any psegs are touched.
+    Params: name - name of the rule table (used in the log)
+            rules - list of rule dicts (see module docstring)
+    Returns: RulePlan
+    """
+    ops = ('==', '!=', '<', '<=', '>', '>=', 'isin', 'isna', 'contains', 'or')
+    for r in rules:
+        for c in r['when']:
+            if c[0] != 'or' and c[1] not in ops:
+                print(f"Rule '{r['logic']}' has an unknown operator: {c}")
+                raise TypeError(f"Rule '{r['logic']}' has an unknown operator: {c}")
+    return RulePlan(name, rules)
+
+
+class FeatureStore:
+    """
+    Numpy arrays of the static psegs columns and derived features, read once per county.
+    Coded columns (ie Class_name) are kept as lu_codes.CodedColumn. Classification state (lu)
+    is never cached here.
+    """
+    def __init__(self, psegs):
+        self.psegs = psegs
+        self.arrays = {}
+
+    def get(self, name):
+        if name not in self.arrays:
+            if name in DERIVED:
+                self.arrays[name] = np.sum([self.get(c).astype(np.int64) for c in DERIVED[name]], axis=0)
+            elif name in lu_codes.CODED_COLUMNS:
+                self.arrays[name] = lu_codes.CodedColumn(self.psegs[name])
+            else:
+                self.arrays[name] = self.psegs[name].to_numpy()
+        return self.arrays[name]
+
+
+def _evaluate(cond, get):
+    if cond[0] == 'or':
+        mask = _evaluate(cond[1][0], get)
+        for c in cond[1][1:]:
+            mask = mask | _evaluate(c, get)
+        return mask
+    name, op, value = cond
+    ary = get(name)
+    if isinstance(ary, lu_codes.CodedColumn) and not _is_col(value):
+        # evaluate on the category table, missing values (code -1) take the last slot
+        labels = np.array(ary.categories + [None], dtype=object)
+        return _evaluate((name, op, value), lambda n: labels)[ary.codes]
+    if _is_col(value):
+        value = get(value[1]) * value[2] if value[2] != 1 else get(value[1])
+    if op == 'isna':
+        return pd.isna(ary)
+    if op == 'isin':
+        return pd.Series(ary, copy=False).isin(value).to_numpy()
+    if op == 'contains':
+        return pd.Series(ary, copy=False).str.contains(value, na=False).to_numpy(dtype=bool)
+    if op == '==':
+        return np.asarray(ary == value, dtype=bool)
+    if op == '!=':
+        return np.asarray(ary != value, dtype=bool)
+    if op == '<':
+        return ary < value
+    if op == '<=':
+        return ary <= value
+    if op == '>':
+        return ary > value
+    return ary >= value
+
+def _labels(template, lu, classes, idx):
+    """
+    Codes of a lu template for the matched psegs, '{Class_name}' is filled once per Class_name category.
+    """
+    if '{Class_name}' not in template:
+        return lu.code(template)
+    table = np.array([lu.code(template.format(Class_name=c)) for c in classes.categories], dtype=np.int32)
+    return table[classes.codes[idx]]
+
+def run_plan(cf, psegs, plan, features=None):
+    """
+    Method: run_plan()
+    Purpose: Apply a compiled rule plan to psegs in order, writing lu back once at the end.
+    Params: cf - county fips
+            psegs - main pseg gdf, modified in place
+            plan - RulePlan from compile_rules()
+            features - FeatureStore built from psegs, reused between plans of the same run
+    Returns: N/A
+    """
+    print(f'--Start {plan.name} {time.asctime()}')
+    rp_st = time.time()
+    if features is None:
+        features = FeatureStore(psegs)
+
+    state = {c: lu_codes.CodedColumn(psegs[c]) for c in lu_codes.STATE_COLUMNS}
+    static_cache = {}
+    def get_static(name):
+        return features.get(name)
+    def get_state(name):
+        return state[name] if name in state else features.get(name)
+
+    # static predicates once per rule, identical conditions shared between rules
+    static_masks = []
+    for rule in plan.rules:
+        mask = np.ones(len(psegs), dtype=bool)
+        for c in rule.static:
+            key = repr(c)
+            if key not in static_cache:
+                static_cache[key] = _evaluate(c, get_static)
+            mask &= static_cache[key]
+        static_masks.append(mask)
+
+    classes = features.get('Class_name')
+    for rule, mask in zip(plan.rules, static_masks):
+        if rule.dynamic:
+            mask = mask.copy()
+            for c in rule.dynamic:
+                mask &= _evaluate(c, get_state)
+        idx = np.flatnonzero(mask)
+        if len(idx) == 0:
+            continue
+        provenance.record(idx, rule.logic)
+        if rule.lu is not None:
+            state['lu'].codes[idx] = _labels(rule.lu, state['lu'], classes, idx)
+
+    for c in lu_codes.STATE_COLUMNS:
+        psegs[c] = state[c].categorical()
+    etime(cf, psegs, plan.name, rp_st)
@@ -9,6 +9,7 @@ Contact: smcdonald@chesapeakebay.net
 """
 import fiona
 import numpy as np
+import pyogrio
 import rasterio as rio
 import rasterio.mask
 import pandas as pd
@@ -21,19 +22,22 @@ import sys
 sys.path.append(r'B:/landuse')
 import luconfig as config
 import helpers
+import zone_raster
+import ras_store
     
 def readPolyData(gdbPath, layerName, polyID):
     """
     Method: readPolyData()
-    Purpose: Read in the polygon data and store the fiona geometries in a dictionary.
+    Purpose: Read in the polygon data.
     Params:  polyPath - path to polygon data
             polyID - name of field in polygon attribute table to use as unique ID
-    Returns: shapes - dictionary of fiona geometries where the keys are the polyID
+    Returns: (ids, geoms) - polygon ids and shapely geometries
+             gdf - df of polyID and polygon area (p_area or s_area)
     """
     gdf = gpd.read_file(gdbPath, layer=layerName)
     gdf = gdf[[polyID, 'geometry']]
-    shapes = {feature[polyID]:feature['geometry'] for idx, feature in gdf.iterrows()}
-    
+    ids, geoms = gdf[polyID].values.astype(np.int64), gdf.geometry.values
+
     if polyID == 'PID':
         gdf.loc[:, 'p_area'] = gdf.geometry.area
         gdf = gdf[[polyID]+['p_area']]
@@ -43,104 +47,61 @@ def readPolyData(gdbPath, layerName, polyID):
         gdf = gdf[[polyID]+['s_area']]
         gdf.loc[:, 's_area'] = gdf.s_area.astype(int)
 
-    return shapes, gdf
+    return (ids, geoms), gdf
 
-def tabulateArea_mp(shapes, rasPath, rasVals, cols):
+def tabulateArea(shapes, rasPath, rasVals, cols, zoneRasPath=None):
     """
-    Method: tabulateAreas_mp()
-    Purpose: Calculate the zonal stats / tabulate area for the specified raster and polygons.
-    Params: shapes - dict of polygons
+    Method: tabulateArea()
+    Purpose: Calculate the zonal stats / tabulate area for the specified raster and polygons with the rasterized
+             zone engine (zone_raster.tabulate_area). Zones are read from zoneRasPath (ps_parcels.tif /
+             ps_segs.tif) when it is on the raster's grid, otherwise the polygons are burned block by block. Rasters
+             coarser than luconfig.ta_fractional_res are tabulated on their native grid with exact cell coverage.
+    Params: shapes - (ids, geoms) of the polygons
             rasPath - path to raster
-            rasVals - unique raster values
-            cols - list of column names
+            rasVals - raster values to tabulate
+            cols - list of column names, zone id first then one per raster value
+            zoneRasPath - optional zone raster of the polygon ids
     Return: result - df of keys and tab area
     """
-    cpus_minus_1 = mp.cpu_count() - 1
-    if cpus_minus_1 == 0:
-        cpus_minus_1 = 1
-
-    batch_size = len(shapes) / cpus_minus_1
-    if batch_size % 1 != 0:
-        batch_size = int((batch_size) + 1)
-    else:
-        batch_size = int(batch_size)
-
-    chunk_iterator = []
-    for i in range(cpus_minus_1): # was num_chunks
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        keys = list(shapes)[mn:mx]
-        geoms = list(shapes.values())[mn:mx]
-        gdf_args = keys, geoms, rasPath, rasVals
-        chunk_iterator.append(gdf_args)
-
-    pool = mp.Pool(processes=cpus_minus_1)
-    results = pool.map(tabulateArea, chunk_iterator) 
-    pool.close()
-
-    result = {} #create one dict from list of dicts
-    for d in results:
-        result.update(d)
-    del results
-
-    df = pd.DataFrame.from_dict(result, orient='index', columns=cols[1:len(cols)])
-    df[cols[0]] = df.index
-
-    return df
-
-def tabulateArea(args):
-    """
-    Method: tabulateArea()
-    Purpose: tabulate area for each unique class in the raster within each polygon. Store data in
-            a dictionary.
-    Params: args:
-                shapes - dictionary of polygon geometries
-                rasPath - path to raster to summarize
-                rasVals - list of unique classes in the raster
-                fileType - flag for if raster is local land use or other
-    Returns: tabArea_dict - dictionary of tabulate area data for each polygon
-    """
-    tabArea_dict = {} #dict to store data in
-    keys, geoms, rasPath, rasVals = args
+    ids, geoms = shapes
     with rio.open(rasPath) as src:
-        noData = src.nodatavals[0]
-        if noData in rasVals: #ignore NoData
-            rasVals.remove(noData)
-        for s in range(len(keys)):
-            vals = tabArea(src, geoms[s], noData, rasVals) # list of unique vals in raster
-            tabArea_dict[keys[s]] = vals
-    return tabArea_dict
-
-def tabArea(src, geom, noData, rasVals):
+        valCols = [(c, v) for c, v in zip(cols[1:], rasVals) if v != src.nodata] # ignore NoData
+        vals = [v for c, v in valCols]
+        zone_src = None
+        if max(src.res) > config.ta_fractional_res: # coarse raster, exact cell coverage on its native grid
+            zones, areas = zone_raster.tabulate_area_fractional(src, vals, geoms, ids)
+        else:
+            if zoneRasPath is not None and os.path.isfile(zoneRasPath):
+                zone_src = rio.open(zoneRasPath)
+                if not zone_raster.aligned(src, zone_src):
+                    print(f"{zoneRasPath} is not on the grid of {rasPath}, burning polygons")
+                    zone_src.close()
+                    zone_src = None
+            if zone_src is not None:
+                zones, areas = zone_raster.tabulate_area(src, vals, zone_src=zone_src)
+                zone_src.close()
+            else:
+                zones, areas = zone_raster.tabulate_area(src, vals, geoms=geoms, ids=ids)
+
+    df = pd.DataFrame(np.round(areas).astype(np.int64), columns=[c for c, v in valCols])
+    df.insert(0, cols[0], zones)
+    # a zone raster only holds zones with pixels, every polygon gets a row (0 without pixels) like the polygon path
+    df = df.set_index(cols[0]).reindex(pd.Index(np.unique(ids), name=cols[0]), fill_value=0).reset_index()
+    return df.reindex(columns=cols, fill_value=0)
+
+def writeTATable(df, zoneID, valNames, tabPath):
     """
-    Method: tabArea()
-    Purpose: Mask the classed raster to the current catchment and calculate the cell count
-            for each class. Organize the counts in a list that will align with the total 
-            number of unique classes found in the whole raster.
-    Params: src - Rasterio open DatasetReader object for the raster
-            geom - fiona geometry of the catchment
-            noData - raster noData value
-            rasVals - list of all unique classes in the raster
-    Returns: finVals - list of class pixel counts within the catchment
+    Method: writeTATable()
+    Purpose: Write one tabulate area table in the layout helpers.joinData reads (ArcPy TabulateArea dbf):
+             VALUE is the zone id, one column per class named by valNames.
+    Params: df - tabulateArea() output
+            zoneID - 'PID' or 'SID'
+            valNames - output column name of each class column of df (ie VALUE_1 or LUZ names)
+            tabPath - output dbf
     """
-    try:
-        ary, t = rio.mask.mask(src, [geom], crop=True, all_touched=False) #mask by current catchment
-        vals, counts = np.unique(ary, return_counts=True) 
-        del ary
-        del t
-        vals = list(vals)
-        counts = list(counts)
-        if noData in vals:
-            i = vals.index(noData)
-            vals.remove(noData) 
-            del counts[i]
-        finVals = [0 for x in range(len(rasVals))] #empty list with same length as unique raster values
-        if len(vals) > 0:
-            for idx, v in enumerate(vals): #for each class found within the catchment
-                if int(v) in rasVals:
-                    finVals[rasVals.index(int(v))] = counts[idx] #set count of unique class in same order as the unique raster values
-        return  finVals #returns list of counts
-    except:
-        return [0] * len(rasVals)
+    out = df.rename(columns=dict(zip([c for c in df.columns if c != zoneID], valNames)))
+    out = out.rename(columns={zoneID: 'VALUE'})
+    pyogrio.write_dataframe(out, tabPath, driver='ESRI Shapefile')
 
 def getRenameDF(rasPath):
     """
@@ -203,6 +164,11 @@ def runTabulateArea(cf):
     checkPath(segsGDB, 'VECTORIZED SEGS gdb')
     checkPath(parcelsGDB, 'VECTORIZED PARCELS gdb')
     
+    # zone rasters of data prep (PID / SID burned on the land cover grid)
+    zoneRas = {'PID': f'{folder}/{cf}/input/ps_parcels.tif', 'SID': f'{folder}/{cf}/input/ps_segs.tif'}
+    areaTabs = {'PID': f'{temp_folder}/parcelstable.dbf', 'SID': f'{temp_folder}/segtable.dbf'}
+    luzNames = {v.lower(): v for v in config.LUZ_values}
+
     for i in ['PID', 'SID']: #for each ID type
         st = time.time()
         if i == 'SID':
@@ -247,10 +213,17 @@ def runTabulateArea(cf):
                 
                 # tabulate area for 1 raster by PID or SID
                 cols_names = [cur_dict['colname']+str(j) for j in cur_dict['vals']]
-                tmp = tabulateArea_mp(shapes, cur_dict['path'], vals, [i]+cols_names)
+                rasPath = ras_store.resolve(cur_dict['path'], cf) # county clip of watershed wide rasters
+                tmp = tabulateArea(shapes, rasPath, vals, [i]+cols_names, zoneRas[i])
                 helpers.etime(cf, f'Tabulated area for {ta}', st)
                 st = time.time()
 
+                # table for helpers.joinData
+                if 'luz' in ta:
+                    writeTATable(tmp, i, [luzNames[v] for v in cur_dict['vals']], cur_dict['tabPath'])
+                else:
+                    writeTATable(tmp, i, [f'VALUE_{v}' for v in cur_dict['vals']], cur_dict['tabPath'])
+
                 if 'luz' in ta: # if luz has empty cols, delete them
                     tmp.loc[:, (tmp != 0).any(axis=0)]
 
@@ -258,6 +231,8 @@ def runTabulateArea(cf):
                 areaDF = areaDF.merge(tmp, on=i, how='outer') # should be same as inner, but outer to be safe
                 del tmp
 
+        areaTab = areaDF[[i, f'{i[0].lower()}_area']].rename(columns={i: 'Value', f'{i[0].lower()}_area': 'Count'})
+        pyogrio.write_dataframe(areaTab, areaTabs[i], driver='ESRI Shapefile') # p_area / s_area table for joinData
         areaDF.to_csv(f'{temp_folder}/{i}_ta.csv', index=False)
         helpers.etime(cf, f'Write {i} CSV Time', st)
         st = time.time()
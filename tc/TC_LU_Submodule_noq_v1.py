@@ -25,10 +25,14 @@ from shapely.ops import unary_union
 import shutil
 from pathlib import Path
 import platform
+import shapely
 
 import tc.dense_mp_v1 as env_pkg
 from tc.dense_mp_v1 import dense as callDense
 import luconfig
+import psegs_schema
+import mp_runtime
+import adjacency
 from helpers import etime
 
 #########################################################################################
@@ -133,7 +137,7 @@ def run_trees_over_submodule(NUM_CPUS, cf):
 
     chunk_iterator = []
     for idx, row in tiles.iterrows():
-        psegs = env_pkg.readPolysMask(psegsPath, psegsLayer, row['geometry'].envelope) # read in psegs layer
+        psegs = psegs_schema.read_psegs(psegsPath, psegsLayer, ['PID', 'PSID', 'Class_name', 'lu'], bbox=row['geometry'].envelope.bounds) # psegs of the tile through the gpkg R-tree
         note = "Read psegs gpkg for tile " + str(row['id'])
         etime(cf, note, st)
         st = time.time()
@@ -272,84 +276,87 @@ def runTCT(args):
                 tct - paths to buffers to use for tct
                 toa - geodataframe of TCT and TOA polygons from rules 1-3
     """
-    psegs, allAg, allTurf, tile, cf, NUM_CPUS = args
-    crs = psegs.crs
-    lusToKeep = allAg + allTurf + ['Buildings', 'Other Impervious Surface']
-    st = time.time()
-    roads = psegs[(psegs['lu'] == 'Roads') | (psegs['Class_name'] == 'Roads')]
-    psegs = psegs[(psegs['lu'] != 'Roads') & (psegs['Class_name'] != 'Roads')]
+    try:
+        psegs, allAg, allTurf, tile, cf, NUM_CPUS = args
+        crs = psegs.crs
+        lusToKeep = allAg + allTurf + ['Buildings', 'Other Impervious Surface']
+        st = time.time()
+        roads = psegs[(psegs['lu'] == 'Roads') | (psegs['Class_name'] == 'Roads')]
+        psegs = psegs[(psegs['lu'] != 'Roads') & (psegs['Class_name'] != 'Roads')]
 
-    roads = roads[['geometry']]
-    roads = unary_union(roads['geometry'])
+        roads = roads[['geometry']]
+        roads = unary_union(roads['geometry'])
     
-    #Subset Environments
-    # get dense - remove records that are dense and not a lu to keep
-    dense = getSubsetEnv(psegs, 1, allTurf, tile, cf)
-    psegs = psegs[(psegs['EnvType'] != 1)|( (psegs['EnvType'] == 1) & (psegs['lu'].isin(lusToKeep)) )]
-    note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==1])) + " dense segments"
-    etime(cf, note, st)
-    st = time.time()
+        #Subset Environments
+        # get dense - remove records that are dense and not a lu to keep
+        dense = getSubsetEnv(psegs, 1, allTurf, tile, cf)
+        psegs = psegs[(psegs['EnvType'] != 1)|( (psegs['EnvType'] == 1) & (psegs['lu'].isin(lusToKeep)) )]
+        note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==1])) + " dense segments"
+        etime(cf, note, st)
+        st = time.time()
 
-    #get less dense - remove records that are less dense and not a lu to keep
-    notDense = getSubsetEnv(psegs, 2, allTurf, tile, cf) 
-    psegs = psegs[(psegs['EnvType'] != 2)|( (psegs['EnvType'] == 2) & (psegs['lu'].isin(lusToKeep)) )]
-    note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==2])) + " less dense segments"
-    etime(cf, note, st)
-    st = time.time()
+        #get less dense - remove records that are less dense and not a lu to keep
+        notDense = getSubsetEnv(psegs, 2, allTurf, tile, cf) 
+        psegs = psegs[(psegs['EnvType'] != 2)|( (psegs['EnvType'] == 2) & (psegs['lu'].isin(lusToKeep)) )]
+        note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==2])) + " less dense segments"
+        etime(cf, note, st)
+        st = time.time()
 
-    # get forested - remove records that are forested and not a lu to keep
-    forested = getSubsetEnv(psegs, 3, allTurf, tile, cf)
-    psegs = psegs[(psegs['EnvType'] != 3)|( (psegs['EnvType'] == 3) & (psegs['lu'].isin(lusToKeep)) )]
-    note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==3])) + " forested segments"
-    etime(cf, note, st)
-    st = time.time()
+        # get forested - remove records that are forested and not a lu to keep
+        forested = getSubsetEnv(psegs, 3, allTurf, tile, cf)
+        psegs = psegs[(psegs['EnvType'] != 3)|( (psegs['EnvType'] == 3) & (psegs['lu'].isin(lusToKeep)) )]
+        note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==3])) + " forested segments"
+        etime(cf, note, st)
+        st = time.time()
 
-    #get ag - remove records that are not a lu to keep
-    ag = getSubsetAg(psegs, 4, allTurf, allAg, tile, cf, NUM_CPUS) #returns 3rd argument - tct_forested to calc tct and forest for forest frag
-    psegs = psegs[psegs['lu'].isin(lusToKeep)] #NEED FOR FRAG FOREST
-    note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==4])) + " agricultural segments"
-    etime(cf, note, st)
-    st = time.time()
+        #get ag - remove records that are not a lu to keep
+        ag = getSubsetAg(psegs, 4, allTurf, allAg, tile, cf, NUM_CPUS) #returns 3rd argument - tct_forested to calc tct and forest for forest frag
+        psegs = psegs[psegs['lu'].isin(lusToKeep)] #NEED FOR FRAG FOREST
+        note = str(tile) + ' -- Subset ' + str(len(psegs[psegs['EnvType']==4])) + " agricultural segments"
+        etime(cf, note, st)
+        st = time.time()
 
-    tct = []
-    tct.append(calcTCT4(dense[0], roads, 20, 1, tile, cf, NUM_CPUS)) #dense tct
-    del dense[0] #gets rid of gdf - leaves forest
-    tct.append(calcTCT4(notDense[0], roads, 10, 2, tile, cf, NUM_CPUS)) #not dense tct
-    del notDense[0] #get rid of gdf - leaves forest
-    tct.append(calcTCT4(forested[0], roads, 10, 3, tile, cf, NUM_CPUS)) #not dense tct - roads_union
-    del forested[0] #gets rid of gdf - leaves forest
-    tct.append(calcTCT4(ag[0], roads, 10, 4, tile, cf, NUM_CPUS)) #not dense tct
-    del ag[0] #gets rid of gdf - leaves forest
-
-    note = str(tile) + " -- Ran Buffer Workflow for all environments"
-    etime(cf, note, st)
-    st = time.time()
+        tct = []
+        tct.append(calcTCT4(dense[0], roads, 20, 1, tile, cf, NUM_CPUS)) #dense tct
+        del dense[0] #gets rid of gdf - leaves forest
+        tct.append(calcTCT4(notDense[0], roads, 10, 2, tile, cf, NUM_CPUS)) #not dense tct
+        del notDense[0] #get rid of gdf - leaves forest
+        tct.append(calcTCT4(forested[0], roads, 10, 3, tile, cf, NUM_CPUS)) #not dense tct - roads_union
+        del forested[0] #gets rid of gdf - leaves forest
+        tct.append(calcTCT4(ag[0], roads, 10, 4, tile, cf, NUM_CPUS)) #not dense tct
+        del ag[0] #gets rid of gdf - leaves forest
+
+        note = str(tile) + " -- Ran Buffer Workflow for all environments"
+        etime(cf, note, st)
+        st = time.time()
 
-    forest = [dense[0], notDense[0], forested[0], ag[0]]
-    del dense
-    del notDense
-    del forested
-    del ag
+        forest = [dense[0], notDense[0], forested[0], ag[0]]
+        del dense
+        del notDense
+        del forested
+        del ag
 
-    forest = groupForest(forest, tct, tile, cf, NUM_CPUS)
-    note = str(tile) + " -- Created Forest Layer -- "
-    etime(cf, note, st)
-    st = time.time()
+        forest = groupForest(forest, tct, tile, cf, NUM_CPUS)
+        note = str(tile) + " -- Created Forest Layer -- "
+        etime(cf, note, st)
+        st = time.time()
 
-    note = str(tile) + " -- Removed TCT Buffers and Dissolved Forest -- "
-    etime(cf, note, st)
-    st = time.time()
+        note = str(tile) + " -- Removed TCT Buffers and Dissolved Forest -- "
+        etime(cf, note, st)
+        st = time.time()
 
-    toa =  getForestFrag(forest, psegs, allTurf, tile, cf, NUM_CPUS)
+        toa =  getForestFrag(forest, psegs, allTurf, tile, cf, NUM_CPUS)
 
-    if len(toa) > 0:
-        toa = toa[['lu_code', 'lu', 'logic', 'geometry']]
+        if len(toa) > 0:
+            toa = toa[['lu_code', 'lu', 'logic', 'geometry']]
     
-    note = str(tile) + " -- Ran Rules 1-3 -- "
-    etime(cf, note, st)
-    st = time.time()
+        note = str(tile) + " -- Ran Rules 1-3 -- "
+        etime(cf, note, st)
+        st = time.time()
 
-    return [tct, toa]
+        return [tct, toa]
+    finally:
+        mp_runtime.shutdown_runtime() # tile worker runtime, pool workers exit without atexit
 
 #########################################################################################
 ############################TCT BUFFERS WORKFLOW#########################################
@@ -854,34 +861,17 @@ def shared_border(args):
                 sjoinSeg - df of relationship between patch id (Id) and psegs (PSID)
     Returns: forest_patches - list of forest patch Ids that shared borders with the passed psegs
     """
-    folder = luconfig.folder
     df1, df2, sjoinSeg, r_field = args
 
-    forestList = list(set(list(sjoinSeg['Id'])))  # get unique forest patch segs
-    count = 0
-    ecount = 0
-    forest_patches = []
-    for patch in forestList:
-        totalShrdBorder = 0
-        pseg_list = list(sjoinSeg[sjoinSeg['Id'] == patch]['PSID'])  
-        patchGeo = list(df2[df2['Id'] == patch]['geometry'])[0]  
-        half_border = patchGeo.length / 2 # if tot count exceeds this it is majority
-        for pseg in pseg_list:
-            count += 1
-            psegGeo = list(df1[df1['PSID'] == pseg]['geometry'])[0]
-            try:
-                border = patchGeo.intersection(psegGeo) 
-                totalShrdBorder += border.length
-                if r_field == 'maj' and totalShrdBorder > half_border:
-                    forest_patches.append(patch)
-                    break # once it exceeds majority - break from current forest patch
-            except:
-                ecount += 1
-
-        if r_field == 'all_ag':
-            if totalShrdBorder / patchGeo.length > 0.85: 
-                forest_patches.append(patch)
-                
+    # first geometry per PSID/patch Id, psegs can be repeated after explode()
+    psegGeo = df1.drop_duplicates('PSID').set_index('PSID')['geometry']
+    patchGeo = df2.drop_duplicates('Id').set_index('Id')['geometry']
+    psegGeo = np.asarray(psegGeo.loc[sjoinSeg['PSID']].values, dtype=object)
+    patchGeo = np.asarray(patchGeo.loc[sjoinSeg['Id']].values, dtype=object)
+
+    border = adjacency.shared_border_lengths(psegGeo, patchGeo)
+    forest_patches = adjacency.patch_border_pass(sjoinSeg['Id'].values, border, shapely.length(patchGeo), r_field)
+
     return forest_patches
 
 #####################################################################################
@@ -891,62 +881,17 @@ def sjoin_mp6(df1, batch_size, sjoin_op, sjoinCols, df2, NUM_CPUS):
     """
     Method: sjoin_mp6()
     Purpose: Chunk and mp a sjoin function on specified geodataframes for specified operation,
-             retaining specified columns.
+             retaining specified columns. Runs on the shared worker runtime (mp_runtime).
     Params: df1 - geodataframe of data to chunk and sjoin (left gdf)
             batch_size - integer value of max number of records to include in each chunk
             sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
             sjoinCols - list of column names to retain
             df2 - geodataframe of data to sjoin (right gdf)
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
-    """
-    folder = luconfig.folder
-    c = list(df1)
-    df1 = df1.reset_index()
-    df1 = df1[c]
-    if len(df1) == 0:
-        print('df1 is empty')
- 
-    num_chunks = int(len(df1) / batch_size) + 1
-
-    #make cols a string for now to pass as 4th arg to sjoin
-    tmpCols = ''
-    for s in range(len(sjoinCols)):
-        tmpCols += sjoinCols[s]
-        if s+1 != len(sjoinCols):
-            tmpCols += ' '
- 
-    chunk_iterator = []
-    for i in range(0, num_chunks):
-        mn, mx = i * batch_size, (i + 1) * batch_size
-        gdf_args = df1[mn:mx], df2, sjoin_op, tmpCols
-        chunk_iterator.append(gdf_args)
-
-    pool = mp.Pool(processes=NUM_CPUS)
-    sj_results = pool.map(sjoin_mp_pt5, chunk_iterator)
-    pool.close()
-    sj_results = pd.concat(sj_results)
-    sj_results.drop_duplicates(inplace=True)
-    return sj_results
-
-def sjoin_mp_pt5(args):
-    """
-    Method: sjoin_mp_pt5()
-    Purpose: Run sjoin on specified geodataframes for specified operation,
-             retaining specified columns.
-    Params: args - tuple of arguments
-                df1 - geodataframe of data to sjoin (left gdf)
-                df2 - geodataframe of data to sjoin (right gdf)
-                sjoin_op - string of sjoin operation to use; 'intersects', 'within', 'contains'
-                sjoinCols - string of column names to retain, separated by a space
-    Returns: sjoinSeg - df (or gdf) of sjoined data, with sjoin columns retained
+            NUM_CPUS - number of processes, only used if the runtime is not running yet
+    Returns: sjoinSeg - df of sjoined data, with sjoin columns retained
     """
-    dft = time.time()
-    df1, df2, sjoin_op, sjoinCols = args 
-    cols = sjoinCols.split(' ') #list of column names to keep
-    sjoinSeg = gpd.sjoin(df1, df2, how='inner', op=sjoin_op)
-    sjoinSeg = sjoinSeg[cols]
-    sjoinSeg.drop_duplicates(inplace=True)
-    return sjoinSeg
+    runtime = mp_runtime.get_runtime(NUM_CPUS)
+    return runtime.sjoin_frames(df1, df2, sjoin_op, sjoinCols, batch_size)
 
 #####################################################################################
 #--------------------- MP SPATIAL OVERLAY FUNCTIONS --------------------------------#
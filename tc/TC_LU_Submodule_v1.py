@@ -29,6 +29,7 @@ import tc.dense_mp_v1 as env_pkg
 from tc.dense_mp_v1 import dense as callDense
 import tc.QGIS_geoprocessing as qgis_pkg
 import luconfig
+import psegs_schema
 from helpers import etime
 
 
@@ -99,7 +100,7 @@ def run_trees_over_submodule(NUM_CPUS, cf):
 
     chunk_iterator = []
     for idx, row in tiles.iterrows():
-        psegs = env_pkg.readPolysMask(psegsPath, psegsLayer, row['geometry'].envelope) # read in psegs layer
+        psegs = psegs_schema.read_psegs(psegsPath, psegsLayer, ['PID', 'PSID', 'Class_name', 'lu'], bbox=row['geometry'].envelope.bounds) # psegs of the tile through the gpkg R-tree
         note = "Read psegs gpkg for tile " + str(row['id'])
         etime(cf, note, st)
         st = time.time()
@@ -0,0 +1,285 @@
+"""
+Script: zone_raster.py
+Purpose: Zone raster helpers. Polygons are burned once as integer zones on a raster's native grid
+         (pixel centers, same rule as rio.mask.mask(all_touched=False)) and per polygon statistics are
+         reduced for all zones together with bincount instead of one mask per polygon.
+         Large extents are processed in blocks of block_size x block_size pixels.
+"""
+import numpy as np
+import shapely
+from rasterio.features import rasterize
+from rasterio.windows import Window
+
+
+def block_windows(src, bounds, block_size):
+    """
+    Method: block_windows()
+    Purpose: Windows of src covering bounds, clipped to the raster.
+    Params: src - open rasterio dataset (north up)
+            bounds - (minx, miny, maxx, maxy) in the raster crs
+            block_size - max rows/cols per window
+    Returns: list of (col_off, row_off, width, height)
+    """
+    minx, miny, maxx, maxy = bounds
+    row0, col0 = src.index(minx, maxy)
+    row1, col1 = src.index(maxx, miny)
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, src.height - 1), min(col1, src.width - 1)
+    windows = []
+    for r in range(row0, row1 + 1, block_size):
+        for c in range(col0, col1 + 1, block_size):
+            windows.append((c, r, min(block_size, col1 + 1 - c), min(block_size, row1 + 1 - r)))
+    return windows
+
+def window_boxes(src, windows):
+    """
+    Returns shapely boxes of windows (for selecting the polygons of each block).
+    """
+    return np.array([shapely.box(*src.window_bounds(Window(*w))) for w in windows], dtype=object)
+
+def zone_grid(geoms, zones, out_shape, transform):
+    """
+    Method: zone_grid()
+    Purpose: Burn polygons as zones, 0 where no pixel center falls in a polygon.
+    Params: geoms - array of shapely polygons (not overlapping)
+            zones - int zone of each polygon (> 0)
+            out_shape - (rows, cols)
+            transform - affine transform of the grid
+    Returns: int32 array
+    """
+    if len(geoms) == 0:
+        return np.zeros(out_shape, dtype=np.int32)
+    return rasterize(zip(geoms, (int(z) for z in zones)), out_shape=out_shape, transform=transform,
+                     fill=0, all_touched=False, dtype='int32')
+
+def zone_values(grid, values):
+    """
+    Returns (zones, values) of every pixel inside a zone.
+    """
+    inside = grid > 0
+    return grid[inside], values[inside]
+
+def zone_value_counts(zones, values):
+    """
+    Method: zone_value_counts()
+    Purpose: Count pixels per (zone, value) pair.
+    Returns: (zones, values, counts) of each distinct pair
+    """
+    if len(zones) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    pairs, counts = np.unique(np.stack([zones.astype(np.int64), values.astype(np.int64)]), axis=1, return_counts=True)
+    return pairs[0], pairs[1], counts
+
+def zone_majority(n, zones, values, counts):
+    """
+    Method: zone_majority()
+    Purpose: Majority value per zone from (zone, value, count) triplets (ie concatenated from several
+             blocks), ties go to the smallest value like np.argmax over np.unique.
+    Params: n - number of zones (zones are 1..n)
+    Returns: int64 array of n + 1, index is the zone, 0 for zones without pixels
+    """
+    majority = np.zeros(n + 1, dtype=np.int64)
+    if len(zones) == 0:
+        return majority
+    pairs, inv = np.unique(np.stack([zones, values]), axis=1, return_inverse=True)
+    totals = np.bincount(inv.ravel(), weights=counts)
+    order = np.lexsort((pairs[1], -totals, pairs[0])) # by zone, count desc, value asc
+    z = pairs[0][order]
+    first = np.r_[True, z[1:] != z[:-1]]
+    majority[z[first]] = pairs[1][order][first]
+    return majority
+
+def block_pairs(keys):
+    """
+    Returns (keys, counts) of the distinct keys of one block, bincount over the key span when it is compact.
+    """
+    if len(keys) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    kmin = keys.min()
+    if keys.max() - kmin <= 4 * len(keys):
+        counts = np.bincount(keys - kmin)
+        present = np.flatnonzero(counts)
+        return present + kmin, counts[present]
+    return np.unique(keys, return_counts=True)
+
+def tabulate_area(src, vals, zone_src=None, geoms=None, ids=None, block_size=4096):
+    """
+    Method: tabulate_area()
+    Purpose: Zone by class area table of a classed raster (TabulateArea). Zones come from a zone raster on the
+             same grid (ie ps_parcels.tif / ps_segs.tif) or are burned from polygons block by block (pixel centers,
+             same rule as rio.mask.mask). Every block adds its distinct (zone, class) keys, the table is one
+             bincount over the keys of all blocks instead of one mask and np.unique per polygon.
+             One burned grid holds one zone per pixel, so polygons overlapping another polygon (overlapping())
+             are left out of the burn and tabulated one at a time, each over all of its pixels like rio.mask.
+    Params: src - open rasterio dataset of the classed raster
+            vals - class values to tabulate, in column order (other values and nodata are ignored)
+            zone_src - open rasterio dataset of integer zones aligned with src (0 and nodata are no zone), or
+            geoms, ids - polygons and their zone ids (> 0)
+            block_size - max rows/cols read at a time
+    Returns: (zones, areas) - sorted zone ids and a len(zones) x len(vals) array of class areas (pixel count times
+             the cell area); with polygons every id is returned, zones without pixels are 0
+    """
+    vals = np.asarray(vals, dtype=np.int64)
+    order = np.argsort(vals)
+    nv = len(vals)
+    if zone_src is not None:
+        bounds = zone_src.bounds
+        zone_nodata = zone_src.nodata
+    else:
+        geoms, ids = np.asarray(geoms, dtype=object), np.asarray(ids, dtype=np.int64)
+        single = overlapping(geoms)
+        burn = np.flatnonzero(~single)
+        bounds = shapely.total_bounds(geoms[burn])
+        tree = shapely.STRtree(geoms[burn])
+    windows = block_windows(src, bounds, block_size) if len(vals) > 0 and (zone_src is not None or len(burn) > 0) else []
+
+    keys, counts = [], []
+    for w in windows:
+        window = Window(*w)
+        ras = src.read(1, window=window).astype(np.int64)
+        if zone_src is not None:
+            zwin = zone_src.window(*src.window_bounds(window)).round_offsets().round_lengths()
+            grid = zone_src.read(1, window=zwin, boundless=True, fill_value=0, out_shape=ras.shape).astype(np.int64)
+            if zone_nodata is not None:
+                grid[grid == zone_nodata] = 0
+        else:
+            hits = burn[tree.query(shapely.box(*src.window_bounds(window)))]
+            grid = zone_grid(geoms[hits], ids[hits], ras.shape, src.window_transform(window))
+        k, c = class_keys(src, ras, grid, vals, order)
+        keys.append(k)
+        counts.append(c)
+    if zone_src is None and len(vals) > 0:
+        for i in np.flatnonzero(single): # overlapping polygons, one burn each
+            for w in block_windows(src, geoms[i].bounds, block_size):
+                window = Window(*w)
+                ras = src.read(1, window=window).astype(np.int64)
+                grid = zone_grid(geoms[i:i + 1], ids[i:i + 1], ras.shape, src.window_transform(window))
+                k, c = class_keys(src, ras, grid, vals, order)
+                keys.append(k)
+                counts.append(c)
+
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    counts = np.concatenate(counts) if counts else np.empty(0, dtype=np.int64)
+    ukeys, inv = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inv, weights=counts, minlength=len(ukeys))
+    zones = np.unique(ukeys // nv) if zone_src is not None else np.unique(ids)
+    areas = np.zeros((len(zones), nv), dtype=np.float64)
+    areas[np.searchsorted(zones, ukeys // nv), ukeys % nv] = totals * abs(src.res[0] * src.res[1])
+    return zones, areas
+
+def class_keys(src, ras, grid, vals, order):
+    """
+    Returns (keys, counts) of the (zone, class) pairs of one block, key = zone * len(vals) + class position.
+    """
+    nv = len(vals)
+    pos = np.searchsorted(vals, ras, sorter=order)
+    pos[pos >= nv] = 0
+    cls = order[pos]
+    inside = (grid > 0) & (vals[cls] == ras)
+    if src.nodata is not None:
+        inside &= ras != src.nodata
+    return block_pairs(grid[inside].astype(np.int64) * nv + cls[inside])
+
+def overlapping(geoms):
+    """
+    Returns a bool mask of the polygons whose interior overlaps another polygon (touching edges do not count).
+    """
+    mask = np.zeros(len(geoms), dtype=bool)
+    if len(geoms) < 2:
+        return mask
+    a, b = shapely.STRtree(geoms).query(geoms, predicate='intersects')
+    a, b = a[a < b], b[a < b]
+    hit = shapely.relate_pattern(geoms[a], geoms[b], '2********')
+    mask[a[hit]] = True
+    mask[b[hit]] = True
+    return mask
+
+def aligned(src, other):
+    """
+    Returns True if other is on the grid of src (same crs and cell size, origins a whole number of cells apart).
+    """
+    if src.crs != other.crs or not np.allclose(src.res, other.res):
+        return False
+    dx = (other.transform.c - src.transform.c) / src.res[0]
+    dy = (other.transform.f - src.transform.f) / src.res[1]
+    return abs(dx - round(dx)) < 1e-6 and abs(dy - round(dy)) < 1e-6
+
+def coverage_pairs(geoms, transform, shape):
+    """
+    Method: coverage_pairs()
+    Purpose: Exact coverage of grid cells by polygons: area of every (polygon, cell) intersection on a grid.
+    Params: geoms - array of shapely polygons
+            transform - affine transform of the grid (north up)
+            shape - (rows, cols) of the grid, cells outside it are skipped
+    Returns: (gi, rows, cols, area) - polygon index, cell row and col and intersection area of each pair (area > 0)
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(geoms) == 0:
+        return empty, empty, empty, np.empty(0, dtype=np.float64)
+    xres, yres = transform.a, -transform.e
+    bounds = shapely.bounds(geoms)
+    c0 = np.clip(np.floor((bounds[:, 0] - transform.c) / xres), 0, shape[1] - 1).astype(np.int64)
+    c1 = np.clip(np.ceil((bounds[:, 2] - transform.c) / xres) - 1, 0, shape[1] - 1).astype(np.int64)
+    r0 = np.clip(np.floor((transform.f - bounds[:, 3]) / yres), 0, shape[0] - 1).astype(np.int64)
+    r1 = np.clip(np.ceil((transform.f - bounds[:, 1]) / yres) - 1, 0, shape[0] - 1).astype(np.int64)
+    ncols = np.maximum(c1 - c0 + 1, 0)
+    ncells = ncols * np.maximum(r1 - r0 + 1, 0)
+    gi = np.repeat(np.arange(len(geoms)), ncells)
+    k = np.arange(len(gi)) - np.repeat(np.cumsum(ncells) - ncells, ncells) # cell number within each polygon's box
+    rows = r0[gi] + k // ncols[gi]
+    cols = c0[gi] + k % ncols[gi]
+    x0 = transform.c + cols * xres
+    y1 = transform.f - rows * yres
+    area = shapely.area(shapely.intersection(geoms[gi], shapely.box(x0, y1 - yres, x0 + xres, y1)))
+    keep = area > 0
+    return gi[keep], rows[keep], cols[keep], area[keep]
+
+def tabulate_area_fractional(src, vals, geoms, ids, block_size=1024, batch_size=100000):
+    """
+    Method: tabulate_area_fractional()
+    Purpose: tabulate_area() on a coarse raster's native grid (ie 30 m NLCD and CDL) instead of a 1 m upsampled copy.
+             Every cell counts with the exact area of its intersection with the polygon, so the result is the
+             area the 1 m pixel center count approximates, from ~900 times fewer pixels.
+    Params: src - open rasterio dataset of the classed raster
+            vals - class values to tabulate, in column order (other values and nodata are ignored)
+            geoms, ids - polygons and their zone ids (> 0)
+            block_size - max rows/cols read at a time
+            batch_size - max polygons intersected with the cells at a time
+    Returns: (zones, areas) - sorted ids and a len(zones) x len(vals) array of class areas, zones without
+             coverage are 0
+    """
+    vals = np.asarray(vals, dtype=np.int64)
+    order = np.argsort(vals)
+    nv = len(vals)
+    geoms, ids = np.asarray(geoms, dtype=object), np.asarray(ids, dtype=np.int64)
+    windows = block_windows(src, shapely.total_bounds(geoms), block_size) if nv > 0 and len(geoms) > 0 else []
+    tree = shapely.STRtree(geoms)
+
+    keys, weights = [], []
+    for w in windows:
+        window = Window(*w)
+        ras = src.read(1, window=window).astype(np.int64)
+        hits = tree.query(shapely.box(*src.window_bounds(window)))
+        for b in range(0, len(hits), batch_size):
+            batch = hits[b:b + batch_size]
+            gi, rows, cols, area = coverage_pairs(geoms[batch], src.window_transform(window), ras.shape) # cells of this window only
+            v = ras[rows, cols]
+            pos = np.searchsorted(vals, v, sorter=order)
+            pos[pos >= nv] = 0
+            cls = order[pos]
+            inside = vals[cls] == v
+            if src.nodata is not None:
+                inside &= v != src.nodata
+            keys.append(ids[batch][gi[inside]] * nv + cls[inside])
+            weights.append(area[inside])
+
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    weights = np.concatenate(weights) if weights else np.empty(0, dtype=np.float64)
+    ukeys, inv = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inv, weights=weights, minlength=len(ukeys))
+    zones = np.unique(ids)
+    areas = np.zeros((len(zones), nv), dtype=np.float64)
+    areas[np.searchsorted(zones, ukeys // nv), ukeys % nv] = totals
+    return zones, areas